@@ -0,0 +1,326 @@
+from .const import MB, HTTP_CHUNK_SIZE, SAVE_INTERVAL
+from .cparcel import lib, BUFFER_SIZE
+from .http_client import HTTPClient
+from .log import get_logger
+from .range_server import RangeServer
+from .udt_client import UDTClient
+from .version import __version__
+from . import defaults
+
+from collections import namedtuple
+import datetime
+import filecmp
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+# Logging
+log = get_logger('benchmark')
+
+# Every combination of these is downloaded by the benchmark
+Case = namedtuple('Case', [
+    'client', 'size', 'n_procs', 'http_chunk_size', 'save_interval',
+    'engine', 'writer', 'congestion_control'])
+
+# udt proxies the range server with parcel-server's udt2tcp, udt-native
+# serves the files from parcel-server itself
+CLIENTS = ('http', 'udt', 'udt-native')
+SIZES = [256 * MB, 1024 * MB]
+N_PROCS = [1, 4, 8]
+HTTP_CHUNK_SIZES = [HTTP_CHUNK_SIZE]
+SAVE_INTERVALS = [SAVE_INTERVAL]
+ENGINES = [defaults.engine]
+WRITERS = [defaults.writer]
+# The UDT proxies use these congestion control algorithms, plain http
+# cases are run with the first only
+CONGESTION_CONTROLS = [defaults.congestion_control]
+
+# Files are generated from a fixed seed so that every run of the
+# benchmark downloads the same bytes
+SEED = 0
+
+
+def cases(clients=CLIENTS, sizes=SIZES, n_procs=N_PROCS,
+          http_chunk_sizes=HTTP_CHUNK_SIZES, save_intervals=SAVE_INTERVALS,
+          engines=ENGINES, writers=WRITERS,
+          congestion_controls=CONGESTION_CONTROLS):
+    """Return every combination of the given parameters.
+
+    """
+
+    return [Case(*values) for values in itertools.product(
+        clients, sizes, n_procs, http_chunk_sizes, save_intervals, engines,
+        writers, congestion_controls)
+        if values[0] != 'http' or values[-1] == congestion_controls[0]]
+
+
+def make_file(directory, size, seed=SEED):
+    """Create a file of ``size`` reproducible pseudo random bytes in
+    ``directory``, unless it already exists.
+
+    :returns: The id of the file
+
+    """
+
+    file_id = 'benchmark_{}_{}'.format(seed, size)
+    path = os.path.join(directory, file_id)
+    if os.path.exists(path) and os.path.getsize(path) == size:
+        return file_id
+    log.info('Creating {} ({} MB)'.format(path, size / MB))
+    rng = random.Random(seed)
+    block = ''.join(chr(rng.getrandbits(8)) for i in xrange(MB))
+    with open(path + '.tmp', 'wb') as f:
+        for i in xrange(0, size, MB):
+            # Rotate the block so no two megabytes are the same
+            shift = i / MB % MB
+            f.write((block[shift:] + block[:shift])[:size - i])
+    os.rename(path + '.tmp', path)
+    return file_id
+
+
+# The UDT proxies of the benchmark are started with these settings
+MSS = 8400
+UDT_BUFFER_SIZE = BUFFER_SIZE / 4
+UDP_BUFFER_SIZE = BUFFER_SIZE / 8
+
+
+def serve(directory, host, port):
+    RangeServer(directory, host, port).serve_forever()
+
+
+def proxy(start, *args):
+    """Run a UDT proxy started by the non-blocking ``lib`` function
+    called ``start`` until the process is terminated.
+
+    """
+
+    assert getattr(lib, start)(*args) == 0, 'Proxy failed to start'
+    while True:
+        time.sleep(99999999)
+
+
+class Benchmark(object):
+
+    def __init__(self, directory=None, host='localhost', http_port=9100,
+                 udt_port=9101, proxy_port=9102,
+                 udt_buffer_size=UDT_BUFFER_SIZE,
+                 udp_buffer_size=UDP_BUFFER_SIZE, destination=None,
+                 stripes=1, pool_size=0):
+        """Downloads files from a local :class:`RangeServer` over
+        loopback, directly with :class:`HTTPClient` and through a UDT
+        proxy pair with :class:`UDTClient`.
+
+        :param str directory:
+            Where the served files are created, by default a temporary
+            directory
+        :param str host: The loopback address to serve on
+        :param int http_port: The port of the range server
+        :param int udt_port: The port of the UDT server proxy
+        :param int proxy_port: The port of the local TCP to UDT proxy
+        :param int udt_buffer_size: The UDT buffer size of both proxies
+        :param int udp_buffer_size: The UDP buffer size of both proxies
+        :param str destination:
+            Where each download is written, by default the temporary
+            directory.  Write modes are compared on this disk
+        :param int stripes:
+            The UDT connections the proxies stripe each connection over
+        :param int pool_size:
+            The UDT connections the client side proxy keeps warm
+
+        """
+
+        self.directory = directory or tempfile.gettempdir()
+        self.host = host
+        self.http_port = http_port
+        self.udt_port = udt_port
+        self.proxy_port = proxy_port
+        self.udt_buffer_size = udt_buffer_size
+        self.udp_buffer_size = udp_buffer_size
+        self.destination = destination
+        self.stripes = stripes
+        self.pool_size = pool_size
+        self.processes = []
+
+    def start(self, client='http',
+              congestion_control=defaults.congestion_control):
+        """Start the servers that ``client`` downloads from.  Each runs in
+        its own process, so that the memory the UDT proxies keep for
+        their connections is released when they are stopped, and is not
+        inherited by the client's workers.
+
+        :param str congestion_control:
+            The UDT congestion control algorithm of both proxies
+
+        """
+
+        host = str(self.host)
+        targets = [(serve, (self.directory, self.host, self.http_port))]
+        if client == 'udt':
+            # The data node side, UDT -> range server
+            targets.append((proxy, (
+                'udt2tcp_start_configurable',
+                host, str(self.udt_port), host, str(self.http_port),
+                MSS, self.udt_buffer_size, self.udp_buffer_size,
+                self.stripes, congestion_control)))
+        elif client == 'udt-native':
+            # The data node side, UDT -> files
+            targets.append((proxy, (
+                'udt2file_start_configurable',
+                host, str(self.udt_port), str(self.directory),
+                MSS, self.udt_buffer_size, self.udp_buffer_size,
+                congestion_control)))
+        if client != 'http':
+            # The client side, parcel -> UDT
+            targets.append((proxy, (
+                'tcp2udt_start_configurable',
+                host, str(self.proxy_port), host, str(self.udt_port),
+                MSS, self.udt_buffer_size, self.udp_buffer_size,
+                self.stripes if client == 'udt' else 1, None,
+                self.pool_size, congestion_control)))
+        for target, args in targets:
+            process = multiprocessing.Process(target=target, args=args)
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        time.sleep(0.5)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+
+    def client(self, case, directory):
+        """Construct the client to download ``case`` with.
+
+        """
+
+        kwargs = dict(
+            token=None,
+            n_procs=case.n_procs,
+            directory=directory,
+            http_chunk_size=case.http_chunk_size,
+            save_interval=case.save_interval,
+            engine=case.engine,
+            writer=case.writer,
+        )
+        if case.client != 'http':
+            return UDTClient(
+                self.host, self.proxy_port,
+                'http://{}:{}'.format(self.host, self.udt_port),
+                external_proxy=True, **kwargs)
+        return HTTPClient(
+            'http://{}:{}'.format(self.host, self.http_port), **kwargs)
+
+    def run(self, case, repeat=3, verify=False):
+        """Download the file of ``case.size`` bytes ``repeat`` times into
+        an empty directory.
+
+        :param bool verify: Compare each downloaded file to the source
+        :returns: A dict of the case and the median time and throughput
+
+        """
+
+        file_id = make_file(self.directory, case.size)
+        source = os.path.join(self.directory, file_id)
+        timings, ok = [], True
+        for i in range(repeat):
+            for process in self.processes:
+                if not process.is_alive():
+                    raise RuntimeError('Benchmark server exited with {}'.format(
+                        process.exitcode))
+            destination = tempfile.mkdtemp(prefix='parcel_benchmark_',
+                                           dir=self.destination)
+            try:
+                client = self.client(case, destination)
+                start = time.time()
+                downloaded, errors = client.download_files([file_id])
+                timings.append(time.time() - start)
+                path = os.path.join(destination, file_id, file_id)
+                ok = ok and not errors and os.path.getsize(path) == case.size
+                if verify:
+                    ok = ok and filecmp.cmp(source, path, shallow=False)
+            finally:
+                shutil.rmtree(destination, ignore_errors=True)
+
+        seconds = sorted(timings)[len(timings) / 2]
+        result = case._asdict()
+        result.update(
+            seconds=seconds,
+            timings=timings,
+            mbps=case.size / float(MB) / seconds,
+            ok=ok,
+        )
+        log.info('{client} {size} B, {n_procs} procs, {http_chunk_size} B '
+                 'chunks, {engine}, {writer}, {congestion_control}: '
+                 '{mbps:.1f} MB/s'.format(
+                     **result))
+        return result
+
+    def run_all(self, cases, repeat=3, verify=False):
+        """Run every case, each with a freshly started server.
+
+        :returns: The results, with a description of the environment
+            they were measured in
+
+        """
+
+        results = []
+        for case in cases:
+            self.start(case.client, case.congestion_control)
+            try:
+                results.append(self.run(case, repeat, verify))
+            finally:
+                self.stop()
+        return dict(
+            version=__version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=multiprocessing.cpu_count(),
+            date=datetime.datetime.utcnow().isoformat(),
+            repeat=repeat,
+            results=results,
+        )
+
+
+def save(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(report, baseline, threshold=0.1):
+    """Compare the throughput of every case in ``report`` that was also
+    run in ``baseline``.
+
+    :param float threshold:
+        The fraction of the baseline throughput a case may lose before
+        it is considered a regression
+    :returns: A list of ``(case, baseline MB/s, MB/s, regressed)``
+
+    """
+
+    def key(result):
+        # Results from before a parameter was added used its default
+        return Case(*(result.get(field, getattr(defaults, field, None))
+                      for field in Case._fields))
+
+    previous = dict((key(r), r['mbps']) for r in baseline['results'])
+    comparison = []
+    for result in report['results']:
+        case = key(result)
+        if case in previous:
+            comparison.append((case, previous[case], result['mbps'],
+                               result['mbps'] < previous[case] * (
+                                   1 - threshold)))
+    return comparison
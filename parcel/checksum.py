@@ -0,0 +1,102 @@
+from .const import MB
+from .log import get_logger
+from . import tracing
+
+from collections import namedtuple
+from Queue import Queue
+import hashlib
+import os
+import threading
+
+# Logging
+log = get_logger('checksum')
+
+# Bytes read from the file per hash update
+BLOCK_SIZE = 4 * MB
+
+# Reported on the pool's event queue once a file has been verified, with
+# a description of the mismatch, or None if it matched
+ChecksumResult = namedtuple('ChecksumResult', ['error'])
+
+
+class PrefixChecksum(object):
+
+    def __init__(self, path, algorithm='md5'):
+        """Hashes a file while it is being downloaded.  The pool passes
+        the end of the contiguous prefix of the file that has been
+        written each time it grows, and a background thread reads and
+        hashes the new part while it is still in the page cache.
+
+        :param str path: The path of the file being downloaded
+        :param str algorithm: The name of a :mod:`hashlib` algorithm
+
+        """
+
+        self.path = path
+        self.hash = hashlib.new(algorithm)
+        self.queued = 0
+        self.error = None
+        self.abandoned = False
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        self.ranges = Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def update(self, end):
+        """Hash the file up to ``end``.  Every byte before ``end`` must
+        have been written.
+
+        """
+
+        if end > self.queued:
+            self.ranges.put((self.queued, end))
+            self.queued = end
+
+    def _run(self):
+        try:
+            while True:
+                work = self.ranges.get()
+                if work is None or self.abandoned:
+                    return
+                if callable(work):
+                    if self.error:
+                        return work(None, self.error)
+                    return work(self.hash.hexdigest(), None)
+                if not self.error:
+                    with tracing.span('checksum', path=self.path,
+                                      begin=work[0], end=work[1]):
+                        self._hash(*work)
+        finally:
+            os.close(self.fd)
+
+    def _hash(self, begin, end):
+        try:
+            os.lseek(self.fd, begin, os.SEEK_SET)
+            while begin < end and not self.abandoned:
+                block = os.read(self.fd, min(BLOCK_SIZE, end - begin))
+                if not block:
+                    raise IOError('Unexpected end of file at {}'.format(begin))
+                self.hash.update(block)
+                begin += len(block)
+        except Exception as e:
+            log.error('Unable to checksum {}: {}'.format(self.path, str(e)))
+            self.error = e
+
+    def verify(self, callback):
+        """Call ``callback(digest, error)`` from the hashing thread once
+        everything passed to :func:`update` has been hashed, with the
+        hex digest of the prefix, or the error that stopped hashing, and
+        stop the thread.  The caller does not wait on the hashing.
+
+        """
+
+        self.ranges.put(callback)
+
+    def abandon(self):
+        """Stop hashing as soon as possible, without waiting for it.
+
+        """
+
+        self.abandoned = True
+        self.ranges.put(None)
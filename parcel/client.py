@@ -1,11 +1,16 @@
 from . import const
+from . import defaults
+from . import tracing
 from . import utils
 from .download_stream import DownloadStream
 from .log import get_logger
+from .metrics import Metrics
+from .pool import DownloadPool
 from .portability import colored
-from .portability import Process
 from .segment import SegmentProducer
+from .tuning import ConnectionTuner
 
+from multiprocessing.pool import ThreadPool
 import os
 import tempfile
 import time
@@ -13,6 +18,9 @@ import time
 # Logging
 log = get_logger('client')
 
+# The most metadata requests made at once
+METADATA_THREADS = 16
+
 
 class Client(object):
 
@@ -29,6 +37,47 @@ class Client(object):
             The number of processes to use in download
         :param str directory:
             The directory to which any data will be downloaded
+        :param list mirrors:
+            The uris of other servers with the same files.  Segments are
+            downloaded from all of them, in proportion to the throughput
+            measured from each
+        :param str writer:
+            How chunks are written to disk, one of
+            :data:`parcel.writers.WRITERS`
+        :param bool preallocate:
+            Allocate the blocks of each file before it is downloaded,
+            where the filesystem supports it
+        :param str segment_digest:
+            The digest recorded for each chunk and checked on restart,
+            one of :data:`parcel.digests.DIGESTS`
+        :param int files_in_flight:
+            The maximum number of files downloaded concurrently by
+            the shared pool of ``n_procs`` processes
+        :param bool autotune:
+            Adjust the number of processes during the download,
+            starting with ``n_procs``
+        :param int min_procs:
+            The fewest processes to use when autotuning
+        :param int max_procs:
+            The most processes to use when autotuning
+        :param int retries:
+            The number of failed segment requests that are retried for
+            each file before it is given up on
+        :param str engine:
+            How the ``n_procs`` connections are run, one of
+            :data:`parcel.engines.ENGINES`
+        :param int metrics_port:
+            Serve live metrics of the download as JSON on this local
+            port, see :class:`parcel.metrics.Metrics`
+        :param str metrics_file:
+            Rewrite this file with live metrics of the download every
+            second
+        :param str trace:
+            Write timed spans of every segment and chunk to this file in
+            the Trace Event Format, see :mod:`parcel.tracing`
+        :param str profile:
+            Run every worker with cProfile and write the merged
+            statistics to this file
 
         """
 
@@ -36,17 +85,42 @@ class Client(object):
             'http_chunk_size', const.HTTP_CHUNK_SIZE)
         DownloadStream.check_segment_md5sums = kwargs.get(
             'segment_md5sums', True)
+        DownloadStream.writer = kwargs.get('writer', defaults.writer)
+        DownloadStream.preallocate = kwargs.get('preallocate', True)
+        DownloadStream.segment_digest = kwargs.get(
+            'segment_digest', defaults.segment_digest)
+        DownloadStream.retries = kwargs.get('retries', defaults.retries)
         SegmentProducer.save_interval = kwargs.get(
             'save_interval', const.SAVE_INTERVAL)
 
         self.debug = debug
         self.directory = directory or os.path.abspath(os.getcwd())
         self.directory = os.path.expanduser(self.directory)
+        self.files_in_flight = kwargs.get(
+            'files_in_flight', defaults.files_in_flight)
         self.n_procs = n_procs
+        self.autotune = kwargs.get('autotune', False)
+        self.min_procs = kwargs.get('min_procs', defaults.min_processes)
+        self.max_procs = kwargs.get('max_procs', defaults.max_processes)
+        self.engine = kwargs.get('engine', defaults.engine)
+        if self.autotune and self.engine == 'async':
+            log.warning('The async engine keeps a fixed number of '
+                        'connections, ignoring --autotune')
+            self.autotune = False
+        self.metrics_port = kwargs.get('metrics_port')
+        self.metrics_file = kwargs.get('metrics_file')
+        self.trace = kwargs.get('trace')
+        # Segment retries of the last download, and the bytes that were
+        # received but discarded by them
+        self.retries = 0
+        self.wasted = 0
+        self.profile = kwargs.get('profile')
         self.start = None
         self.stop = None
         self.token = token
         self.uri = self.fix_uri(uri)
+        self.uris = [self.uri] + [
+            self.fix_uri(mirror) for mirror in kwargs.get('mirrors', [])]
 
     @staticmethod
     def fix_uri(uri):
@@ -99,11 +173,16 @@ class Client(object):
             log.info(
                 'Download complete: {0:.2f} Gbps average'.format(rate))
 
-    def download_files(self, file_ids, *args, **kwargs):
+    def download_files(self, file_ids, manifest=None, *args, **kwargs):
         """Download a list of files.
 
         :params list file_ids:
             A list of strings containing the ids of the entities to download
+        :params dict manifest:
+            Manifest rows by file id.  The ``md5`` of a file is verified
+            as it is downloaded.  If the row has a ``filename`` and
+            ``size`` the server is not asked for them, otherwise the
+            ``size`` is checked against the size the server reports.
 
         """
 
@@ -118,20 +197,39 @@ class Client(object):
         for file_id in file_ids:
             log.info('Given file id: {}'.format(file_id))
 
-        # Download each file
-        downloaded, errors = [], {}
+        # Construct download streams
+        rows, candidates = manifest or {}, []
         for file_id in set(file_ids):
-
-            # Construct download stream
             directory = os.path.join(self.directory, file_id)
             stream = DownloadStream(file_id, self.uri, directory, self.token)
-
-            # Download file
+            stream.mirrors = self.uris
+            row = rows.get(file_id, {})
+            stream.md5sum = row.get('md5') or None
+            if row.get('filename') and row.get('size'):
+                stream.name, stream.size = row['filename'], long(row['size'])
+            candidates.append(stream)
+
+        # Get information for all files at once
+        fetched = self.prefetch_information(candidates)
+
+        streams, errors = [], {}
+        for stream in candidates:
+            file_id = stream.ID
+            row = rows.get(file_id, {})
+
+            # Get file information
+            utils.print_opening_header(file_id)
             try:
-                self.parallel_download(stream)
-                downloaded.append(file_id)
-
-            # Handle file download error, store error to print out later
+                if fetched[file_id]:
+                    raise fetched[file_id]
+                stream.init()
+                if row.get('size') and int(row['size']) != stream.size:
+                    raise ValueError(
+                        'Size {} does not match manifest size {}'.format(
+                            stream.size, row['size']))
+                streams.append(stream)
+
+            # Handle file information error, store error to print out later
             except Exception as e:
                 log.error('Unable to download {}: {}'.format(file_id, str(e)))
                 errors[file_id] = str(e)
@@ -141,6 +239,10 @@ class Client(object):
             finally:
                 utils.print_closing_header(file_id)
 
+        # Download all files with a single pool of processes
+        downloaded, pool_errors = self.parallel_download(*streams)
+        errors.update(pool_errors)
+
         # Print error messages
         self.print_summary(downloaded, errors)
         for file_id, error in errors.iteritems():
@@ -148,6 +250,32 @@ class Client(object):
 
         return downloaded, errors
 
+    def prefetch_information(self, streams):
+        """Get the name and size of every file concurrently, before any
+        of them are downloaded.
+
+        :returns: A dict of the exception raised for each file id, or
+            None if the information was fetched
+
+        """
+
+        def fetch(stream):
+            try:
+                stream.get_information()
+            except Exception as e:
+                return stream.ID, e
+            return stream.ID, None
+
+        if not streams:
+            return {}
+        log.info('Getting file information...')
+        pool = ThreadPool(min(METADATA_THREADS, len(streams)))
+        try:
+            return dict(pool.map(fetch, streams))
+        finally:
+            pool.close()
+            pool.join()
+
     def print_summary(self, downloaded, errors):
         print('\nSUMMARY:')
         if downloaded:
@@ -156,57 +284,56 @@ class Client(object):
         if errors:
             print('{}: {}'.format(
                 colored('Failed to download', 'red'), len(errors)))
+        if self.retries:
+            print('{}: {} ({} B re-downloaded)'.format(
+                colored('Segment retries', 'yellow'), self.retries,
+                self.wasted))
         print('')
 
-    def serial_download(self, stream):
-        """Download file to directory serially.
+    def serial_download(self, *streams):
+        """Download files to directory serially.
 
         """
-        self._download(1, stream)
+        return self._download(1, streams)
 
-    def parallel_download(self, stream):
-        """Download file to directory in parallel.
+    def parallel_download(self, *streams):
+        """Download files to directory in parallel.
 
         """
-        self._download(self.n_procs, stream)
+        return self._download(self.n_procs, streams)
 
-    def _download(self, nprocs, stream):
-        """Start ``self.n_procs`` to download the file.
+    def _download(self, nprocs, streams):
+        """Start ``nprocs`` to download the files.  The processes are
+        shared by all files, up to ``self.files_in_flight`` of which
+        are downloaded at a time.
 
-        :params str file_id:
-            String containing the id of the entity to download
+        :params list streams:
+            Initialized :class:`DownloadStream` objects to download
+        :returns: A tuple of downloaded file ids and a dict of errors
 
         """
 
-        # Start stream
-        utils.print_opening_header(stream.ID)
-        log.info('Getting file information...')
-        stream.init()
-
-        # Create segments producer to stream
-        n_procs = 1 if stream.size < .01 * const.GB else nprocs
-        producer = SegmentProducer(stream, n_procs)
-
-        def download_worker():
-            while True:
-                try:
-                    segment = producer.q_work.get()
-                    if segment is None:
-                        return log.debug('Producer returned with no more work')
-                    stream.write_segment(segment, producer.q_complete)
-                except Exception as e:
-                    if self.debug:
-                        raise
-                    else:
-                        log.error("Download aborted: {}".format(str(e)))
-
-        # Divide work amongst process pool
-        pool = [Process(target=download_worker) for i in range(n_procs)]
-
-        # Start pool
-        map(lambda p: p.start(), pool)
+        tuner = None
+        if self.autotune and nprocs > 1:
+            tuner = ConnectionTuner(nprocs, self.min_procs, self.max_procs)
+        metrics = None
+        if self.metrics_port is not None or self.metrics_file:
+            metrics = Metrics(self.metrics_port, self.metrics_file)
+        if self.trace:
+            tracing.start_trace(self.trace)
+        if self.profile:
+            tracing.start_profiles(self.profile)
+        pool = DownloadPool(nprocs, self.files_in_flight, self.debug, tuner,
+                            self.engine, metrics, self.profile, self.uris)
         self.start_timer()
-
-        # Wait for file to finish download
-        producer.wait_for_completion()
-        self.stop_timer()
+        try:
+            downloaded, errors = pool.download(streams)
+        finally:
+            self.retries, self.wasted = pool.retries, pool.wasted
+            if metrics:
+                metrics.close()
+            tracing.finish_trace()
+            if self.profile:
+                tracing.merge_profiles(self.profile)
+        self.stop_timer(sum(s.size for s in streams if s.ID in downloaded))
+        return downloaded, errors
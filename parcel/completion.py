@@ -0,0 +1,204 @@
+from collections import namedtuple
+from ctypes import c_bool, c_char, c_uint64
+from multiprocessing import Lock
+from multiprocessing.sharedctypes import RawArray, RawValue
+import struct
+import time
+
+# A completed chunk: the pool's slot for the file, whether a digest
+# was recorded, the mirror it came from, the chunk's range and its raw
+# digest
+RECORD = struct.Struct('<IHHQQ16s')
+
+# The number of records each worker can report before the pool reads
+RING_CAPACITY = 4096
+
+# Reported by a worker on the event queue under the file's slot each
+# time it retries a segment, with the bytes it received but discarded
+# and the mirror that failed
+SegmentRetry = namedtuple('SegmentRetry', ['wasted', 'error', 'mirror'])
+
+
+class CompletionRing(object):
+    """A single producer, single consumer ring buffer in shared memory.
+    Each download worker records the chunks it has written in its own
+    ring, and the pool reads them in batches, without a manager
+    process or pickling.
+
+    Only the worker advances ``head`` and only the pool advances
+    ``tail``, so neither side needs a lock.
+
+    """
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self.capacity = capacity
+        self.records = RawArray(c_char, capacity * RECORD.size)
+        # [head, tail]: total records written and read
+        self.counters = RawArray(c_uint64, 2)
+        # [chunks waiting to be written, microseconds the worker waited
+        # to queue another], published by the worker's WritePipeline
+        self.pipeline = RawArray(c_uint64, 2)
+        # Set by the worker once it has been told to exit, so that the
+        # pool can tell a retired worker from one that died
+        self.retired = RawValue(c_bool)
+
+    @property
+    def queued(self):
+        return self.pipeline[0]
+
+    @property
+    def stalled(self):
+        return self.pipeline[1] / 1e6
+
+    def put(self, slot, begin, end, digest=None, mirror=0):
+        """Record a completed chunk, waiting while the ring is full.
+
+        """
+
+        head = self.counters[0]
+        while head - self.counters[1] >= self.capacity:
+            time.sleep(0.001)
+        offset = (head % self.capacity) * RECORD.size
+        RECORD.pack_into(self.records, offset, slot, digest is not None,
+                         mirror, begin, end, digest or '')
+        # Publish the record only after it has been written
+        self.counters[0] = head + 1
+
+    def read(self):
+        """Return all records written since the last read as a list of
+        ``(slot, begin, end, digest, mirror)`` tuples.
+
+        """
+
+        head, tail = self.counters[0], self.counters[1]
+        records = []
+        for i in xrange(tail, head):
+            offset = (i % self.capacity) * RECORD.size
+            slot, has_digest, mirror, begin, end, digest = RECORD.unpack_from(
+                self.records, offset)
+            records.append((slot, begin, end, digest if has_digest else None,
+                            mirror))
+        self.counters[1] = head
+        return records
+
+
+class SegmentClaim(object):
+    """The segment a download worker is currently writing, shared with
+    the pool so that the pool can split off the rest of a slow
+    worker's segment for an idle one.
+
+    The worker claims each chunk with :func:`take` before writing it,
+    and the pool only moves ``end`` to a point the worker has not
+    claimed yet, so no byte is ever written by both.
+
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        # [segments started, slot, claimed up to, end, retries, mirror,
+        # begin]
+        self.state = RawArray(c_uint64, 7)
+
+    @property
+    def started(self):
+        return self.state[0]
+
+    @property
+    def slot(self):
+        return self.state[1]
+
+    @property
+    def remaining(self):
+        return max(0, self.state[3] - self.state[2])
+
+    @property
+    def begin(self):
+        return self.state[6]
+
+    @property
+    def end(self):
+        return self.state[3]
+
+    @property
+    def retries(self):
+        return self.state[4]
+
+    @property
+    def mirror(self):
+        return self.state[5]
+
+    def start(self, slot, segment, mirror=0):
+        """Called by the worker when it starts a new segment.
+
+        """
+
+        with self.lock:
+            self.state[5] = mirror
+            self.state[1] = slot
+            self.state[6] = segment.begin
+            self.state[2] = segment.begin
+            self.state[3] = segment.end
+            self.state[0] += 1
+
+    def release(self):
+        """Called by the worker when it is done with a segment, whether
+        or not all of it was written.
+
+        """
+
+        with self.lock:
+            self.state[3] = self.state[2]
+
+    def cancel(self, slot):
+        """Called by the pool to stop the worker after what it has
+        claimed, if it is still writing a segment of ``slot``.
+
+        """
+
+        with self.lock:
+            if self.state[1] == slot:
+                self.state[3] = self.state[2]
+
+    def retry(self, mirror=0):
+        """Called by the worker each time it requests its segment again
+        after a failure, from ``mirror``.
+
+        """
+
+        with self.lock:
+            self.state[4] += 1
+            self.state[5] = mirror
+
+    def take(self, offset, length):
+        """Claim up to ``length`` bytes at ``offset``.
+
+        :returns:
+            The number of bytes the worker may write, which is less
+            than ``length`` if the segment has been split
+
+        """
+
+        with self.lock:
+            length = max(0, min(length, self.state[3] - offset))
+            self.state[2] = max(self.state[2], offset + length)
+        return length
+
+    def split(self, min_size, align=1):
+        """Shorten the segment to half of what is left unclaimed.
+
+        :param int min_size: The smallest segment either half may be
+        :param int align: Split on a multiple of this many bytes
+        :returns:
+            ``(slot, begin, end)`` of the range split off, or None if
+            too little is left
+
+        """
+
+        with self.lock:
+            claimed, end = self.state[2], self.state[3]
+            at = claimed + (end - claimed) / 2
+            at -= at % align
+            if at - claimed < min_size or end - at < min_size:
+                return None
+            self.state[3] = at
+            return self.state[1], at, end
@@ -7,3 +7,19 @@ MB = 1024 * 1024
 
 HTTP_CHUNK_SIZE = 1 * MB
 SAVE_INTERVAL = int(1e6)
+MMAP_WINDOW_SIZE = 64 * MB
+
+# Segments are sized to take about SEGMENT_SECONDS to download at the
+# throughput measured per worker, within these bounds
+MIN_SEGMENT_SIZE = 16 * MB
+MAX_SEGMENT_SIZE = 1 * GB
+SEGMENT_SECONDS = 10
+
+# A failed segment request is retried after a random delay of up to
+# RETRY_BACKOFF seconds, doubled with every failure up to MAX_RETRY_BACKOFF
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 30
+
+# Chunks a worker may have received ahead of the disk: while one is
+# written and hashed the next ones are received
+WRITE_QUEUE_DEPTH = 2
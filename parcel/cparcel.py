@@ -1,14 +1,24 @@
 import os
-from ctypes import cdll, c_void_p, c_int
+from ctypes import (cdll, c_void_p, c_int, c_char_p, c_double, c_int64,
+                    POINTER, Structure, byref)
 from log import get_logger
 from utils import STRIP
 import platform
+import threading
+import time
 
 
 if platform.system() == 'Darwin':
     BUFFER_SIZE = 1048567
 else:
     BUFFER_SIZE = 67108864
+MSS = 8400
+
+# The kinds of proxy that count their connections
+PROXIES = ('tcp2udt', 'udt2tcp', 'udt2file')
+
+# The most connections of each proxy that udt_stats() describes
+MAX_UDT_CONNECTIONS = 256
 
 
 # Logging
@@ -24,6 +34,38 @@ except:
     _lib = None
 
 
+class UDTStats(Structure):
+    """The UDT statistics of a connection or of all of a proxy's
+    connections, see ``udt_stats_t`` in parcel.h.
+
+    """
+
+    _fields_ = [
+        ('socket', c_int),
+        ('connections', c_int),
+        ('rtt_ms', c_double),
+        ('bandwidth_mbps', c_double),
+        ('send_mbps', c_double),
+        ('receive_mbps', c_double),
+        ('send_period_us', c_double),
+        ('sent_packets', c_int64),
+        ('received_packets', c_int64),
+        ('retransmitted_packets', c_int64),
+        ('send_loss_packets', c_int64),
+        ('receive_loss_packets', c_int64),
+        ('sent_naks', c_int64),
+        ('received_naks', c_int64),
+        ('flow_window', c_int),
+        ('congestion_window', c_int),
+        ('flight_size', c_int),
+        ('send_buffer_available', c_int),
+        ('receive_buffer_available', c_int),
+    ]
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name, _ in self._fields_}
+
+
 def no_parcel_lib(*args, **kwargs):
     raise NotImplementedError(STRIP("""
         C++ parcel dynamic library failed to load. Either it was not
@@ -57,10 +99,13 @@ class ParcelDLL(object):
         #                                       char *remote_port,
         #                                       int mss,
         #                                       int udt_buffer_size,
-        #                                       int udp_buffer_size)
+        #                                       int udp_buffer_size,
+        #                                       int stripes,
+        #                                       char *congestion_control)
         self.udt2tcp_start_configurable = _lib.udt2tcp_start_configurable
         self.udt2tcp_start_configurable.argtypes = (
-            c_void_p, c_void_p, c_void_p, c_void_p, c_int, c_int, c_int)
+            c_void_p, c_void_p, c_void_p, c_void_p, c_int, c_int, c_int,
+            c_int, c_char_p)
         self.udt2tcp_start_configurable.restype = c_int
 
         # EXTERN int tcp2udt_start_configurable(char *local_host,
@@ -69,14 +114,153 @@ class ParcelDLL(object):
         #                                       char *remote_port,
         #                                       int mss,
         #                                       int udt_buffer_size,
-        #                                       int udp_buffer_size)
+        #                                       int udp_buffer_size,
+        #                                       int stripes,
+        #                                       char *stripe_hosts,
+        #                                       int pool_size,
+        #                                       char *congestion_control)
         self.tcp2udt_start_configurable = _lib.tcp2udt_start_configurable
         self.tcp2udt_start_configurable.argtypes = (
-            c_void_p, c_void_p, c_void_p, c_void_p, c_int, c_int, c_int)
+            c_void_p, c_void_p, c_void_p, c_void_p, c_int, c_int, c_int,
+            c_int, c_char_p, c_int, c_char_p)
         self.tcp2udt_start_configurable.restype = c_int
 
+        # int udt2file_start(char *local_host, char *local_port, char *directory);
+        self.udt2file_start = _lib.udt2file_start
+        self.udt2file_start.argtypes = (c_void_p, c_void_p, c_void_p)
+        self.udt2file_start.restype = c_int
+
+        # EXTERN int udt2file_start_configurable(char *local_host,
+        #                                        char *local_port,
+        #                                        char *directory,
+        #                                        int mss,
+        #                                        int udt_buffer_size,
+        #                                        int udp_buffer_size,
+        #                                        char *congestion_control)
+        self.udt2file_start_configurable = _lib.udt2file_start_configurable
+        self.udt2file_start_configurable.argtypes = (
+            c_void_p, c_void_p, c_void_p, c_int, c_int, c_int, c_char_p)
+        self.udt2file_start_configurable.restype = c_int
+
+        # EXTERN int proxy_connections(char *proxy, int *opened, int *active)
+        self.proxy_connections = _lib.proxy_connections
+        self.proxy_connections.argtypes = (
+            c_char_p, POINTER(c_int), POINTER(c_int))
+        self.proxy_connections.restype = c_int
+
+        # EXTERN int udt_stats(char *proxy, udt_stats_t *total,
+        #                      udt_stats_t *connections, int max)
+        self.udt_stats = _lib.udt_stats
+        self.udt_stats.argtypes = (
+            c_char_p, POINTER(UDTStats), POINTER(UDTStats), c_int)
+        self.udt_stats.restype = c_int
+
     def _set_not_implemented(self):
         self.udt2tcp_start = no_parcel_lib
         self.tcp2udt_start = no_parcel_lib
+        self.udt2tcp_start_configurable = no_parcel_lib
+        self.tcp2udt_start_configurable = no_parcel_lib
+        self.udt2file_start = no_parcel_lib
+        self.udt2file_start_configurable = no_parcel_lib
+        self.proxy_connections = no_parcel_lib
+        self.udt_stats = no_parcel_lib
 
 lib = ParcelDLL()
+
+
+def proxy_connections():
+    """Count the connections of the proxies started in this process.
+
+    :returns:
+        A dict of each kind of proxy in :data:`PROXIES` to the number of
+        connections it has ``opened`` and has ``active`` now, empty if
+        the library is not loaded
+
+    """
+
+    if not _lib:
+        return {}
+    counts = {}
+    for proxy in PROXIES:
+        opened, active = c_int(), c_int()
+        lib.proxy_connections(proxy, byref(opened), byref(active))
+        counts[proxy] = dict(opened=opened.value, active=active.value)
+    return counts
+
+
+def udt_stats(max_connections=MAX_UDT_CONNECTIONS):
+    """Sample the UDT connections of the proxies started in this process.
+    The rates of a connection are measured since it was last sampled,
+    by anyone.
+
+    :returns:
+        A dict of each kind of proxy in :data:`PROXIES` to a dict with
+        the ``total`` of its connections and up to ``max_connections``
+        open ``connections``, see :class:`UDTStats`, empty if the
+        library is not loaded
+
+    """
+
+    if not _lib:
+        return {}
+    stats = {}
+    for proxy in PROXIES:
+        total = UDTStats()
+        connections = (UDTStats * max_connections)()
+        count = lib.udt_stats(proxy, byref(total), connections,
+                              max_connections)
+        stats[proxy] = dict(
+            total=total.as_dict(),
+            connections=[c.as_dict() for c in
+                         connections[:min(count, max_connections)]],
+        )
+    return stats
+
+
+def describe_udt_stats(total):
+    """Summarize the ``total`` of a proxy from :func:`udt_stats` in a
+    line, to tell congestion (RTT and loss) from small windows and
+    buffers.
+
+    """
+
+    line = ('{sent_packets} packets sent, {received_packets} received, '
+            '{retransmitted_packets} retransmitted, {lost} lost'.format(
+                lost=(total['send_loss_packets'] +
+                      total['receive_loss_packets']), **total))
+    if total['connections']:
+        line += (', {connections} open: RTT {rtt_ms:.1f} ms, '
+                 '{send_mbps:.0f}/{receive_mbps:.0f} Mb/s sent/received, '
+                 'flow window {flow_window}, congestion window '
+                 '{congestion_window:.0f}, {flight_size} in flight'.format(
+                     **total))
+    return line
+
+
+def log_udt_stats(stats=None):
+    """Log the totals of each proxy that has sent or received anything.
+
+    """
+
+    for proxy, sample in sorted((stats or udt_stats()).items()):
+        total = sample['total']
+        if total['sent_packets'] or total['received_packets']:
+            log.info('UDT {:<15} : {}'.format(
+                proxy, describe_udt_stats(total)))
+
+
+def log_udt_stats_every(interval):
+    """Log the UDT statistics of this process's proxies every
+    ``interval`` seconds from a daemon thread.
+
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            log_udt_stats()
+
+    thread = threading.Thread(target=run, name='udt-stats')
+    thread.daemon = True
+    thread.start()
+    return thread
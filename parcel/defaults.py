@@ -1,6 +1,14 @@
 tcp_url = 'https://localhost'
 udt_url = 'https://localhost'
 processes = 8
+min_processes = 1
+max_processes = 32
 subcommand = 'http'
 proxy_host = 'localhost'
 proxy_port = 9000
+files_in_flight = 4
+writer = 'pwrite'
+segment_digest = 'md5'
+engine = 'processes'
+congestion_control = 'udt'
+retries = 10
@@ -0,0 +1,70 @@
+import hashlib
+import struct
+import zlib
+
+
+def md5(block):
+    return hashlib.md5(block).digest()
+
+
+def crc32(block):
+    return struct.pack('>I', zlib.crc32(block) & 0xffffffff)
+
+
+# Digests that can be recorded for each downloaded chunk and checked
+# when a download is resumed, as name: (size in bytes, function of a
+# block returning the digest).  md5 and crc32 are always available,
+# the others only if their optional modules are installed
+DIGESTS = {
+    'md5': (16, md5),
+    'crc32': (4, crc32),
+}
+
+try:
+    import crc32c as _crc32c
+    DIGESTS['crc32c'] = (4, lambda block: struct.pack(
+        '>I', _crc32c.crc32c(block) & 0xffffffff))
+except ImportError:
+    pass
+
+try:
+    import xxhash as _xxhash
+    if hasattr(_xxhash, 'xxh3_64_digest'):
+        DIGESTS['xxh3'] = (8, _xxhash.xxh3_64_digest)
+    DIGESTS['xxh64'] = (8, lambda block: _xxhash.xxh64(block).digest())
+except ImportError:
+    pass
+
+try:
+    from hashlib import blake2b as _blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b as _blake2b
+    except ImportError:
+        _blake2b = None
+if _blake2b:
+    DIGESTS['blake2b'] = (
+        16, lambda block: _blake2b(block, digest_size=16).digest())
+
+
+def get_digest(name):
+    """Return the function that computes the digest called ``name``.
+
+    """
+
+    if name not in DIGESTS:
+        raise ValueError('Unsupported digest {}, expected one of: {}'.format(
+            name, ', '.join(sorted(DIGESTS))))
+    return DIGESTS[name][1]
+
+
+def digest_size(name):
+    """Return the size in bytes of the digest called ``name``, or 0 for
+    no digest.
+
+    """
+
+    if not name:
+        return 0
+    get_digest(name)
+    return DIGESTS[name][0]
@@ -1,17 +1,100 @@
+from .digests import get_digest
 from .log import get_logger
+from .pipeline import WritePipeline
+from .writers import get_writer
+from . import tracing
 from . import utils
 from . import const
+from . import defaults
 
-from intervaltree import Interval
+import json
 import os
 import requests
+import threading
+import time
 import urlparse
+import weakref
+
+# Each download worker keeps its own HTTP session so that
+# connections are kept alive across segments and files
+_local = threading.local()
+
+
+def get_session(max_retries=16):
+    """Return the long lived HTTP session for this process and thread.
+    A new session is created after a fork so that children never share
+    sockets with their parent.
+
+    :param int max_retries: urllib3 retries used by the session adapter
+    :returns: A `requests` session
+
+    """
+
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.sessions = {}
+        _local.sockets = weakref.WeakSet()
+        _local.stats = {'opened': 0, 'reused': 0}
+    if max_retries not in _local.sessions:
+        a = requests.adapters.HTTPAdapter(max_retries=max_retries)
+        s = requests.Session()
+        s.mount('http://', a)
+        s.mount('https://', a)
+        _local.sessions[max_retries] = s
+    return _local.sessions[max_retries]
+
+
+def count_connection(r):
+    """Record whether the response arrived on a new or a reused
+    socket.  urllib3 silently reconnects sockets that the server has
+    dropped, so its own pool counters can not tell the two apart.
+
+    """
+
+    # raw._fp is the httplib response, whose file object holds the
+    # socket even when the connection will be closed after the response
+    fp = getattr(getattr(r.raw, '_fp', None), 'fp', None)
+    sock = getattr(fp, '_sock', None)
+    if sock is None:
+        return
+    if sock in _local.sockets:
+        _local.stats['reused'] += 1
+    else:
+        _local.sockets.add(sock)
+        _local.stats['opened'] += 1
+
+
+def session_stats():
+    """Count the connections opened and reused by this process and
+    thread's HTTP sessions.
+
+    :returns: A dict with ``opened`` and ``reused`` counts
+
+    """
+
+    if getattr(_local, 'pid', None) != os.getpid():
+        return {'opened': 0, 'reused': 0}
+    return dict(_local.stats)
+
+
+def discard(r):
+    """Close a response without returning its connection to the pool.
+    Used when the body has not been read to the end, as the connection
+    can not be reused for another request.
+
+    """
+
+    r.raw.close()
 
 
 class DownloadStream(object):
 
     http_chunk_size = const.HTTP_CHUNK_SIZE
     check_segment_md5sums = True
+    segment_digest = defaults.segment_digest
+    writer = defaults.writer
+    preallocate = True
+    retries = defaults.retries
 
     def __init__(self, ID, uri, directory, token=None):
         self.ID = ID
@@ -20,9 +103,26 @@ class DownloadStream(object):
         self.log = get_logger(str(ID))
         self.name = None
         self.directory = directory
+        self.md5sum = None
         self.size = None
+        # Whether the name and size have been read from or written to
+        # the metadata cache
+        self.information_cached = False
         self.token = token
         self.uri = uri
+        # Servers with the same files, segments may come from any
+        self.mirrors = [uri]
+
+    def __getstate__(self):
+        # Streams are sent to the download workers with each segment,
+        # loggers cannot be pickled so recreate it on the other side
+        state = self.__dict__.copy()
+        del state['log']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.log = get_logger(str(self.ID))
 
     def init(self):
         self.get_information()
@@ -33,7 +133,7 @@ class DownloadStream(object):
     def setup_file(self):
         self.setup_directories()
         try:
-            utils.set_file_length(self.path, self.size)
+            utils.set_file_length(self.path, self.size, self.preallocate)
         except:
             self.log.warn(utils.STRIP(
                 """Unable to set file length. File appears to
@@ -64,6 +164,14 @@ class DownloadStream(object):
         return os.path.join(
             self.state_directory, '{}.parcel'.format(self.name))
 
+    @property
+    def metadata_path(self):
+        """Function to standardize the metadata cache path for a download.
+
+        :returns: A string specifying the cached name and size path
+        """
+        return os.path.join(self.state_directory, 'metadata.json')
+
     @property
     def state_directory(self):
         """Function to standardize the state directory for a download.
@@ -72,7 +180,7 @@ class DownloadStream(object):
         """
         return os.path.join(self.directory, 'logs')
 
-    def header(self, start=None, end=None):
+    def header(self, start=None, end=None, uri=None):
         """Return a standard header for any parcel HTTP request.  If ``start``
         and ``end`` are specified, then the header will contain a Range
         request.
@@ -82,6 +190,7 @@ class DownloadStream(object):
             The end of the range interval. This value is inclusive.
             If give range A-B, then both bytes A and B will be
             included.
+        :param str uri: The server requested, by default ``self.uri``
         :returns: A dictionary header containing the token
         """
 
@@ -92,12 +201,13 @@ class DownloadStream(object):
             header['Range'] = 'bytes={}-{}'.format(start, end)
             # provide host because it's mandatory, range request
             # may not work otherwise
-            scheme, host, path, params, q, frag = urlparse.urlparse(self.uri)
+            scheme, host, path, params, q, frag = urlparse.urlparse(
+                uri or self.uri)
             header['host'] = host
         return header
 
     def request(self, headers=None, verify=False, close=False,
-                max_retries=16):
+                max_retries=16, uri=None):
         """Make request for file and return the response.
 
         :param str file_id: The id of the entity being requested.
@@ -106,123 +216,290 @@ class DownloadStream(object):
         :param bool close:
             Automatically close the connection. Set to true if you just
             the response header.
+        :param str uri: The server to ask, by default ``self.uri``
         :returns: A `requests` response.
 
         """
-        url = urlparse.urljoin(self.uri, self.ID)
+        uri = uri or self.uri
+        url = urlparse.urljoin(uri, self.ID)
         self.log.debug('Request to {}'.format(url))
 
-        # Set urllib3 retries and mount for session
-        a = requests.adapters.HTTPAdapter(max_retries=max_retries)
-        s = requests.Session()
-        s.mount(urlparse.urlparse(url).scheme, a)
+        # Reuse this worker's session and its kept-alive connections
+        s = get_session(max_retries)
 
         headers = self.headers() if headers is None else headers
         try:
             r = s.get(url, headers=headers, verify=verify, stream=True)
+            count_connection(r)
         except Exception as e:
             raise RuntimeError((
                 "Unable to connect to API: ({}). Is this url correct: '{}'? "
                 "Is there a connection to the API? Is the server running?"
-            ).format(str(e), self.uri))
+            ).format(str(e), uri))
         try:
             r.raise_for_status()
         except Exception as e:
             raise RuntimeError('{}: {}'.format(str(e), r.text))
 
         if close:
-            r.close()
+            discard(r)
         return r
 
     def get_information(self):
-        """Make a request to the data server for information on the file.
+        """Make a request to the data server for information on the file,
+        unless it is already known from the manifest or was cached by
+        a previous run.
 
         :param str file_id: The id of the entity being requested.
         :returns: Tuple containing the name and size of the entity
 
         """
 
-        headers = self.header()
-        r = self.request(headers, close=True)
+        if self.name is not None and self.size is not None:
+            if not self.information_cached:
+                self.save_information()
+            return self.name, self.size
+        if self.load_information():
+            return self.name, self.size
+
+        # Ask each mirror in turn until one answers
+        for uri in self.mirrors:
+            try:
+                r = self.request(self.header(uri=uri), close=True, uri=uri)
+                break
+            except Exception as e:
+                if uri == self.mirrors[-1]:
+                    raise
+                self.log.warn('Unable to get information from {}: {}'.format(
+                    uri, str(e)))
         content_length = r.headers.get('Content-Length')
         if not content_length:
             raise ValueError(
                 'Unexpected response from server: missing content length.')
         self.size = long(content_length)
-        self.log.info('Request responded   : {} bytes'.format(self.size))
+        self.log.debug('Request responded   : {} bytes'.format(self.size))
         attachment = r.headers.get('content-disposition', None)
         self.name = (attachment.split('filename=')[-1]
                      if attachment else 'untitled')
+        self.save_information()
         return self.name, self.size
 
-    def write_segment(self, segment, q_complete, retries=5):
+    def load_information(self):
+        """Read the name and size cached next to the state files.
 
-        """Read data from the data server and write it to a file.
+        :returns: True if they were found
+
+        """
+
+        if not os.path.isfile(self.metadata_path):
+            return False
+        try:
+            with open(self.metadata_path) as f:
+                metadata = json.load(f)
+            self.name, self.size = metadata['name'], long(metadata['size'])
+        except Exception as e:
+            self.log.warn('Unable to read {}: {}'.format(
+                self.metadata_path, str(e)))
+            return False
+        self.log.debug('Using cached file information')
+        self.information_cached = True
+        return True
+
+    def save_information(self):
+        """Cache the name and size next to the state files so that a
+        resumed download does not have to ask the server again.
+
+        """
+
+        try:
+            self.setup_directories()
+            with open(self.metadata_path, 'w') as f:
+                json.dump({'name': self.name, 'size': self.size}, f)
+            self.information_cached = True
+        except Exception as e:
+            self.log.warn('Unable to cache file information: {}'.format(
+                str(e)))
+
+    def write_chunk(self, writer, chunk, offset, report, mirror=0):
+        """Write a chunk to disk, get its digest if necessary, and report
+        completion back to the producer.
+
+        :returns: The number of bytes written
+
+        """
+
+        with tracing.span('write', file=self.ID, offset=offset):
+            writer.write(chunk, offset)
+        if self.check_segment_md5sums:
+            with tracing.span('digest', file=self.ID, offset=offset):
+                digest = get_digest(self.segment_digest)(chunk)
+        else:
+            digest = None
+        report(offset, offset+len(chunk), digest, mirror)
+        return len(chunk)
+
+    def write_segment(self, segment, report, claim=None, retried=None,
+                      pipeline=None, mirror=0):
+
+        """Read data from the data server and write it to a file.  Chunks
+        are written and hashed by ``pipeline`` while the next ones are
+        received.  After a failure the rest of the segment is requested
+        again, from the next mirror if there are several, continuing
+        from the last byte written once a backoff with jitter has
+        passed.  No more than ``self.retries`` failures are retried.
 
         :param str file_id: The id of the file
         :params str path: A string specifying the full download path
         :params tuple segment:
             A tuple containing the interval to download (start, end)
-        :params q_out: A multiprocessing Queue used for async reporting
+        :params report:
+            A callable used for async reporting of each written chunk
+            as ``report(begin, end, digest, mirror)``
+        :params claim:
+            An optional :class:`SegmentClaim` that each chunk is claimed
+            from before it is written.  If the pool splits the segment,
+            or cancels it when the file has run out of retries, only
+            the part up to the new end is written
+        :params retried:
+            An optional callable told of each retry as
+            ``retried(wasted, error, mirror)``, where ``wasted`` is the
+            number of bytes received in the failed attempt that were not
+            written and ``mirror`` is the mirror that failed
+        :params pipeline:
+            The worker's :class:`WritePipeline`, by default one is
+            started for the segment
+        :params int mirror:
+            The index in ``self.mirrors`` of the server to download from
         :returns: The total number of bytes written
 
         """
 
-        written = 0
-        # Create header that specifies range and make initial stream
-        # request. Note the 1 subtracted from the end of the interval
-        # is because the HTTP range request is inclusive of the top of
-        # the interval.
-        start, end = segment.begin, segment.end-1
-        assert end >= start, 'Invalid segment range.'
+        if pipeline is None:
+            pipeline = WritePipeline()
+            try:
+                return self.write_segment(
+                    segment, report, claim, retried, pipeline, mirror)
+            finally:
+                pipeline.close()
 
-        try:
-            # Initialize segment request
-            r = self.request(self.header(start, end))
-
-            # Iterate over the data stream
-            self.log.debug('Initializing segment: {}-{}'.format(start, end))
-            for chunk in r.iter_content(chunk_size=self.http_chunk_size):
-                if not chunk:
-                    continue  # Empty are keep-alives.
-                offset = start + written
-                written += len(chunk)
-
-                # Write the chunk to disk, create an interval that
-                # represents the chunk, get md5 info if necessary, and
-                # report completion back to the producer
-                utils.write_offset(self.path, chunk, offset)
-                if self.check_segment_md5sums:
-                    iv_data = {'md5sum': utils.md5sum(chunk)}
+        written = 0
+        failures = 0
+        traced = tracing.enabled()
+        segment_start = time.time()
+        assert segment.end > segment.begin, 'Invalid segment range.'
+
+        while True:
+            # Continue from the last byte written, up to the end of the
+            # claim, which is moved if the segment is split or cancelled
+            start = segment.begin + written
+            end = claim.end if claim is not None else segment.end
+            if start >= end:
+                break
+            uri = self.mirrors[mirror]
+            writes = pipeline.writes()
+            received = 0
+            split = False
+            error = None
+            r = None
+
+            try:
+                # Get this worker's open writer for the file
+                writer = get_writer(self.writer, self.path, pipeline)
+
+                # Initialize segment request, the span covers connecting
+                # and waiting for the response headers. Note the 1
+                # subtracted from the end of the interval is because the
+                # HTTP range request is inclusive of the top of the
+                # interval.
+                with tracing.span('request', file=self.ID, begin=start):
+                    r = self.request(self.header(start, end-1, uri), uri=uri)
+
+                # Iterate over the data stream
+                self.log.debug('Initializing segment: {}-{}'.format(
+                    start, end-1))
+                read_start = time.time() if traced else None
+                for chunk in r.iter_content(chunk_size=self.http_chunk_size):
+                    if not chunk:
+                        continue  # Empty are keep-alives.
+                    offset = start + received
+                    if traced:
+                        tracing.record('read', read_start, time.time(),
+                                       file=self.ID, offset=offset,
+                                       length=len(chunk))
+
+                    # Claim the chunk, the rest of the segment may have
+                    # been split off and given to another worker
+                    if claim is not None:
+                        length = claim.take(offset, len(chunk))
+                        if length < len(chunk):
+                            split, chunk = True, chunk[:length]
+
+                    # Queue the chunk to be written while the next one is
+                    # received, this blocks while the disk is behind
+                    if chunk:
+                        writes.submit(self.write_chunk, writer, chunk,
+                                      offset, report, mirror)
+                        received += len(chunk)
+                    if split:
+                        self.log.debug('Segment split at {}'.format(claim.end))
+                        break
+                    if traced:
+                        read_start = time.time()
+
+                # Check that the data is not truncated or elongated
+                if not split and start + received != end:
+                    raise IOError('Segment corruption: received {} of {} '
+                                  'bytes'.format(received, end - start))
+
+                writes.wait()
+                if writes.error is not None:
+                    raise writes.error
+
+                if split:
+                    discard(r)
                 else:
-                    iv_data = None
-                complete_segment = Interval(offset, offset+len(chunk), iv_data)
-                q_complete.put(complete_segment)
-
-        except KeyboardInterrupt:
-            return self.log.error('Process stopped by user.')
-
-        # Retry on exception if we haven't exceeded max retries
-        except Exception as e:
-            self.log.warn(
-                'Unable to download part of file: {}\n.'.format(str(e)))
-            if retries > 0:
-                self.log.warn('Retrying download of this segment')
-                return self.write_segment(segment, q_complete, retries-1)
-            else:
-                self.log.error('Max retries exceeded.')
-                return 0
-
-        # Check that the data is not truncated or elongated
-        if written != segment.end-segment.begin:
-            self.log.warn('Segment corruption: {}'.format(
-                '(non-fatal) retrying' if retries else 'max retries exceeded'))
-            if retries:
-                return self.write_segment(segment, q_complete, retries-1)
-            else:
-                raise RuntimeError('Segment corruption. Max retries exceeded.')
-
-        r.close()
+                    r.close()
+
+            except KeyboardInterrupt:
+                return self.log.error('Process stopped by user.')
+
+            except Exception as e:
+                error = e
+
+            # Whatever was received before a failure is still written
+            writes.wait()
+            written += writes.written
+            if error is None:
+                break
+
+            # Retry on exception if we haven't exceeded max retries
+            wasted = 0
+            if r is not None:
+                wasted = max(0, r.raw.tell() - writes.written)
+                discard(r)
+            failures += 1
+            tracing.record('segment', segment_start, time.time(),
+                           file=self.ID, begin=start,
+                           end=segment.begin + written, error=str(error))
+            self.log.warn('Unable to download part of file from {}: {}\n.'
+                          .format(uri, str(error)))
+            if failures > self.retries:
+                raise RuntimeError(
+                    'Max retries exceeded: {}'.format(str(error)))
+            if retried is not None:
+                retried(wasted, str(error), mirror)
+            mirror = (mirror + 1) % len(self.mirrors)
+            if claim is not None:
+                claim.retry(mirror)
+            delay = utils.retry_delay(failures)
+            self.log.warn('Retrying download of this segment from {} in '
+                          '{:.1f} s'.format(segment.begin + written, delay))
+            time.sleep(delay)
+            segment_start = time.time()
+
+        tracing.record('segment', segment_start, time.time(), file=self.ID,
+                       begin=start, end=segment.begin + written,
+                       retries=failures)
         return written
 
     def print_download_information(self):
@@ -0,0 +1,156 @@
+from .completion import SegmentRetry
+from .download_stream import session_stats
+from .event_loop import event_loop_worker
+from .log import get_logger
+from .pipeline import WritePipeline
+from .portability import OS_WINDOWS
+from .portability import Process
+from .writers import close_writers, writer_stats
+from . import tracing
+
+from functools import partial
+import Queue
+import multiprocessing
+import threading
+
+# Logging
+log = get_logger('engines')
+
+
+def download_worker(q_work, q_events, ring, claims, debug=False):
+    """Pull ``(slot, stream, segment, mirror)`` tuples off the work queue
+    until a ``None`` is received.  Written chunks are recorded in the
+    worker's shared memory ``ring`` under the file's ``slot``, and
+    claimed from the worker's shared claim so that the pool can split
+    the segment.
+    Retries are reported on ``q_events`` as ``(slot, SegmentRetry)``
+    and failures as ``(slot, exception)`` so that the pool can give up
+    on that file and move on to the next one.  On exit the worker's
+    connection and write counters are reported as ``(None, stats)``.
+
+    Chunks are written and hashed by the worker's
+    :class:`WritePipeline` while the next ones are received.
+
+    """
+
+    claim, = claims
+    pipeline = WritePipeline(stats=ring.pipeline)
+    while True:
+        work = q_work.get()
+        if work is None:
+            ring.retired.value = True
+            pipeline.close()
+            close_writers()
+            tracing.flush_trace()
+            stats = session_stats()
+            stats.update(writer_stats())
+            stats['write_stall'] = pipeline.stalled
+            q_events.put((None, stats))
+            return log.debug('Pool returned with no more work')
+        slot, stream, segment, mirror = work
+        claim.start(slot, segment, mirror)
+        retried = lambda wasted, error, mirror: q_events.put(
+            (slot, SegmentRetry(wasted, error, mirror)))
+        try:
+            stream.write_segment(segment, partial(ring.put, slot), claim,
+                                 retried, pipeline, mirror)
+        except Exception as e:
+            log.error('Download aborted: {}'.format(str(e)), exc_info=debug)
+            q_events.put((slot, RuntimeError(str(e))))
+        finally:
+            claim.release()
+
+
+class Engine(object):
+    """How the download pool runs its workers.  Each worker is started
+    as ``Process(target=target, args=(q_work, q_events, ring, claims,
+    debug))`` with one claim per connection it keeps open, and
+    communicates with the pool over queues created by ``Queue``.
+
+    """
+
+    Process = None
+    Queue = None
+    target = None
+
+    def __init__(self, n_procs):
+        """:param int n_procs: The number of connections to use
+
+        """
+
+        self.n_procs = n_procs
+
+    @property
+    def workers(self):
+        """The number of workers to start.
+
+        """
+
+        return self.n_procs
+
+    @property
+    def connections(self):
+        """The number of connections each worker keeps open.
+
+        """
+
+        return 1
+
+
+class ProcessEngine(Engine):
+    """One process per connection running blocking ``requests`` code.
+    Windows falls back to threads.
+
+    """
+
+    Process = Process
+    Queue = staticmethod(
+        Queue.Queue if OS_WINDOWS else multiprocessing.Queue)
+    target = staticmethod(download_worker)
+
+
+class ThreadEngine(Engine):
+    """One thread per connection running blocking ``requests`` code,
+    all in the client process.
+
+    """
+
+    Process = threading.Thread
+    Queue = Queue.Queue
+    target = staticmethod(download_worker)
+
+
+class EventLoopEngine(ProcessEngine):
+    """A single worker process that keeps all connections open at once
+    with non-blocking sockets, see :mod:`parcel.event_loop`.  The
+    number of connections can not be tuned while downloading.
+
+    """
+
+    target = staticmethod(event_loop_worker)
+
+    @property
+    def workers(self):
+        return 1
+
+    @property
+    def connections(self):
+        return self.n_procs
+
+
+ENGINES = {
+    'processes': ProcessEngine,
+    'threads': ThreadEngine,
+    'async': EventLoopEngine,
+}
+
+
+def get_engine(name, n_procs):
+    """Return the engine called ``name`` for ``n_procs`` connections.
+
+    """
+
+    if name not in ENGINES:
+        raise ValueError('Unknown engine {}, expected one of: {}'.format(
+            name, ', '.join(sorted(ENGINES))))
+    return ENGINES[name](n_procs)
@@ -0,0 +1,538 @@
+from .completion import SegmentRetry
+from .log import get_logger
+from .pipeline import WritePipeline
+from .writers import close_writers, get_writer, writer_stats
+from . import tracing
+from . import utils
+
+from Queue import Empty
+from functools import partial
+import errno
+import select
+import socket
+import ssl
+import time
+import urlparse
+
+# Logging
+log = get_logger('event_loop')
+
+# Seconds the loop waits on its sockets before checking for new work
+SELECT_TIMEOUT = 0.01
+
+# Bytes read from a socket at a time, and at most per turn of the loop
+RECV_SIZE = 256 * 1024
+RECV_PER_TURN = 16 * RECV_SIZE
+
+# Errors of non-blocking sockets that mean "try again later"
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINPROGRESS,
+               getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+
+class Connection(object):
+
+    def __init__(self, scheme, host, port):
+        """A non-blocking HTTP connection that is kept alive across
+        segments.  TLS connections are not verified, like the
+        ``requests`` code path.
+
+        """
+
+        self.key = (scheme, host, port)
+        self.host = host
+        self.reused = False
+        self.tls = scheme == 'https'
+        family, kind, proto, _, address = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, kind, proto)
+        self.sock.setblocking(0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        code = self.sock.connect_ex(address)
+        if code and code not in WOULD_BLOCK:
+            raise socket.error(code, 'Unable to connect to {}'.format(host))
+        self.connected = False
+        self.handshaken = not self.tls
+        self.want_write = True
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def ready(self):
+        """Finish connecting and the TLS handshake.
+
+        :returns: True once the connection can be used
+
+        """
+
+        if not self.connected:
+            code = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if code in WOULD_BLOCK:
+                return False
+            if code:
+                raise socket.error(code, 'Unable to connect to {}'.format(
+                    self.host))
+            self.connected = True
+            if self.tls:
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                context.verify_mode = ssl.CERT_NONE
+                self.sock = context.wrap_socket(
+                    self.sock, server_hostname=self.host,
+                    do_handshake_on_connect=False)
+        if not self.handshaken:
+            try:
+                self.sock.do_handshake()
+            except ssl.SSLWantReadError:
+                self.want_write = False
+                return False
+            except ssl.SSLWantWriteError:
+                self.want_write = True
+                return False
+            self.handshaken = True
+        return True
+
+    def send(self, data):
+        """:returns: The number of bytes sent, which may be 0
+
+        """
+
+        try:
+            return self.sock.send(data)
+        except ssl.SSLWantWriteError:
+            return 0
+        except socket.error as e:
+            if e.errno in WOULD_BLOCK:
+                return 0
+            raise
+
+    def recv(self):
+        """Read what is available on the socket.
+
+        :returns: A list of the blocks read, and False if the server
+            closed the connection
+
+        """
+
+        blocks, size = [], 0
+        while size < RECV_PER_TURN:
+            try:
+                block = self.sock.recv(RECV_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break
+            except socket.error as e:
+                if e.errno in WOULD_BLOCK:
+                    break
+                raise
+            if not block:
+                return blocks, False
+            blocks.append(block)
+            size += len(block)
+        return blocks, True
+
+    def pending(self):
+        """Whether TLS has already decrypted data that ``select`` will
+        not report.
+
+        """
+
+        return self.tls and self.handshaken and self.sock.pending() > 0
+
+    def close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+class Transfer(object):
+
+    def __init__(self, slot, stream, segment, mirror, claim, ring, pipeline,
+                 connection):
+        """Downloads one segment from a mirror over a connection and
+        hands it to the ``pipeline`` to be written to disk in chunks of
+        ``stream.http_chunk_size``, exactly like
+        :func:`DownloadStream.write_segment`.  Each time it is started
+        again it continues from the last byte written.
+
+        """
+
+        self.slot = slot
+        self.mirror = mirror
+        self.stream = stream
+        self.segment = segment
+        self.claim = claim
+        self.report = partial(ring.put, slot)
+        self.pipeline = pipeline
+        self.offset = segment.begin
+        self.failures = 0
+        self.resume_at = None
+        self.started = time.time()
+        self.start(connection)
+
+    def start(self, connection):
+        self.connection = connection
+        self.requested = time.time()
+        # Ask for the rest of the claim, which is moved if the segment
+        # is split or cancelled
+        self.begin, self.end = self.offset, self.claim.end
+        self.writes = self.pipeline.writes()
+        self.buffer, self.buffered = [], 0
+        self.headers = None
+        self.header_data = ''
+        self.remaining = None
+        self.keep_alive = False
+        self.split = False
+        self.received = False
+        url = urlparse.urlparse(urlparse.urljoin(self.uri, self.stream.ID))
+        lines = [
+            'GET {} HTTP/1.1'.format(url.path or '/'),
+            'Host: {}'.format(url.netloc),
+            'Range: bytes={}-{}'.format(self.begin, self.end - 1),
+            'Connection: keep-alive',
+            'User-Agent: parcel',
+        ]
+        if self.stream.token:
+            lines.append('X-Auth-Token: {}'.format(self.stream.token))
+        self.request = '\r\n'.join(lines) + '\r\n\r\n'
+
+    @property
+    def uri(self):
+        return self.stream.mirrors[self.mirror]
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def wants_write(self):
+        if not self.connection.handshaken:
+            return self.connection.want_write
+        return bool(self.request)
+
+    def step(self):
+        """Do whatever I/O the connection is ready for.
+
+        :returns: True once the segment has been written
+
+        """
+
+        if not self.connection.ready():
+            return False
+        if self.request:
+            sent = self.connection.send(self.request)
+            self.request = self.request[sent:]
+            return False
+
+        blocks, is_open = self.connection.recv()
+        for block in blocks:
+            self.received = True
+            if self.headers is None:
+                block = self.parse_headers(block)
+            if self.headers is not None and block:
+                self.receive(block[:self.remaining])
+            if self.done():
+                return True
+        if not is_open:
+            raise IOError('Connection closed by server')
+        return False
+
+    def parse_headers(self, block):
+        """Buffer ``block`` until all headers have been received.
+
+        :returns: The part of ``block`` after the headers
+
+        """
+
+        self.header_data += block
+        if '\r\n\r\n' not in self.header_data:
+            return ''
+        head, body = self.header_data.split('\r\n\r\n', 1)
+        lines = head.split('\r\n')
+        version, status = lines[0].split(' ', 2)[:2]
+        self.headers = dict(
+            (name.strip().lower(), value.strip()) for name, value in
+            (line.split(':', 1) for line in lines[1:] if ':' in line))
+        if status not in ('200', '206'):
+            raise IOError('{} response: {}'.format(status, lines[0]))
+        if 'content-length' not in self.headers:
+            raise IOError('Missing content length')
+        self.remaining = long(self.headers['content-length'])
+        # Servers that do not send a Content-Range must have sent
+        # exactly the range that was asked for
+        if 'content-range' in self.headers:
+            begin = long(self.headers['content-range'].split(
+                ' ')[-1].split('-')[0])
+        else:
+            begin = self.begin if self.remaining == (
+                self.end - self.begin) else None
+        if begin != self.begin:
+            raise IOError('Server did not return the requested range')
+        self.keep_alive = (version == 'HTTP/1.1' and self.headers.get(
+            'connection', '').lower() != 'close')
+        tracing.record('request', self.requested, time.time(),
+                       file=self.stream.ID, begin=self.begin)
+        return body
+
+    def receive(self, block):
+        """Buffer ``block`` of the body and write every full chunk.
+
+        """
+
+        self.remaining -= len(block)
+        self.buffer.append(block)
+        self.buffered += len(block)
+        chunk_size = self.stream.http_chunk_size
+        if self.buffered < chunk_size and self.remaining:
+            return
+        data = ''.join(self.buffer)
+        written = 0
+        while not self.split and (len(data) - written >= chunk_size or (
+                not self.remaining and written < len(data))):
+            self.write(data[written:written+chunk_size])
+            written += chunk_size
+        self.buffer = [data[written:]] if written < len(data) else []
+        self.buffered = max(0, len(data) - written)
+
+    def write(self, chunk):
+        length = self.claim.take(self.offset, len(chunk))
+        if length < len(chunk):
+            self.split, chunk = True, chunk[:length]
+        if not chunk:
+            return
+        self.writes.submit(
+            self.stream.write_chunk,
+            get_writer(self.stream.writer, self.stream.path, self.pipeline),
+            chunk, self.offset, self.report, self.mirror)
+        self.offset += len(chunk)
+
+    def flush(self):
+        """Wait for the chunks received so far to be written, and rewind
+        to the last byte written if a write failed.
+
+        """
+
+        self.writes.wait()
+        self.offset = self.begin + self.writes.written
+        if self.writes.error is not None:
+            raise self.writes.error
+
+    def done(self):
+        if self.split:
+            return True
+        if self.remaining is None or self.remaining > 0:
+            return False
+        if self.offset != self.end:
+            raise IOError('Segment corruption: received {} of {} '
+                          'bytes'.format(self.offset - self.begin,
+                                         self.end - self.begin))
+        return True
+
+
+class EventLoop(object):
+
+    def __init__(self, q_events, ring, claims, debug=False, pipeline=None):
+        """Keeps one transfer in flight per claim, over non-blocking
+        sockets in a single thread.  Transfers that failed wait out
+        their backoff without holding up the others.
+
+        """
+
+        self.q_events = q_events
+        self.ring = ring
+        self.pipeline = pipeline or WritePipeline(stats=ring.pipeline)
+        self.claims = claims
+        self.debug = debug
+        self.free = range(len(claims))
+        self.transfers = {}
+        # Failed transfers by claim, until their resume_at time
+        self.waiting = {}
+        self.idle = {}
+        self.stats = {'opened': 0, 'reused': 0}
+
+    def connect(self, uri, fresh=False):
+        """Return a kept-alive connection to the server at ``uri``, or a
+        new one.
+
+        """
+
+        url = urlparse.urlparse(uri)
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        key = (url.scheme, url.hostname, port)
+        idle = self.idle.get(key)
+        if idle and not fresh:
+            self.stats['reused'] += 1
+            connection = idle.pop()
+            connection.reused = True
+            return connection
+        self.stats['opened'] += 1
+        return Connection(*key)
+
+    def start(self, slot, stream, segment, mirror):
+        index = self.free.pop()
+        claim = self.claims[index]
+        claim.start(slot, segment, mirror)
+        try:
+            transfer = Transfer(slot, stream, segment, mirror, claim,
+                                self.ring, self.pipeline,
+                                self.connect(stream.mirrors[mirror]))
+        except Exception as e:
+            return self.fail(index, slot, e)
+        self.transfers[index] = transfer
+
+    def finish(self, index):
+        transfer = self.transfers.pop(index)
+        transfer.claim.release()
+        self.free.append(index)
+        tracing.record('segment', transfer.started, time.time(),
+                       file=transfer.stream.ID, begin=transfer.segment.begin,
+                       end=transfer.offset)
+        if transfer.keep_alive and not transfer.split:
+            self.idle.setdefault(
+                transfer.connection.key, []).append(transfer.connection)
+        else:
+            transfer.connection.close()
+
+    def retry(self, index, error):
+        """Close the transfer's connection and start it again from the
+        last byte written after a backoff, while the file has retries
+        left.
+
+        """
+
+        transfer = self.transfers.pop(index)
+        transfer.connection.close()
+        received = transfer.offset
+        try:
+            transfer.flush()
+        except Exception as e:
+            error = e
+        # A kept-alive connection may have been closed by the server
+        # while it was idle, which does not count as a failed attempt
+        if transfer.connection.reused and not transfer.received:
+            transfer.resume_at = time.time()
+            self.waiting[index] = transfer
+            return
+        transfer.failures += 1
+        tracing.record('segment', transfer.requested, time.time(),
+                       file=transfer.stream.ID, begin=transfer.begin,
+                       end=transfer.offset, error=str(error))
+        if transfer.failures > transfer.stream.retries:
+            return self.fail(index, transfer.slot, RuntimeError(
+                'Max retries exceeded: {}'.format(str(error))))
+        transfer.stream.log.warn('Unable to download part of file from {}: '
+                                 '{}.'.format(transfer.uri, str(error)))
+        # What was received but not written is requested again, from the
+        # next mirror
+        self.q_events.put((transfer.slot, SegmentRetry(
+            transfer.buffered + received - transfer.offset, str(error),
+            transfer.mirror)))
+        transfer.mirror = (transfer.mirror + 1) % len(transfer.stream.mirrors)
+        transfer.claim.retry(transfer.mirror)
+        transfer.resume_at = time.time() + utils.retry_delay(
+            transfer.failures)
+        self.waiting[index] = transfer
+
+    def resume(self):
+        """Start the waiting transfers whose backoff has passed.
+
+        """
+
+        now = time.time()
+        for index, transfer in self.waiting.items():
+            if transfer.resume_at > now:
+                continue
+            del self.waiting[index]
+            if transfer.offset >= transfer.claim.end:
+                # Split off or cancelled by the pool while waiting
+                transfer.claim.release()
+                self.free.append(index)
+                continue
+            try:
+                transfer.start(self.connect(transfer.uri, fresh=True))
+            except Exception as e:
+                self.fail(index, transfer.slot, e)
+                continue
+            self.transfers[index] = transfer
+
+    def fail(self, index, slot, error):
+        log.error('Download aborted: {}'.format(str(error)),
+                  exc_info=self.debug)
+        self.claims[index].release()
+        self.free.append(index)
+        self.q_events.put((slot, RuntimeError(str(error))))
+
+    def step(self, index):
+        transfer = self.transfers[index]
+        try:
+            if transfer.step():
+                transfer.flush()
+                self.finish(index)
+        except Exception as e:
+            self.retry(index, e)
+
+    def poll(self):
+        """Wait for sockets to be ready and step their transfers.
+
+        """
+
+        if not self.transfers:
+            return time.sleep(SELECT_TIMEOUT)
+        ready = [i for i, t in self.transfers.items()
+                 if t.connection.pending()]
+        readers = [t for t in self.transfers.values() if not t.wants_write()]
+        writers = [t for t in self.transfers.values() if t.wants_write()]
+        r, w, _ = select.select(
+            readers, writers, [], 0 if ready else SELECT_TIMEOUT)
+        index = dict((id(t), i) for i, t in self.transfers.items())
+        for i in set(ready + [index[id(t)] for t in r + w]):
+            if i in self.transfers:
+                self.step(i)
+
+    def run(self, q_work):
+        stopping = False
+        while True:
+            while self.free and not stopping:
+                try:
+                    if self.transfers or self.waiting:
+                        work = q_work.get_nowait()
+                    else:
+                        work = q_work.get()
+                except Empty:
+                    break
+                if work is None:
+                    self.ring.retired.value = True
+                    stopping = True
+                else:
+                    self.start(*work)
+            self.resume()
+            if not self.transfers and not self.waiting:
+                if stopping:
+                    break
+                continue
+            self.poll()
+
+    def close(self):
+        self.pipeline.close()
+        for transfer in self.transfers.values():
+            transfer.connection.close()
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+
+
+def event_loop_worker(q_work, q_events, ring, claims, debug=False):
+    """Download segments from the work queue with one non-blocking
+    connection per claim, all in this process, until a ``None`` is
+    received.  Reports the same way as
+    :func:`parcel.engines.download_worker`.
+
+    """
+
+    loop = EventLoop(q_events, ring, claims, debug)
+    try:
+        loop.run(q_work)
+    finally:
+        loop.close()
+        close_writers()
+        tracing.flush_trace()
+        stats = dict(loop.stats)
+        stats.update(writer_stats())
+        stats['write_stall'] = loop.pipeline.stalled
+        q_events.put((None, stats))
@@ -0,0 +1,259 @@
+from .digests import digest_size
+from .log import get_logger
+from .utils import replace_file
+
+from intervaltree import IntervalTree
+import binascii
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+
+# Logging
+log = get_logger('journal')
+
+# The state file starts with a header that identifies the format
+# version and the segment digest, followed by fixed size records of
+# completed ranges
+MAGIC = 'PRCLSTAT'
+VERSION = 2
+HEADER = struct.Struct('<8sH16sH')
+RANGE = struct.Struct('<QQ')
+
+# Seconds between fsyncs of the journal while downloading
+SYNC_INTERVAL = 5
+
+# Journals are compacted in the background once this many records
+# (and at least as many as the previous compaction kept) are appended
+COMPACT_RECORDS = 4096
+
+
+class StateJournal(object):
+
+    def __init__(self, path, digest='md5'):
+        """Creates an append-only journal of the completed ranges of a
+        download and the digest of each.  Only the journal holds the
+        digests, the producer keeps just the merged ranges in memory.
+
+        :param str path: The path of the state file
+        :param str digest:
+            The name of the segment digest stored with each range (see
+            :data:`parcel.digests.DIGESTS`), or an empty string to store
+            ranges only
+
+        """
+
+        self.path = path
+        self.set_digest(digest)
+        self.recorded_digest = None
+        self.fd = None
+        self.pending = []
+        self.since_compaction = []
+        self.appended = 0
+        self.compacted = 0
+        self.compaction = None
+        self.last_sync = time.time()
+
+    def set_digest(self, digest):
+        """Change the digest that is stored with each range from the next
+        :func:`rewrite` on.
+
+        """
+
+        self.digest = digest
+        self.digest_size = digest_size(digest)
+        self.record_size = RANGE.size + self.digest_size
+
+    def load(self):
+        """Read all completed ranges from the state file.  State files
+        written by older versions of parcel (a pickled IntervalTree)
+        are read as well, and will be migrated by :func:`rewrite`.  The
+        name of the digest the file was written with is kept in
+        ``self.recorded_digest``.
+
+        :returns: A list of ``(begin, end, digest)`` records, where
+            ``digest`` is None if none was recorded
+
+        """
+
+        with open(self.path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if not header.startswith(MAGIC):
+                log.info('Migrating state file {}'.format(self.path))
+                f.seek(0)
+                completed = pickle.load(f)
+                assert isinstance(completed, IntervalTree), \
+                    "Bad save state: {}".format(self.path)
+                self.recorded_digest = 'md5'
+                return [(i.begin, i.end, binascii.unhexlify(i.data['md5sum'])
+                         if i.data and 'md5sum' in i.data else None)
+                        for i in completed]
+            magic, version, digest, digest_size = HEADER.unpack(header)
+            if version != VERSION:
+                raise ValueError(
+                    'Unsupported state file version: {}'.format(version))
+            data = f.read()
+
+        self.recorded_digest = digest.rstrip('\0')
+        return self._parse(data, digest_size)
+
+    def _parse(self, data, digest_size):
+        record_size = RANGE.size + digest_size
+        records = []
+        # Any trailing partial record was torn by a crash and is ignored
+        for offset in xrange(0, len(data) - record_size + 1, record_size):
+            begin, end = RANGE.unpack_from(data, offset)
+            digest = data[offset+RANGE.size:offset+record_size]
+            if digest == '\0' * digest_size:
+                digest = None
+            records.append((begin, end, digest))
+        return records
+
+    def _record(self, begin, end, digest=None):
+        digest = (digest or '')[:self.digest_size]
+        return RANGE.pack(begin, end) + digest.ljust(self.digest_size, '\0')
+
+    def _header(self):
+        return HEADER.pack(MAGIC, VERSION, self.digest, self.digest_size)
+
+    def _write_snapshot(self, records):
+        """Write a complete journal of ``records`` to a temp file next to
+        the state file and return its name.
+
+        """
+
+        temp = tempfile.NamedTemporaryFile(
+            prefix='.parcel_',
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            delete=False)
+        try:
+            temp.write(self._header())
+            temp.write(''.join(self._record(*r) for r in sorted(records)))
+            temp.flush()
+            os.fsync(temp.fileno())
+        finally:
+            temp.close()
+        return temp.name
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND |
+                          getattr(os, 'O_BINARY', 0))
+
+    def _close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def rewrite(self, records):
+        """Replace the journal with a compact one containing only
+        ``records``.  This is done once when a download is started or
+        resumed.
+
+        :param list records: ``(begin, end, digest)`` tuples
+
+        """
+
+        self.wait_for_compaction()
+        self._close()
+        replace_file(self._write_snapshot(records), self.path)
+        self.pending = []
+        self.appended = 0
+        self.compacted = len(records)
+        self._open()
+
+    def append(self, begin, end, digest=None):
+        """Buffer a completed range to be written on the next flush.
+
+        """
+
+        record = self._record(begin, end, digest)
+        self.pending.append(record)
+        if self.compaction:
+            self.since_compaction.append(record)
+
+    def flush(self, sync=False):
+        """Append buffered records to the journal.  The journal is only
+        fsynced every ``SYNC_INTERVAL`` seconds unless ``sync`` is
+        given.
+
+        """
+
+        if self.pending:
+            os.write(self.fd, ''.join(self.pending))
+            self.appended += len(self.pending)
+            self.pending = []
+        if sync or time.time() - self.last_sync > SYNC_INTERVAL:
+            os.fsync(self.fd)
+            self.last_sync = time.time()
+
+        if self.compaction and not self.compaction.is_alive():
+            self._finish_compaction()
+        elif (not self.compaction and
+              self.appended > max(COMPACT_RECORDS, self.compacted)):
+            self._start_compaction()
+
+    def _start_compaction(self):
+        """Compact everything written to the journal so far in a
+        background thread.  Records appended in the meantime are kept
+        aside and added to the compacted journal when it is swapped in.
+
+        """
+
+        self.appended = 0
+        self.since_compaction = []
+        self.compaction = threading.Thread(
+            target=self._compact, args=(os.fstat(self.fd).st_size,))
+        self.compaction.result = None
+        self.compaction.daemon = True
+        self.compaction.start()
+
+    def _compact(self, size):
+        thread = threading.current_thread()
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(HEADER.size)
+                data = f.read(size - HEADER.size)
+            # Retried chunks are recorded again, keep the latest record
+            records = dict(((begin, end), digest) for begin, end, digest
+                           in self._parse(data, self.digest_size))
+            self.compacted = len(records)
+            thread.result = self._write_snapshot(
+                [(b, e, d) for (b, e), d in records.iteritems()])
+        except Exception as e:
+            log.error('Unable to compact state: {}'.format(str(e)))
+
+    def _finish_compaction(self):
+        """Swap in the compacted journal, including any records that were
+        appended while it was being written.
+
+        """
+
+        temp_name, self.compaction = self.compaction.result, None
+        if not temp_name:
+            return
+        with open(temp_name, 'ab') as f:
+            f.write(''.join(self.since_compaction))
+            f.flush()
+            os.fsync(f.fileno())
+        self.since_compaction = []
+        self._close()
+        replace_file(temp_name, self.path)
+        self._open()
+
+    def wait_for_compaction(self):
+        if self.compaction:
+            self.compaction.join()
+            self._finish_compaction()
+
+    def close(self):
+        """Flush and fsync all records and close the journal.
+
+        """
+
+        if self.fd is None:
+            return
+        self.flush(sync=True)
+        self.wait_for_compaction()
+        self._close()
@@ -0,0 +1,92 @@
+from .log import get_logger
+from .utils import replace_file
+
+import BaseHTTPServer
+import json
+import threading
+
+# Logging
+log = get_logger('metrics')
+
+# Seconds between the snapshots published by a server
+PUBLISH_INTERVAL = 1
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.metrics.dumps()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('{}: {}'.format(self.client_address[0], format % args))
+
+
+class Metrics(object):
+
+    def __init__(self, port=None, path=None, host='localhost'):
+        """Publishes snapshots of a running download or server as JSON,
+        either served over HTTP to anything that asks or rewritten to a
+        file, for dashboards and for telling a stalled worker from a
+        slow link.  Nothing is published if neither is given.
+
+        :param int port:
+            The port to serve the latest snapshot on, 0 for any free
+            port, or None to not serve it
+        :param str path:
+            A file to atomically replace with each snapshot, or None
+        :param str host: The address to serve on
+
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.snapshot = {}
+        self.server = None
+        if port is not None:
+            self.server = BaseHTTPServer.HTTPServer(
+                (host, port), MetricsRequestHandler)
+            self.server.metrics = self
+            thread = threading.Thread(target=self.server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            log.info('Serving metrics on http://{}:{}/'.format(
+                host, self.port))
+
+    @property
+    def port(self):
+        return self.server and self.server.server_address[1]
+
+    def dumps(self):
+        with self.lock:
+            return json.dumps(self.snapshot, indent=2, sort_keys=True)
+
+    def publish(self, snapshot):
+        """Replace the published snapshot.
+
+        :param dict snapshot: JSON serializable metrics
+
+        """
+
+        with self.lock:
+            self.snapshot = snapshot
+        if not self.path:
+            return
+        try:
+            temp_name = self.path + '.tmp'
+            with open(temp_name, 'w') as f:
+                f.write(self.dumps())
+            replace_file(temp_name, self.path)
+        except (IOError, OSError) as e:
+            log.warn('Unable to write metrics: {}'.format(str(e)))
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,153 @@
+from .log import get_logger
+
+import time
+
+# Logging
+log = get_logger('mirrors')
+
+# A mirror that fails is left out of new assignments for this many
+# seconds, doubled every time it is dropped again, up to MAX_PENALTY
+PENALTY = 15
+MAX_PENALTY = 300
+
+# A mirror whose connections are slower than this fraction of the
+# fastest mirror's is dropped, once it has been measured MIN_SAMPLES
+# times
+SLOW_FRACTION = 0.1
+MIN_SAMPLES = 3
+
+
+class Mirror(object):
+
+    def __init__(self, uri):
+        """A server that has the same files as the others, and the
+        throughput measured from it.
+
+        """
+
+        self.uri = uri
+        # Bytes received since the last measurement, and in total
+        self.measured = 0
+        self.total = 0
+        # Moving average throughput of each connection to the mirror
+        self.rate = None
+        self.samples = 0
+        self.errors = 0
+        self.drops = 0
+        self.dropped_until = None
+        # The current weight of the smooth weighted round robin
+        self.weight = 0.
+
+    @property
+    def dropped(self):
+        return self.dropped_until is not None
+
+
+class Mirrors(object):
+
+    def __init__(self, uris):
+        """Spreads segments over mirrors in proportion to the throughput
+        each mirror's connections are measured to get.  A mirror that
+        fails or falls far behind the others is dropped for a while and
+        then rejoins to be measured again.
+
+        :param list uris: The mirrors' URIs, the first is the primary
+
+        """
+
+        self.mirrors = [Mirror(uri) for uri in uris]
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def __getitem__(self, index):
+        return self.mirrors[index]
+
+    def live(self):
+        return [m for m in self.mirrors if not m.dropped]
+
+    def choose(self):
+        """Pick the mirror of the next segment with a smooth weighted
+        round robin, so that each mirror gets a share of the segments
+        in proportion to its connections' throughput, interleaved.
+        Mirrors that have not been measured yet get the average share.
+
+        :returns: The index of the mirror
+
+        """
+
+        if len(self.mirrors) == 1:
+            return 0
+        live = self.live() or self.mirrors
+        rates = [m.rate for m in live if m.rate]
+        default = sum(rates) / len(rates) if rates else 1.
+        total = 0.
+        for mirror in live:
+            weight = default if mirror.rate is None else mirror.rate
+            mirror.weight += weight
+            total += weight
+        chosen = max(live, key=lambda m: m.weight)
+        chosen.weight -= total
+        return self.mirrors.index(chosen)
+
+    def measure(self, elapsed, connections):
+        """Update each mirror's moving average throughput per connection,
+        rejoin mirrors whose penalty is over and drop the slow ones.
+
+        :param float elapsed: Seconds since the last measurement
+        :param list connections:
+            The number of connections downloading from each mirror
+
+        """
+
+        now = time.time()
+        for mirror, n in zip(self.mirrors, connections):
+            if mirror.dropped and now >= mirror.dropped_until:
+                log.info('Mirror rejoined     : {}'.format(mirror.uri))
+                mirror.dropped_until = None
+                mirror.rate, mirror.samples, mirror.weight = None, 0, 0.
+            if not n and not mirror.measured:
+                continue
+            rate = mirror.measured / elapsed / max(1, n)
+            mirror.rate = (rate if mirror.rate is None
+                           else .8 * mirror.rate + .2 * rate)
+            mirror.samples += 1
+            mirror.measured = 0
+
+        measured = [m for m in self.live() if m.samples >= MIN_SAMPLES]
+        if len(measured) < 2:
+            return
+        fastest = max(m.rate for m in measured)
+        for mirror in measured:
+            if mirror.rate < SLOW_FRACTION * fastest:
+                self.drop(mirror, '{:.0f} B/s per connection, {:.0f} B/s '
+                          'on the fastest'.format(mirror.rate, fastest))
+
+    def error(self, index, error):
+        """Count a failed request to a mirror, and drop it if there are
+        others to download from.
+
+        """
+
+        mirror = self.mirrors[index]
+        mirror.errors += 1
+        self.drop(mirror, error)
+
+    def drop(self, mirror, reason):
+        if mirror.dropped or len(self.live()) < 2:
+            return
+        mirror.drops += 1
+        penalty = min(MAX_PENALTY, PENALTY * 2 ** (mirror.drops - 1))
+        mirror.dropped_until = time.time() + penalty
+        log.warning('Dropping mirror {} for {} s: {}'.format(
+            mirror.uri, penalty, reason))
+
+    def snapshot(self, connections):
+        return [dict(
+            uri=m.uri,
+            bytes=m.total,
+            bytes_per_second=(m.rate or 0) * n,
+            connections=n,
+            errors=m.errors,
+            dropped=m.dropped,
+        ) for m, n in zip(self.mirrors, connections)]
@@ -0,0 +1,124 @@
+from .const import WRITE_QUEUE_DEPTH
+from .log import get_logger
+
+import Queue
+import threading
+import time
+
+# Logging
+log = get_logger('pipeline')
+
+
+class Writes(object):
+
+    def __init__(self, pipeline):
+        """The chunks of one request that have been handed to a
+        :class:`WritePipeline`.  ``written`` counts the bytes written so
+        far, and ``error`` is the first exception raised by a write,
+        after which the request's remaining chunks are dropped.
+
+        """
+
+        self.pipeline = pipeline
+        self.pending = 0
+        self.written = 0
+        self.error = None
+
+    def submit(self, write, *args):
+        """Queue ``write(*args)``, which returns the number of bytes it
+        wrote.  Raises the error of an earlier chunk instead, so that the
+        caller stops receiving.
+
+        """
+
+        self.pipeline.submit(self, write, args)
+
+    def wait(self):
+        """Block until every chunk submitted has been written or dropped.
+
+        """
+
+        self.pipeline.wait(self)
+
+
+class WritePipeline(object):
+
+    def __init__(self, depth=WRITE_QUEUE_DEPTH, stats=None):
+        """Writes and hashes received chunks on a thread of its own, so
+        that a worker keeps receiving while the disk is busy.  At most
+        ``depth`` chunks wait to be written.  Beyond that
+        :func:`submit` blocks, and the time it blocks is the disk's
+        back-pressure on the network.
+
+        :param int depth: The number of chunks received ahead of the disk
+        :param stats:
+            An optional shared array that the number of chunks queued
+            and the microseconds :func:`submit` blocked are published
+            to, see :attr:`CompletionRing.pipeline`
+
+        """
+
+        self.queue = Queue.Queue(depth)
+        self.done = threading.Condition()
+        self.stats = stats
+        self.stalled = 0.
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writes(self):
+        return Writes(self)
+
+    def submit(self, writes, write, args):
+        if writes.error is not None:
+            raise writes.error
+        with self.done:
+            writes.pending += 1
+        job = (writes, write, args)
+        try:
+            self.queue.put_nowait(job)
+        except Queue.Full:
+            start = time.time()
+            self.queue.put(job)
+            self.stalled += time.time() - start
+        if self.stats is not None:
+            self.stats[0] = self.queue.qsize()
+            self.stats[1] = int(self.stalled * 1e6)
+
+    def wait(self, writes):
+        with self.done:
+            while writes.pending:
+                self.done.wait()
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                # The sentinel was counted as queued after the last write
+                if self.stats is not None:
+                    self.stats[0] = 0
+                return
+            writes, write, args = job
+            written, error = 0, None
+            if writes.error is None:
+                try:
+                    written = write(*args)
+                except Exception as e:
+                    log.debug('Write failed: {}'.format(str(e)))
+                    error = e
+            with self.done:
+                writes.written += written
+                if writes.error is None:
+                    writes.error = error
+                writes.pending -= 1
+                self.done.notify_all()
+            if self.stats is not None:
+                self.stats[0] = self.queue.qsize()
+
+    def close(self):
+        """Write what is queued and stop the thread.
+
+        """
+
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,649 @@
+from .checksum import ChecksumResult
+from .completion import CompletionRing, SegmentClaim, SegmentRetry
+from .cparcel import proxy_connections, udt_stats, log_udt_stats
+from .digests import digest_size
+from .engines import get_engine
+from .ranges import Range, RangeSet
+from .log import get_logger
+from .mirrors import Mirrors
+from .segment import SegmentProducer
+from .tracing import profiled
+from .tuning import TUNE_INTERVAL
+from . import const
+
+from Queue import Empty
+import time
+
+# Logging
+log = get_logger('pool')
+
+# Seconds the pool sleeps when no worker has reported anything
+POLL_INTERVAL = 0.005
+
+# Seconds over which each worker's throughput is measured
+RATE_INTERVAL = 1
+
+
+class Worker(object):
+
+    def __init__(self, engine, q_work, q_events, debug=False, profile=None):
+        """A download worker started by ``engine``, and the shared memory
+        it reports through.  The worker has a claim for each of its
+        connections.  If ``profile`` is a path the worker runs with
+        cProfile, see :func:`parcel.tracing.profiled`.
+
+        """
+
+        self.ring = CompletionRing()
+        self.claims = [SegmentClaim() for i in range(engine.connections)]
+        self.measured = 0
+        self.total = 0
+        self.rate = None
+        self.last_report = time.time()
+        target = engine.target
+        args = (q_work, q_events, self.ring, self.claims, debug)
+        if profile:
+            target, args = profiled, (profile, target) + args
+        self.process = engine.Process(target=target, args=args)
+
+    @property
+    def connection_rate(self):
+        """The moving average throughput of each of the worker's
+        connections.
+
+        """
+
+        return self.rate and self.rate / len(self.claims)
+
+
+class DownloadPool(object):
+
+    def __init__(self, n_procs, files_in_flight=1, debug=False, tuner=None,
+                 engine='processes', metrics=None, profile=None,
+                 mirrors=None):
+        """Creates a pool of download workers that is shared by all files
+        passed to :func:`download`.
+
+        :param int n_procs:
+            The number of worker processes (connections) to use
+        :param int files_in_flight:
+            The maximum number of files that will have segments
+            scheduled at any one time
+        :param bool debug:
+            Print worker stack traces
+        :param tuner:
+            A :class:`parcel.tuning.ConnectionTuner` that adjusts the
+            number of workers while downloading, or None to keep
+            ``n_procs`` workers
+        :param str engine:
+            How the workers are run, one of
+            :data:`parcel.engines.ENGINES`
+        :param metrics:
+            A :class:`parcel.metrics.Metrics` that a snapshot of the
+            download is published to every ``RATE_INTERVAL`` seconds,
+            see :func:`snapshot`
+        :param str profile:
+            Run every worker with cProfile, writing the statistics next
+            to this path for :func:`parcel.tracing.merge_profiles`
+        :param list mirrors:
+            The URIs of the servers every file can be downloaded from,
+            in the order of each stream's ``mirrors``.  Segments are
+            spread over them by their measured throughput, see
+            :class:`parcel.mirrors.Mirrors`
+
+        """
+
+        self.tuner = tuner
+        self.metrics = metrics
+        self.profile = profile
+        self.engine_name = engine
+        self.mirrors = Mirrors(mirrors or [None])
+        self.engine = get_engine(engine, tuner.n_procs if tuner else n_procs)
+        self.n_procs = self.engine.workers
+        self.files_in_flight = max(1, files_in_flight)
+        self.debug = debug
+        self.active = {}
+        # Files that are complete but still being checksummed, by slot
+        self.verifying = {}
+        self.next_slot = 0
+        self.downloaded = []
+        self.errors = {}
+        self.stats = {}
+        self.workers = []
+        # Workers told to exit that have not yet done so
+        self.retiring = 0
+        self.spawned = 0
+        self.reported = 0
+        self.scheduled = 0
+        self.started = 0
+        # Segment retries, and the bytes received but discarded by them
+        self.retries = 0
+        self.wasted = 0
+        self.download_start = time.time()
+        self.measure_start = time.time()
+        self.tune_start = time.time()
+        self.tune_bytes = 0
+        self.tune_errors = 0
+        self.saturated = True
+        self.history = []
+        self.q_work = self.engine.Queue()
+        self.q_events = self.engine.Queue()
+
+    def start(self):
+        """Start ``self.n_procs`` workers that will live until :func:`stop`
+        is called.
+
+        """
+
+        self.resize(self.n_procs)
+
+    def resize(self, n_procs):
+        """Start or retire workers so that ``n_procs`` are running.
+        Retired workers finish their current segment first.
+
+        """
+
+        live = len(self.workers) - self.retiring
+        for i in range(live, n_procs):
+            self.spawn()
+        for i in range(n_procs, live):
+            self.q_work.put(None)
+            self.retiring += 1
+        self.n_procs = n_procs
+        self.history.append(n_procs)
+
+    def spawn(self):
+        worker = Worker(self.engine, self.q_work, self.q_events,
+                        self.debug, self.profile)
+        worker.process.start()
+        self.workers.append(worker)
+        self.spawned += 1
+
+    def reap(self):
+        """Forget workers that have exited, after reading what is left in
+        their rings.  A worker that exited without being retired has
+        died, its segments are put back in their files' work pools and
+        it is replaced.
+
+        :returns: The set of producers that were updated
+
+        """
+
+        updated = set()
+        for worker in [w for w in self.workers if not w.process.is_alive()]:
+            updated |= self.read_rings([worker])
+            self.workers.remove(worker)
+            self.started += sum(c.started for c in worker.claims)
+            if worker.ring.retired.value:
+                self.retiring = max(0, self.retiring - 1)
+            else:
+                self.reclaim(worker)
+                self.spawn()
+        return updated
+
+    def reclaim(self, worker):
+        """Return the parts of a dead worker's segments that were not
+        written to their files' work pools.
+
+        """
+
+        log.error('Worker {} died (exit code {})'.format(
+            worker.process.name, getattr(worker.process, 'exitcode', None)))
+        for claim in worker.claims:
+            producer = self.active.get(claim.slot)
+            if producer is None or claim.end <= claim.begin:
+                continue
+            missing = RangeSet([(claim.begin, claim.end)])
+            for begin, end in producer.completed:
+                missing.remove(begin, end)
+            for begin, end in missing:
+                log.debug('Rescheduling {} [{}, {})'.format(
+                    producer.download.ID, begin, end))
+                producer.work_pool.add(begin, end)
+
+    def collect(self, stats):
+        """Add the counters a worker reports on exit to the pool's.
+
+        """
+
+        self.reported += 1
+        for key, value in stats.iteritems():
+            self.stats[key] = self.stats.get(key, 0) + value
+
+    def stop(self):
+        """Discard any work left behind by failed files, tell the workers
+        there is no more work, and wait for them to exit.
+
+        """
+
+        try:
+            while True:
+                self.q_work.get_nowait()
+        except Empty:
+            pass
+        for i in range(len(self.workers) - self.retiring):
+            self.q_work.put(None)
+
+        # Collect the counters each worker reports on exit.  A worker
+        # may still be filling its ring with leftover work, and what
+        # it reported can still be in the queue after it has exited
+        while self.reported < self.spawned:
+            alive = any(w.process.is_alive() for w in self.workers)
+            self.read_rings()
+            try:
+                slot, result = self.q_events.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if alive:
+                    continue
+                break
+            if slot is None:
+                self.collect(result)
+        map(lambda w: w.process.join(), self.workers)
+        self.publish()
+        self.workers = []
+        if self.stats:
+            log.info('HTTP connections    : {opened} opened, {reused} reused'
+                     .format(**self.stats))
+            log.info('Disk writes         : {writes} chunks in {t:.2f} s, '
+                     'receiving waited {stall:.2f} s on them'.format(
+                         t=self.stats['write_time'],
+                         stall=self.stats['write_stall'], **self.stats))
+        if len(self.mirrors) > 1:
+            for mirror in self.mirrors:
+                log.info('Mirror              : {} B from {}'.format(
+                    mirror.total, mirror.uri))
+        if self.retries:
+            log.info('Segment retries     : {}, {} B re-downloaded'.format(
+                self.retries, self.wasted))
+        log_udt_stats()
+        if self.tuner:
+            log.info('Connections used    : {}'.format(
+                ' -> '.join(str(n) for n in self.history)))
+
+    def download(self, streams):
+        """Download all of the given streams.  Larger files are scheduled
+        first, and up to ``self.files_in_flight`` files share the
+        workers at once so that the tail of one file overlaps with the
+        start of the next.  Segments are handed out as workers become
+        idle, see :func:`schedule`.
+
+        :param list streams: Initialized :class:`DownloadStream` objects
+        :returns: A tuple of downloaded file ids and a dict of errors
+
+        """
+
+        pending = sorted(streams, key=lambda s: s.size, reverse=True)
+        self.start()
+        try:
+            while pending or self.active or self.verifying:
+                while pending and len(self.active) < self.files_in_flight:
+                    self.activate(pending.pop(0))
+                if self.active:
+                    self.schedule()
+                if not self.poll():
+                    time.sleep(POLL_INTERVAL)
+        finally:
+            self.stop()
+        return self.downloaded, self.errors
+
+    def activate(self, stream):
+        """Create a producer for the stream.
+
+        """
+
+        n_procs = 1 if stream.size < .01 * const.GB else self.n_procs
+        slot, self.next_slot = self.next_slot, self.next_slot + 1
+        try:
+            producer = SegmentProducer(stream, n_procs, slot)
+        except Exception as e:
+            return self.fail(stream.ID, e)
+        self.active[slot] = producer
+        if producer.is_complete():
+            self.finish(producer)
+
+    def schedule(self):
+        """Keep a segment queued for every idle worker, plus one spare so
+        that a worker never waits on the pool.  When the active files
+        have no more work, the segment that will take the longest to
+        finish is split instead.
+
+        """
+
+        queued = self.queue_depth
+        idle = len([c for w in self.workers for c in w.claims
+                    if not c.remaining]) - self.retiring
+        while queued < idle + 1:
+            work = self.next_segment()
+            if work is None and queued < idle:
+                work = self.split_segment()
+            if work is None:
+                return
+            self.q_work.put(work)
+            self.scheduled += 1
+            queued += 1
+
+    @property
+    def queue_depth(self):
+        """The number of segments scheduled that no worker has started.
+
+        """
+
+        return self.scheduled - self.started - sum(
+            c.started for w in self.workers for c in w.claims)
+
+    def segment_size(self):
+        """The number of bytes the average connection downloads in
+        ``SEGMENT_SECONDS``, within ``MIN_SEGMENT_SIZE`` and
+        ``MAX_SEGMENT_SIZE``.
+
+        """
+
+        rates = [w.connection_rate for w in self.workers if w.rate]
+        if not rates:
+            return const.MIN_SEGMENT_SIZE
+        size = int(sum(rates) / len(rates) * const.SEGMENT_SECONDS)
+        size = min(const.MAX_SEGMENT_SIZE, max(const.MIN_SEGMENT_SIZE, size))
+        return size - size % const.MB
+
+    def next_segment(self):
+        """Take a new segment from the earliest activated file that still
+        has work.
+
+        :returns: ``(slot, stream, segment, mirror)`` or None
+
+        """
+
+        size = self.segment_size()
+        for slot in sorted(self.active):
+            segment = self.active[slot].next_segment(size)
+            if segment:
+                return (slot, self.active[slot].download, segment,
+                        self.mirrors.choose())
+        return None
+
+    def split_segment(self):
+        """Split off the second half of what is left of the segment that
+        will take the longest to finish at its connection's rate.
+
+        :returns: ``(slot, stream, segment, mirror)`` or None
+
+        """
+
+        remaining = sorted([
+            (c.remaining / (w.connection_rate or 1), c)
+            for w in self.workers for c in w.claims
+            if c.remaining and c.slot in self.active],
+            reverse=True)
+        for _, claim in remaining:
+            split = claim.split(const.MIN_SEGMENT_SIZE, const.MB)
+            if split:
+                slot, begin, end = split
+                log.debug('Split segment of {} at {}'.format(
+                    self.active[slot].download.ID, begin))
+                return (slot, self.active[slot].download, Range(begin, end),
+                        self.mirrors.choose())
+        return None
+
+    def measure(self):
+        """Update each worker's and each file's moving average
+        throughput every ``RATE_INTERVAL`` seconds.
+
+        """
+
+        elapsed = time.time() - self.measure_start
+        if elapsed < RATE_INTERVAL:
+            return
+        for worker in self.workers:
+            # The pool can only judge the number of connections if all
+            # of them had work for the whole interval
+            self.saturated &= bool(worker.measured)
+            self.tune_bytes += worker.measured
+            if not worker.measured:
+                continue
+            rate = worker.measured / elapsed
+            worker.rate = (rate if worker.rate is None
+                           else .8 * worker.rate + .2 * rate)
+            worker.measured = 0
+        for producer in self.active.values():
+            # A file's rate is measured from its first completed chunk
+            if producer.rate is None and not producer.measured:
+                continue
+            rate = producer.measured / elapsed
+            producer.rate = (rate if producer.rate is None
+                             else .8 * producer.rate + .2 * rate)
+            producer.measured = 0
+        self.mirrors.measure(elapsed, self.mirror_connections())
+        self.measure_start = time.time()
+        self.publish()
+        log.debug('Segment size: {} B'.format(self.segment_size()))
+        self.tune()
+
+    def mirror_connections(self):
+        """The number of connections downloading from each mirror.
+
+        """
+
+        connections = [0] * len(self.mirrors)
+        for claim in [c for w in self.workers for c in w.claims]:
+            if claim.remaining and claim.mirror < len(connections):
+                connections[claim.mirror] += 1
+        return connections
+
+    def publish(self):
+        if self.metrics:
+            self.metrics.publish(self.snapshot())
+
+    def snapshot(self):
+        """Describe the download as it is now: the throughput of each
+        worker, mirror and active file in bytes per second, the segments
+        being downloaded and waiting in the queue, retries, the chunks
+        each worker has received ahead of the disk and how long it
+        waited on it, how long state file checkpoints take, and the
+        connections and UDT statistics of any proxy running in this
+        process.
+
+        :returns: A JSON serializable dict
+
+        """
+
+        claims = [c for w in self.workers for c in w.claims]
+        in_flight = [c for c in claims if c.remaining]
+        workers = [dict(
+            name=w.process.name,
+            alive=w.process.is_alive(),
+            bytes=w.total,
+            bytes_per_second=w.rate or 0,
+            idle_seconds=time.time() - w.last_report,
+            segments_in_flight=len([c for c in w.claims if c.remaining]),
+            retries=sum(c.retries for c in w.claims),
+            write_queue=w.ring.queued,
+            write_stall_seconds=w.ring.stalled,
+        ) for w in self.workers]
+        files = {}
+        for slot, producer in self.active.items():
+            files[producer.download.ID] = dict(
+                size=producer.download.size,
+                completed=producer.completed.total,
+                bytes_per_second=producer.rate or 0,
+                segments_in_flight=len(
+                    [c for c in in_flight if c.slot == slot]),
+                retries=producer.retries,
+                checkpoints=producer.checkpoints,
+                last_checkpoint_seconds=producer.last_checkpoint,
+                mean_checkpoint_seconds=(
+                    producer.checkpoint_time / (producer.checkpoints or 1)),
+            )
+        return dict(
+            time=time.time(),
+            elapsed=time.time() - self.download_start,
+            engine=self.engine_name,
+            connections=len(self.workers) * self.engine.connections,
+            bytes_per_second=sum(w.rate or 0 for w in self.workers),
+            queue_depth=max(0, self.queue_depth),
+            segments_in_flight=len(in_flight),
+            retries=self.retries,
+            wasted_bytes=self.wasted,
+            write_stall_seconds=sum(w.ring.stalled for w in self.workers),
+            downloaded=len(self.downloaded),
+            errors=len(self.errors),
+            workers=workers,
+            files=files,
+            mirrors=self.mirrors.snapshot(self.mirror_connections()),
+            proxies=proxy_connections(),
+            udt=udt_stats(),
+        )
+
+    def tune(self):
+        """Let the tuner choose the number of workers every
+        ``TUNE_INTERVAL`` seconds.
+
+        """
+
+        elapsed = time.time() - self.tune_start
+        if not self.tuner or elapsed < TUNE_INTERVAL:
+            return
+        throughput = self.tune_bytes / elapsed
+        if self.saturated or self.tune_errors:
+            n_procs = self.tuner.update(throughput, self.tune_errors)
+            log.debug('Throughput with {} connections: {:.1f} MB/s'.format(
+                self.n_procs, throughput / const.MB))
+            if n_procs != self.n_procs:
+                log.info('Connections         : {} -> {} ({:.1f} MB/s)'.format(
+                    self.n_procs, n_procs, throughput / const.MB))
+                self.resize(n_procs)
+        self.tune_start = time.time()
+        self.tune_bytes = 0
+        self.tune_errors = 0
+        self.saturated = True
+
+    def poll(self):
+        """Handle everything the workers have reported since the last
+        poll.
+
+        :returns: True if anything was reported
+
+        """
+
+        reported = False
+        try:
+            while True:
+                slot, result = self.q_events.get_nowait()
+                reported = True
+                if slot is None:
+                    self.collect(result)
+                    continue
+                if isinstance(result, SegmentRetry):
+                    self.retry(slot, result)
+                    continue
+                if isinstance(result, ChecksumResult):
+                    self.verified(slot, result.error)
+                    continue
+                self.tune_errors += 1
+                if slot in self.active:
+                    self.fail(self.active[slot].download.ID, result)
+        except Empty:
+            pass
+        updated = self.read_rings()
+        updated |= self.reap()
+        for producer in updated:
+            reported = True
+            if producer.slot in self.active and producer.is_complete():
+                self.finish(producer)
+        self.measure()
+        return reported
+
+    def read_rings(self, workers=None):
+        """Add the chunks recorded in each worker's ring to their files'
+        producers.  Chunks of files that are no longer active are
+        discarded.
+
+        :param list workers: The workers to read, defaults to all
+        :returns: The set of producers that were updated
+
+        """
+
+        updated = set()
+        for worker in self.workers if workers is None else workers:
+            for slot, begin, end, digest, mirror in worker.ring.read():
+                worker.measured += end - begin
+                worker.total += end - begin
+                if mirror < len(self.mirrors):
+                    self.mirrors[mirror].measured += end - begin
+                    self.mirrors[mirror].total += end - begin
+                worker.last_report = time.time()
+                producer = self.active.get(slot)
+                if producer is None:
+                    continue
+                producer.measured += end - begin
+                if digest:
+                    digest = digest[:digest_size(
+                        producer.download.segment_digest)]
+                producer.add_completed(begin, end, digest)
+                updated.add(producer)
+        return updated
+
+    def finish(self, producer):
+        """Retire a complete file and verify it on its checksum thread,
+        which reports the result on ``q_events`` so that the pool keeps
+        serving the other files while the rest of it is hashed.
+
+        """
+
+        producer.finish_download()
+        slot = producer.slot
+        del self.active[slot]
+        self.verifying[slot] = producer
+        producer.verify_checksum(
+            lambda error: self.q_events.put((slot, ChecksumResult(error))))
+
+    def verified(self, slot, error):
+        producer = self.verifying.pop(slot, None)
+        if producer is None:
+            return
+        if error:
+            log.error('Download corrupt    : {}: {}'.format(
+                producer.download.ID, error))
+            self.errors[producer.download.ID] = error
+            return
+        self.downloaded.append(producer.download.ID)
+        log.info('Download complete   : {}'.format(producer.download.ID))
+
+    def retry(self, slot, retry):
+        """Count a worker's retry against the file's budget of
+        ``stream.retries``, shared by all of its segments, and give up
+        on the file once the budget is spent.  Retries are errors to
+        the tuner, so that connections are shed when segments fail.
+
+        """
+
+        self.retries += 1
+        self.tune_errors += 1
+        self.wasted += retry.wasted
+        if retry.mirror < len(self.mirrors):
+            self.mirrors.error(retry.mirror, retry.error)
+        producer = self.active.get(slot)
+        if producer is None:
+            return
+        producer.retries += 1
+        if producer.retries > producer.download.retries:
+            self.fail(producer.download.ID, 'Retry budget of {} exhausted: '
+                      '{}'.format(producer.download.retries, retry.error))
+
+    def fail(self, file_id, error):
+        log.error('Unable to download {}: {}'.format(file_id, str(error)))
+        producer = None
+        for slot in self.active.keys():
+            if self.active[slot].download.ID == file_id:
+                producer = self.active.pop(slot)
+                # Stop the workers still writing its segments
+                for claim in [c for w in self.workers for c in w.claims]:
+                    claim.cancel(slot)
+        if producer:
+            try:
+                # Keep what was written so the download can be resumed
+                producer.journal.close()
+                if producer.checksum:
+                    producer.checksum.abandon()
+            except Exception as e:
+                log.error('Unable to finish {}: {}'.format(file_id, str(e)))
+        self.errors[file_id] = str(error)
@@ -0,0 +1,181 @@
+from .log import get_logger
+from .portability import OS_LINUX
+
+import BaseHTTPServer
+import SocketServer
+import ctypes
+import ctypes.util
+import errno
+import os
+import socket
+import urllib
+
+# Logging
+log = get_logger('range_server')
+
+# Bytes sent per call when copying without sendfile
+COPY_SIZE = 1024 * 1024
+
+# Connections waiting to be accepted, enough for a client using many
+# connections at once
+BACKLOG = 128
+
+# Errors raised when the client hangs up mid response, as clients do
+# after reading the headers of a request for a file's information
+DISCONNECTED = (errno.EPIPE, errno.ECONNRESET)
+
+
+def _load_sendfile():
+    """Load ``sendfile(2)`` from libc, which copies from a file to a
+    socket inside the kernel.
+
+    """
+
+    if not OS_LINUX:
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendfile = getattr(libc, 'sendfile64', None) or libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+
+_sendfile = _load_sendfile()
+
+
+def copy_range(sock, f, begin, end):
+    """Send bytes ``[begin, end)`` of the open file ``f`` on ``sock``,
+    with ``sendfile(2)`` if it is available so that the data is never
+    copied into the process.
+
+    """
+
+    if _sendfile:
+        offset = ctypes.c_int64(begin)
+        while offset.value < end:
+            sent = _sendfile(sock.fileno(), f.fileno(), ctypes.byref(offset),
+                             min(end - offset.value, 1 << 30))
+            if sent < 0:
+                code = ctypes.get_errno()
+                if code == errno.EINTR:
+                    continue
+                raise socket.error(code, os.strerror(code))
+            if sent == 0:
+                raise IOError('Unexpected end of file at {}'.format(
+                    offset.value))
+        return
+
+    f.seek(begin)
+    while begin < end:
+        block = f.read(min(COPY_SIZE, end - begin))
+        if not block:
+            raise IOError('Unexpected end of file at {}'.format(begin))
+        sock.sendall(block)
+        begin += len(block)
+
+
+def parse_range(header, size):
+    """Parse a ``Range: bytes=begin-end`` header of a file of ``size``
+    bytes.  The end may be omitted.
+
+    :returns: The ``(begin, end)`` to send, ``end`` exclusive
+    :raises ValueError: If the range is malformed or not satisfiable
+
+    """
+
+    unit, _, spec = header.strip().partition('=')
+    if unit != 'bytes' or ',' in spec:
+        raise ValueError('Unsupported range: {}'.format(header))
+    first, _, last = spec.partition('-')
+    begin = long(first)
+    end = long(last) + 1 if last.strip() else size
+    end = min(end, size)
+    if begin >= end:
+        raise ValueError('Unsatisfiable range: {}'.format(header))
+    return begin, end
+
+
+class RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'parcel'
+
+    def do_GET(self):
+        self.send_file(body=True)
+
+    def do_HEAD(self):
+        self.send_file(body=False)
+
+    def send_file(self, body):
+        """Answer a request for ``/<file_id>`` like the data server does,
+        with the whole file or the requested range.
+
+        """
+
+        name = os.path.basename(urllib.unquote(self.path.split('?')[0]))
+        path = os.path.join(self.server.directory, name)
+        if not name or not os.path.isfile(path):
+            return self.send_error(404, 'No file {}'.format(name))
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            begin, end = 0, size
+            if self.headers.get('Range'):
+                try:
+                    begin, end = parse_range(self.headers['Range'], size)
+                except ValueError as e:
+                    return self.send_error(416, str(e))
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                    begin, end - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - begin))
+            self.send_header('Content-Disposition',
+                             'attachment; filename={}'.format(name))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            self.wfile.flush()
+            if not body:
+                return
+            try:
+                copy_range(self.connection, f, begin, end)
+            except socket.error as e:
+                if e.errno not in DISCONNECTED:
+                    raise
+                self.close_connection = 1
+
+    def log_message(self, format, *args):
+        log.debug('{}: {}'.format(self.client_address[0], format % args))
+
+
+class RangeServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = BACKLOG
+
+    def __init__(self, directory, host='localhost', port=0):
+        """An HTTP/1.1 server that streams the files in ``directory`` to
+        parcel clients with kept-alive connections, sending ranges with
+        ``sendfile(2)`` where available.  Unlike
+        :mod:`parcel.mock_server` files are never read into memory, so
+        it can serve files of any size at disk speed.
+
+        :param str directory: The directory of the files to serve
+        :param str host: The address to bind
+        :param int port: The port to bind, 0 for any free port
+
+        """
+
+        self.directory = directory
+        BaseHTTPServer.HTTPServer.__init__(
+            self, (host, port), RangeRequestHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
@@ -0,0 +1,105 @@
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+
+# A segment of a file to download
+Range = namedtuple('Range', ['begin', 'end'])
+
+
+class RangeSet(object):
+
+    def __init__(self, ranges=()):
+        """A set of byte ranges ``[begin, end)`` kept as two sorted arrays
+        of beginnings and ends.  Overlapping and adjacent ranges are
+        merged as they are added, so a file that is downloaded in order
+        is a single range no matter how many chunks it took, and the
+        total number of bytes in the set is kept as it changes.
+
+        Ranges are found by bisecting, in O(log n), but adding and
+        removing splice the arrays, which is O(n) in the number of
+        ranges.  That stays around the number of segments in flight.
+
+        :param ranges: An iterable of ``(begin, end)`` tuples to add
+
+        """
+
+        self.begins = []
+        self.ends = []
+        self.total = 0
+        for begin, end in ranges:
+            self.add(begin, end)
+
+    def __len__(self):
+        return len(self.begins)
+
+    def __iter__(self):
+        return iter(zip(self.begins, self.ends))
+
+    def __repr__(self):
+        return 'RangeSet({})'.format(list(self))
+
+    def add(self, begin, end):
+        """Add ``[begin, end)``, merging it with the ranges it overlaps or
+        touches.
+
+        """
+
+        if begin >= end:
+            return
+        # Ranges i to j-1 end at or after begin and start at or before
+        # end, so they merge with the new range
+        i = bisect_left(self.ends, begin)
+        j = bisect_right(self.begins, end)
+        if i < j:
+            begin = min(begin, self.begins[i])
+            end = max(end, self.ends[j-1])
+            self.total -= sum(self.ends[k] - self.begins[k]
+                              for k in xrange(i, j))
+        self.begins[i:j] = [begin]
+        self.ends[i:j] = [end]
+        self.total += end - begin
+
+    def remove(self, begin, end):
+        """Remove ``[begin, end)``, splitting a range that it falls
+        inside of.
+
+        """
+
+        if begin >= end:
+            return
+        # Ranges i to j-1 overlap the removed range
+        i = bisect_right(self.ends, begin)
+        j = bisect_left(self.begins, end)
+        if i >= j:
+            return
+        begins, ends = [], []
+        if self.begins[i] < begin:
+            begins.append(self.begins[i])
+            ends.append(begin)
+        if self.ends[j-1] > end:
+            begins.append(end)
+            ends.append(self.ends[j-1])
+        self.total -= sum(self.ends[k] - self.begins[k]
+                          for k in xrange(i, j))
+        self.total += sum(e - b for b, e in zip(begins, ends))
+        self.begins[i:j] = begins
+        self.ends[i:j] = ends
+
+    def first(self):
+        """:returns: The lowest ``(begin, end)`` range, or None if empty
+
+        """
+
+        if not self.begins:
+            return None
+        return self.begins[0], self.ends[0]
+
+    def next_gap(self, offset):
+        """Find the first byte at or after ``offset`` that is not in the
+        set.
+
+        """
+
+        i = bisect_right(self.begins, offset) - 1
+        if i >= 0 and self.ends[i] > offset:
+            return self.ends[i]
+        return offset
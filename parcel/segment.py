@@ -1,26 +1,15 @@
-from .portability import OS_WINDOWS
-from intervaltree import Interval, IntervalTree
 import os
-import pickle
-import random
-import string
-import tempfile
 import time
 
-if OS_WINDOWS:
-    WINDOWS = True
-    from Queue import Queue
-else:
-    # if we are running on a posix system, then we will be
-    # communicating across processes, and will need
-    # multiprocessing manager
-    from multiprocessing import Manager
-    WINDOWS = False
-
+from checksum import PrefixChecksum
+from digests import DIGESTS
+from journal import StateJournal
 from log import get_logger
-from utils import get_pbar, md5sum, mmap_open, STRIP
+import tracing
+from ranges import Range, RangeSet
+from utils import get_pbar, STRIP
 from const import SAVE_INTERVAL
-from progressbar import ProgressBar, Percentage, Bar, ETA
+from validate import find_corrupt_segments
 
 log = get_logger('segment')
 
@@ -29,78 +18,155 @@ class SegmentProducer(object):
 
     save_interval = SAVE_INTERVAL
 
-    def __init__(self, download, n_procs):
+    def __init__(self, download, n_procs, slot=0):
 
         assert download.size is not None,\
             'Segment producer passed uninitizalied Download!'
 
         self.download = download
         self.n_procs = n_procs
+        self.slot = slot
+        self.since_save = 0
+        # Bytes completed since the pool last measured the file's
+        # throughput, and its moving average
+        self.measured = 0
+        self.rate = None
+        # Segment retries counted against the file's budget
+        self.retries = 0
+        # State file flushes and the seconds they took
+        self.checkpoints = 0
+        self.checkpoint_time = 0.
+        self.last_checkpoint = 0.
 
         # Initialize producer
         self.load_state()
+        self._setup_checksum()
         self._setup_pbar()
-        self._setup_queues()
         self._setup_work()
-        self.schedule()
 
     def _setup_pbar(self):
         self.pbar = None
         self.pbar = get_pbar(self.download.ID, self.download.size)
 
+    def _setup_checksum(self):
+        """Start hashing the file as it is written if there is an expected
+        md5sum to verify it against.
+
+        """
+
+        self.checksum = None
+        self.prefix = 0
+        if not self.download.md5sum:
+            return
+        if not self.download.is_regular_file:
+            log.warn('File is not a regular file, refusing to checksum.')
+            return
+        self.checksum = PrefixChecksum(self.download.path)
+        self._advance_prefix()
+
+    def _advance_prefix(self):
+        """Extend the contiguous prefix of completed bytes as far as it
+        goes and pass it on to be hashed.
+
+        """
+
+        self.prefix = self.completed.next_gap(self.prefix)
+        self.checksum.update(self.prefix)
+
+    def verify_checksum(self, report):
+        """Compare the md5sum of the completed file to the expected one
+        once the rest of it has been hashed, without waiting for it.
+
+        :param report:
+            Called, from the checksum thread, with a description of the
+            mismatch, or None if it matched
+
+        """
+
+        if not self.checksum:
+            return report(None)
+
+        def verify(md5sum, error):
+            if error:
+                return report('Unable to verify md5sum: {}'.format(
+                    str(error)))
+            if md5sum != self.download.md5sum:
+                return report('md5sum mismatch: expected {}, got {}'.format(
+                    self.download.md5sum, md5sum))
+            log.info('Verified md5sum of {}: {}'.format(
+                self.download.ID, md5sum))
+            report(None)
+
+        self.checksum.verify(verify)
+
     def _setup_work(self):
         if self.is_complete():
             log.info('File already complete.')
             return
 
-        work_size = self.integrate(self.work_pool)
-        self.block_size = work_size / self.n_procs
+        self.block_size = self.work_pool.total / self.n_procs
 
-    def _setup_queues(self):
-        if WINDOWS:
-            self.q_work = Queue()
-            self.q_complete = Queue()
-        else:
-            manager = Manager()
-            self.q_work = manager.Queue()
-            self.q_complete = manager.Queue()
+    @property
+    def size_complete(self):
+        return self.completed.total
+
+    def validate_segment_md5sums(self, records):
+        """Check the digest of every completed segment, in parallel.
+
+        :param list records: ``(begin, end, digest)`` tuples
+        :returns: The records of the segments that are not corrupt
 
-    def integrate(self, itree):
-        return sum([i.end-i.begin for i in itree.items()])
+        """
 
-    def validate_segment_md5sums(self):
         if not self.download.check_segment_md5sums:
-            return True
-        corrupt_segments = 0
-        intervals = sorted(self.completed.items())
-        pbar = ProgressBar(widgets=[
-            'Checksumming {}: '.format(self.download.ID), Percentage(), ' ',
-            Bar(marker='#', left='[', right=']'), ' ', ETA()])
-        with mmap_open(self.download.path) as data:
-            for interval in pbar(intervals):
-                log.debug('Checking segment md5: {}'.format(interval))
-                if not interval.data or 'md5sum' not in interval.data:
-                    log.error(STRIP(
-                        """User opted to check segment md5sums on restart.
-                        Previous download did not record segment
-                        md5sums (--no-segment-md5sums)."""))
-                    return
-                chunk = data[interval.begin:interval.end]
-                checksum = md5sum(chunk)
-                if checksum != interval.data.get('md5sum'):
-                    log.debug('Redownloading corrupt segment {}, {}.'.format(
-                        interval, checksum))
-                    corrupt_segments += 1
-                    self.completed.remove(interval)
+            return records
+        name = self.download.segment_digest
+        segments = sorted(r for r in records if r[2])
+        if len(segments) < len(records):
+            log.error(STRIP(
+                """User opted to check segment {} digests on restart.
+                Previous download did not record them for {} segments
+                (--no-segment-md5sums).""".format(
+                    name, len(records) - len(segments))))
+        if not segments:
+            return records
+
+        corrupt_segments = set(find_corrupt_segments(
+            self.download.path, name, segments, self.download.ID))
+        for segment in corrupt_segments:
+            log.debug('Redownloading corrupt segment {}.'.format(segment))
         if corrupt_segments:
             log.warn('Redownloading {} currupt segments.'.format(
-                corrupt_segments))
+                len(corrupt_segments)))
+        return [r for r in records if r[:2] not in corrupt_segments]
 
     def load_state(self):
-        # Establish default intervals
-        self.work_pool = IntervalTree([Interval(0, self.download.size)])
-        self.completed = IntervalTree()
-        self.size_complete = 0
+        # Establish default ranges
+        self.work_pool = RangeSet([(0, self.download.size)])
+        self.completed = RangeSet()
+        self.journal = StateJournal(
+            self.download.state_path,
+            digest=(self.download.segment_digest
+                    if self.download.check_segment_md5sums else ''))
+        records = self._load_state() or []
+        for begin, end, digest in records:
+            self.completed.add(begin, end)
+        for begin, end in self.completed:
+            self.work_pool.remove(begin, end)
+
+        # Start a compact journal of whatever was resumed, this also
+        # migrates state files written by older versions
+        self.download.setup_directories()
+        self.journal.rewrite(records)
+
+    def _load_state(self):
+        """Read the records of a download that is being resumed.
+
+        :returns: ``(begin, end, digest)`` tuples of the completed
+            segments that are not corrupt
+
+        """
+
         if not os.path.isfile(self.download.state_path)\
            and os.path.isfile(self.download.path):
             log.warn(STRIP(
@@ -127,90 +193,73 @@ class SegmentProducer(object):
                 """State file found at '{}' but no file for {}.
                 Restarting entire download.""".format(
                     self.download.state_path, self.download.ID)))
+            self.download.setup_file()
             return
         try:
-            with open(self.download.state_path, "rb") as f:
-                self.completed = pickle.load(f)
-            assert isinstance(self.completed, IntervalTree), \
-                "Bad save state: {}".format(self.download.state_path)
+            records = self.journal.load()
         except Exception as e:
-            self.completed = IntervalTree()
             log.error('Unable to resume file state: {}'.format(str(e)))
-        else:
-            self.validate_segment_md5sums()
-            self.size_complete = self.integrate(self.completed)
-            for interval in self.completed:
-                self.work_pool.chop(interval.begin, interval.end)
+            return
+        if not self._resume_digest(self.journal.recorded_digest):
+            records = [(begin, end, None) for begin, end, _ in records]
+        return self.validate_segment_md5sums(records)
+
+    def _resume_digest(self, recorded):
+        """Keep using the digest a resumed download was started with, so
+        that every segment in the state file can be checked.
 
-    def save_state(self):
+        :returns: True if the recorded digests can be used
+
+        """
+
+        current = self.journal.digest
+        if not current or not recorded or recorded == current:
+            return recorded == current
+        if recorded not in DIGESTS:
+            log.warn(STRIP(
+                """State file has {} segment digests, which are not
+                supported by this installation.  Continuing with
+                {}.""".format(recorded, current)))
+            return False
+        log.info('Resuming with {} segment digests from state file'.format(
+            recorded))
+        self.download.segment_digest = recorded
+        self.journal.set_digest(recorded)
+        return True
+
+    def save_state(self, sync=False):
+        start = time.time()
         try:
-            # Grab a temp file in the same directory (hopefully avoud
-            # cross device links) in order to atomically write our save file
-            temp = tempfile.NamedTemporaryFile(
-                prefix='.parcel_',
-                dir=os.path.abspath(self.download.state_directory),
-                delete=False)
-            # Write completed state
-            pickle.dump(self.completed, temp)
-            # Make sure all data is written to disk
-            temp.flush()
-            os.fsync(temp.fileno())
-            temp.close()
-
-            # Rename temp file as our save file, this could fail if
-            # the state file and the temp directory are on different devices
-            if OS_WINDOWS and os.path.exists(self.download.state_path):
-                # If we're on windows, there's not much we can do here
-                # except stash the old state file, rename the new one,
-                # and back up if there is a problem.
-                old_path = os.path.join(tempfile.gettempdir(), ''.join(
-                    random.choice(string.ascii_lowercase + string.digits)
-                    for _ in range(10)))
-                try:
-                    # stash the old state file
-                    os.rename(self.download.state_path, old_path)
-                    # move the new state file into place
-                    os.rename(temp.name, self.download.state_path)
-                    # if no exception, then delete the old stash
-                    os.remove(old_path)
-                except Exception as msg:
-                    log.error('Unable to write state file: {}'.format(msg))
-                    try:
-                        os.rename(old_path, self.download.state_path)
-                    except:
-                        pass
-                    raise
-            else:
-                # If we're not on windows, then we'll just try to
-                # atomically rename the file
-                os.rename(temp.name, self.download.state_path)
-
-        except KeyboardInterrupt:
-            log.warn('Keyboard interrupt. removing temp save file'.format(
-                temp.name))
-            temp.close()
-            os.remove(temp.name)
+            self.journal.flush(sync)
         except Exception as e:
             log.error('Unable to save state: {}'.format(str(e)))
             raise
+        tracing.record('checkpoint', start, time.time(),
+                       file=self.download.ID, sync=sync)
+        self.last_checkpoint = time.time() - start
+        self.checkpoint_time += self.last_checkpoint
+        self.checkpoints += 1
+
+    def next_segment(self, size):
+        """Take the next segment of at most ``size`` bytes, and never more
+        than an even share of the file per process, off the work pool.
 
-    def schedule(self):
-        while True:
-            interval = self._get_next_interval()
-            log.debug('Returning interval: {}'.format(interval))
-            if not interval:
-                return
-            self.q_work.put(interval)
-
-    def _get_next_interval(self):
-        intervals = sorted(self.work_pool.items())
-        if not intervals:
+        :returns: A :class:`Range` or None if there is no more work
+
+        """
+
+        interval = self._get_next_interval(size)
+        log.debug('Returning interval: {}'.format(interval))
+        return interval
+
+    def _get_next_interval(self, size):
+        first = self.work_pool.first()
+        if not first:
             return None
-        interval = intervals[0]
-        start = interval.begin
-        end = min(interval.end, start + self.block_size)
-        self.work_pool.chop(start, end)
-        return Interval(start, end)
+        start, end = first
+        end = min(end, start + min(size, self.block_size))
+        self.work_pool.remove(start, end)
+        return Range(start, end)
 
     def print_progress(self):
         if not self.pbar:
@@ -230,41 +279,30 @@ class SegmentProducer(object):
             return (os.path.exists(self.download.path))
 
     def is_complete(self):
-        return (self.integrate(self.completed) == self.download.size and
+        return (self.completed.total == self.download.size and
                 self.check_file_exists_and_size())
 
+    def add_completed(self, begin, end, digest=None):
+        """Record a range that a worker reported as written to disk,
+        flushing the state file every ``save_interval`` bytes.
+
+        """
+
+        self.completed.add(begin, end)
+        self.journal.append(begin, end, digest)
+        self.since_save += end - begin
+        self.print_progress()
+        if self.checksum and begin <= self.prefix:
+            self._advance_prefix()
+        if self.since_save >= self.save_interval:
+            self.since_save = 0
+            self.save_state()
+
     def finish_download(self):
-        # Tell the children there is no more work, each child should
-        # pull one NoneType from the queue and exit
-        for i in range(self.n_procs):
-            self.q_work.put(None)
-
-        # Wait for all the children to exit by checking to make sure
-        # that everyone has taken their NoneType from the queue.
-        # Otherwise, the segment producer will exit before the
-        # children return, causing them to read from a closed queue
-        log.debug('Waiting for children to report')
-        while not self.q_work.empty():
-            time.sleep(0.1)
+        # Flush the final state so that the download can be resumed or
+        # verified later
+        self.journal.close()
 
         # Finish the progressbar
         if self.pbar:
             self.pbar.finish()
-
-    def wait_for_completion(self):
-        try:
-            since_save = 0
-            while not self.is_complete():
-                while since_save < self.save_interval:
-                    interval = self.q_complete.get()
-                    self.completed.add(interval)
-                    if self.is_complete():
-                        break
-                    this_size = interval.end - interval.begin
-                    self.size_complete += this_size
-                    since_save += this_size
-                    self.print_progress()
-                since_save = 0
-                self.save_state()
-        finally:
-            self.finish_download()
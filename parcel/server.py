@@ -1,9 +1,12 @@
 # import signal
 import urlparse
-from cparcel import lib
+from cparcel import (lib, proxy_connections, udt_stats, log_udt_stats_every,
+                     BUFFER_SIZE, MSS)
+import os
 import time
 
 from log import get_logger
+from metrics import PUBLISH_INTERVAL
 
 # Logging
 log = get_logger('server')
@@ -11,9 +14,49 @@ log = get_logger('server')
 
 class Server(object):
 
-    def start(self, proxy_host, proxy_port, remote_uri):
+    def __init__(self, metrics=None, udt_stats_interval=None):
+        """:param metrics:
+            A :class:`parcel.metrics.Metrics` that the connection counts
+            and UDT statistics of the proxy are published to while it
+            runs
+        :param udt_stats_interval:
+            Log the UDT statistics of the proxy every this many seconds
+
+        """
+
+        self.metrics = metrics
+        self.udt_stats_interval = udt_stats_interval
+
+    def wait(self):
+        """Block while the non-blocking proxy runs, publishing its
+        metrics.
+
         """
 
+        if self.udt_stats_interval:
+            log_udt_stats_every(self.udt_stats_interval)
+        start = time.time()
+        while True:
+            if self.metrics:
+                self.metrics.publish(dict(
+                    time=time.time(),
+                    elapsed=time.time() - start,
+                    proxies=proxy_connections(),
+                    udt=udt_stats(),
+                ))
+            time.sleep(PUBLISH_INTERVAL if self.metrics else 99999999)
+
+    def start(self, proxy_host, proxy_port, remote_uri, stripes=1,
+              congestion_control=None):
+        """Proxy UDT clients to the data server at ``remote_uri``.
+
+        :param int stripes:
+            More than 1 if the clients stripe each of their connections
+            over several UDT connections
+        :param str congestion_control:
+            The UDT congestion control algorithm to send with, ``udt``,
+            ``tcp`` or ``blast:MBPS``, by default ``udt``
+
         """
         # Signal handling for external calls
         # signal.signal(signal.SIGINT, signal.SIG_DFL)
@@ -23,9 +66,30 @@ class Server(object):
         port = p.port or {'https': '443', 'http': '80'}[p.scheme]
         log.info('Binding proxy server {}:{} -> {}:{}'.format(
             proxy_host, proxy_port, p.hostname, port))
-        proxy = lib.udt2tcp_start(
-            str(proxy_host), str(proxy_port), str(p.hostname), str(port))
+        proxy = lib.udt2tcp_start_configurable(
+            str(proxy_host), str(proxy_port), str(p.hostname), str(port),
+            MSS, BUFFER_SIZE*2, BUFFER_SIZE, stripes, congestion_control)
         assert proxy == 0, 'Proxy failed to start'
 
-        while True:
-            time.sleep(99999999)  # Block because udt2tcp_start is non-blocking
+        self.wait()  # Block because udt2tcp_start is non-blocking
+
+    def serve(self, host, port, directory, congestion_control=None):
+        """Serve the files in ``directory`` over UDT without an upstream
+        HTTP server.  Clients send the same range requests they would
+        send to the data server, and the file ids in their urls are the
+        names of files in ``directory``.
+
+        :param str congestion_control:
+            The UDT congestion control algorithm to send with, as for
+            :meth:`start`
+
+        """
+
+        directory = os.path.abspath(os.path.expanduser(directory))
+        log.info('Serving {} on UDT {}:{}'.format(directory, host, port))
+        server = lib.udt2file_start_configurable(
+            str(host), str(port), str(directory),
+            MSS, BUFFER_SIZE*2, BUFFER_SIZE, congestion_control)
+        assert server == 0, 'File server failed to start'
+
+        self.wait()  # Block because udt2file_start is non-blocking
@@ -0,0 +1,151 @@
+/******************************************************************************
+ *
+ * FILE    : bench_cbuffer.cpp
+ * PROJECT : parcel
+ *
+ * DESCRIPTION : A micro-benchmark of the data path of the proxy
+ *               transcribers.  A producer thread moves bytes into a
+ *               CircularBuffer and a consumer thread moves them out,
+ *               with one memcpy standing in for each socket receive
+ *               and send, and reports the throughput and the bytes
+ *               moved per second of CPU time.
+ *
+ *               copy    : through private buffers with write() and
+ *                         read(), as the transcribers used to
+ *               inplace : straight into and out of the buffer with
+ *                         write_region() and read_region()
+ *
+ *               Build with `make bench` and run
+ *               `./bench_cbuffer [copy|inplace] [GiB] [MiB buffer]`
+ *
+ * LICENSE : Licensed under the Apache License, Version 2.0 (the
+ *           "License"); you may not use this file except in
+ *           compliance with the License.  You may obtain a copy of
+ *           the License at
+ *
+ *               http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *           Unless required by applicable law or agreed to in
+ *           writing, software distributed under the License is
+ *           distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+ *           CONDITIONS OF ANY KIND, either express or implied.  See
+ *           the License for the specific language governing
+ *           permissions and limitations under the License.)
+ *
+ ******************************************************************************/
+
+#include "cbuffer.h"
+#include <stdint.h>
+#include <sys/resource.h>
+#include <sys/time.h>
+
+using namespace std;
+
+/* The most a socket call moves at once, as in the transcribers */
+#define CHUNK_SIZE 1048576
+
+typedef struct bench_args_t {
+    CircularBuffer *pipe;
+    uint64_t total;
+    bool inplace;
+} bench_args_t;
+
+static char source[CHUNK_SIZE];
+static char sink[CHUNK_SIZE];
+
+static double now()
+{
+    struct timeval tv;
+    gettimeofday(&tv, NULL);
+    return tv.tv_sec + tv.tv_usec / 1e6;
+}
+
+static double cpu_time()
+{
+    struct rusage usage;
+    getrusage(RUSAGE_SELF, &usage);
+    return usage.ru_utime.tv_sec + usage.ru_utime.tv_usec / 1e6
+        + usage.ru_stime.tv_sec + usage.ru_stime.tv_usec / 1e6;
+}
+
+void *produce(void *_args_)
+{
+    bench_args_t *args = (bench_args_t*) _args_;
+    char *buffer = (char*) malloc(CHUNK_SIZE);
+    uint64_t produced = 0;
+
+    while (produced < args->total){
+        size_t size = min((uint64_t) CHUNK_SIZE, args->total - produced);
+        if (args->inplace){
+            /* Receive straight into the buffer */
+            char *region = args->pipe->write_region(&size);
+            memcpy(region, source, size);
+            args->pipe->commit_write(size);
+        } else {
+            /* Receive into a private buffer, then copy it in */
+            memcpy(buffer, source, size);
+            args->pipe->write(buffer, size);
+        }
+        produced += size;
+    }
+    args->pipe->close();
+    free(buffer);
+    return NULL;
+}
+
+void *consume(void *_args_)
+{
+    bench_args_t *args = (bench_args_t*) _args_;
+    char *buffer = (char*) malloc(CHUNK_SIZE);
+    uint64_t consumed = 0;
+
+    while (1){
+        size_t size = CHUNK_SIZE;
+        if (args->inplace){
+            /* Send straight from the buffer */
+            char *region = args->pipe->read_region(&size);
+            if (!region){
+                break;
+            }
+            memcpy(sink, region, size);
+            args->pipe->commit_read(size);
+        } else {
+            /* Copy out into a private buffer, then send it */
+            if ((size = args->pipe->read(buffer, CHUNK_SIZE)) == (size_t) -1){
+                break;
+            }
+            memcpy(sink, buffer, size);
+        }
+        consumed += size;
+    }
+    if (consumed != args->total){
+        fprintf(stderr, "consumed %llu of %llu bytes\n",
+                (unsigned long long) consumed, (unsigned long long) args->total);
+    }
+    free(buffer);
+    return NULL;
+}
+
+int main(int argc, char *argv[])
+{
+    bench_args_t args;
+    args.inplace = argc < 2 || strcmp(argv[1], "copy") != 0;
+    args.total = (uint64_t) ((argc > 2 ? atof(argv[2]) : 8) * (1 << 30));
+    size_t capacity = (size_t) ((argc > 3 ? atof(argv[3]) : 64) * (1 << 20));
+    args.pipe = new CircularBuffer(capacity);
+    memset(source, 'x', sizeof(source));
+
+    double start = now(), start_cpu = cpu_time();
+    pthread_t producer, consumer;
+    pthread_create(&producer, NULL, produce, &args);
+    pthread_create(&consumer, NULL, consume, &args);
+    pthread_join(producer, NULL);
+    pthread_join(consumer, NULL);
+    double elapsed = now() - start, cpu = cpu_time() - start_cpu;
+
+    double gb = args.total / 1e9;
+    printf("%-8s %6.2f GB in %6.2f s: %6.2f GB/s, %6.2f GB/s per core\n",
+           args.inplace ? "inplace" : "copy", gb, elapsed, gb / elapsed, gb / cpu);
+    delete args.pipe;
+    return 0;
+}
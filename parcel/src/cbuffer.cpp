@@ -13,10 +13,11 @@
 using namespace std;
 
 CircularBuffer::CircularBuffer(size_t capacity)
-    : beg_index_(0)
-    , end_index_(0)
-    , size_(0)
+    : write_pos_(0)
+    , read_pos_(0)
     , capacity_(capacity)
+    , writer_waiting_(0)
+    , reader_waiting_(0)
     , closed_(false)
 {
     data_ = new char[capacity];
@@ -29,24 +30,72 @@ CircularBuffer::CircularBuffer(size_t capacity)
     if (pthread_mutex_init(&cond_mutex_, NULL)){
         perror("error initializing pthread_mutex");
     }
-    if (pthread_mutex_init(&pointer_mutex_, NULL)){
-        perror("error initializing pthread_mutex");
-    }
 }
 
 CircularBuffer::~CircularBuffer()
 {
-    pthread_mutex_destroy(&pointer_mutex_);
     pthread_mutex_destroy(&cond_mutex_);
     pthread_cond_destroy(&space_cond_);
     pthread_cond_destroy(&data_cond_);
     delete [] data_;
 }
 
+void CircularBuffer::close()
+{
+    /*
+     *  close() - Close the buffer
+     *
+     *  Writes fail once the buffer is closed, and reads fail once
+     *  what was written before it was closed has been read.  Threads
+     *  blocked on the buffer are woken so that they can exit.
+     */
+    pthread_mutex_lock(&cond_mutex_);
+    __atomic_store_n(&closed_, true, __ATOMIC_SEQ_CST);
+    pthread_cond_broadcast(&space_cond_);
+    pthread_cond_broadcast(&data_cond_);
+    pthread_mutex_unlock(&cond_mutex_);
+}
+
 /******************************************************************************
  * Writing data
  ******************************************************************************/
 
+char *CircularBuffer::write_region(size_t *bytes)
+{
+    /*
+     *  write_region() - Where to write next, in place
+     *
+     *  Block until there is space, then return the contiguous free
+     *  space after the last byte written and lower *bytes to its
+     *  size.  Only the producer may call this.
+     *
+     *  returns: The start of the region, NULL if the buffer is
+     *  closed.
+     */
+    while (!has_space() && !closed()){
+        wait_for_space();
+    }
+    if (closed()){ return NULL; }
+
+    /* Only the producer moves write_pos_ */
+    uint64_t write_pos = write_pos_;
+    size_t index = write_pos % capacity_;
+    *bytes = min(*bytes, min(capacity_ - size(), capacity_ - index));
+    return data_ + index;
+}
+
+void CircularBuffer::commit_write(size_t bytes)
+{
+    /*
+     *  commit_write() - Publish bytes written to the write region
+     *
+     */
+    __atomic_store_n(&write_pos_, write_pos_ + bytes, __ATOMIC_SEQ_CST);
+    if (__atomic_load_n(&reader_waiting_, __ATOMIC_SEQ_CST)){
+        signal_data();
+    }
+}
+
 size_t CircularBuffer::write_nonblocking(const char *data, size_t bytes)
 {
     /*
@@ -58,50 +107,27 @@ size_t CircularBuffer::write_nonblocking(const char *data, size_t bytes)
      *  returns: The number of bytes written to buffer on success, -1
      *  on failure.
      */
-    if (closed_)   { return -1; }
-    if (bytes == 0){ return  0; }
-
-    /* Lock and calculate sizes */
-    pthread_mutex_lock(&pointer_mutex_);
-    size_t capacity        = capacity_;
-    size_t bytes_to_write  = min(bytes, capacity - size_);
-    size_t size_1          = capacity - end_index_;
-    size_t size_2          = bytes_to_write - size_1;
-    bool   single_step     = (bytes_to_write <= capacity - end_index_);
-    pthread_mutex_unlock(&pointer_mutex_);
+    if (closed())  { return -1; }
+    if (bytes == 0 || !has_space()){ return 0; }
 
-    /* Short circuit, there's no more space */
-    if (bytes_to_write == 0){ return  0; }
-
-    /* Write data */
-    if (single_step){
-        memcpy(data_ + end_index_, data, bytes_to_write);
-    } else {
-        memcpy(data_ + end_index_, data, size_1);
-        memcpy(data_, data + size_1, size_2);
-    }
-
-    /* Update pointers */
-    pthread_mutex_lock(&pointer_mutex_);
-    if (single_step){
-        end_index_ += bytes_to_write;
-        if (end_index_ == capacity){
-            /* Loop back */
-            end_index_ = 0;
+    size_t written = 0;
+    while (written < bytes && has_space()){
+        size_t size = bytes - written;
+        char *region = write_region(&size);
+        if (!region){
+            break;
         }
-    } else {
-        end_index_ = size_2;
+        memcpy(region, data + written, size);
+        commit_write(size);
+        written += size;
     }
-    size_ += bytes_to_write;
-    pthread_mutex_unlock(&pointer_mutex_);
-
-    return bytes_to_write;
+    return written;
 }
 
 size_t CircularBuffer::write(const char *data, size_t bytes)
 {
     /*
-     *  write_nonblocking() - Blocking write to buffer
+     *  write() - Blocking write to buffer
      *
      *  Write to the circular buffer, if there is not enough space
      *  write what we can and block until someone else has read from
@@ -110,32 +136,64 @@ size_t CircularBuffer::write(const char *data, size_t bytes)
      *  returns: The number of bytes written to buffer on success, -1
      *  on failure.
      */
-    if (closed_)   { return -1; }
+    if (closed())  { return -1; }
     if (bytes == 0){ return  0; }
 
-    size_t bytes_written = 0;
-    if (!has_space()){
-        wait_for_space();
-    }
-
-    while (bytes_written < bytes){
-        if (!has_space()){
-            wait_for_space();
+    size_t written = 0;
+    while (written < bytes){
+        size_t size = bytes - written;
+        char *region = write_region(&size);
+        if (!region){
+            return -1;
         }
-        size_t written_this_time = write_nonblocking(data  + bytes_written,
-                                                     bytes - bytes_written);
-        bytes_written += written_this_time;
-    }
-    if (bytes_written > 0) {
-        signal_data();
+        memcpy(region, data + written, size);
+        commit_write(size);
+        written += size;
     }
-    return bytes_written;
+    return written;
 }
 
 /******************************************************************************
  * Reading data
  ******************************************************************************/
 
+char *CircularBuffer::read_region(size_t *bytes)
+{
+    /*
+     *  read_region() - Where to read next, in place
+     *
+     *  Block until there is data, then return the contiguous data
+     *  after the last byte read and lower *bytes to its size.  Only
+     *  the consumer may call this.
+     *
+     *  returns: The start of the region, NULL if the buffer is
+     *  closed and empty.
+     */
+    while (!size() && !closed()){
+        wait_for_data();
+    }
+    size_t available = size();
+    if (!available){ return NULL; }
+
+    /* Only the consumer moves read_pos_ */
+    uint64_t read_pos = read_pos_;
+    size_t index = read_pos % capacity_;
+    *bytes = min(*bytes, min(available, capacity_ - index));
+    return data_ + index;
+}
+
+void CircularBuffer::commit_read(size_t bytes)
+{
+    /*
+     *  commit_read() - Release bytes read from the read region
+     *
+     */
+    __atomic_store_n(&read_pos_, read_pos_ + bytes, __ATOMIC_SEQ_CST);
+    if (__atomic_load_n(&writer_waiting_, __ATOMIC_SEQ_CST)){
+        signal_space();
+    }
+}
+
 size_t CircularBuffer::read_nonblocking(char *data, size_t bytes)
 {
     /*
@@ -145,48 +203,26 @@ size_t CircularBuffer::read_nonblocking(char *data, size_t bytes)
      *  read 0 bytes and immediately return 0;
      *
      *  returns: The number of bytes read from buffer on success, -1
-     *  on failure.
+     *  on failure or if the buffer is closed and empty.
      */
-    if (closed_)   { return -1; }
+    if (closed() && !size()){ return -1; }
     if (bytes == 0){ return  0; }
 
-    pthread_mutex_lock(&pointer_mutex_);
-    size_t capacity       = capacity_;
-    size_t bytes_to_read  = min(bytes, size_);
-    size_t size_1         = capacity - beg_index_;
-    size_t size_2         = bytes_to_read - size_1;
-    bool   single_step    = (bytes_to_read <= capacity - beg_index_);
-    pthread_mutex_unlock(&pointer_mutex_);
-
-    /* Read data */
-    if (single_step){
-        memcpy(data, data_ + beg_index_, bytes_to_read);
-    } else {
-        memcpy(data, data_ + beg_index_, size_1);
-        memcpy(data + size_1, data_, size_2);
+    size_t bytes_read = 0;
+    while (bytes_read < bytes && size()){
+        size_t size = bytes - bytes_read;
+        char *region = read_region(&size);
+        memcpy(data + bytes_read, region, size);
+        commit_read(size);
+        bytes_read += size;
     }
-
-    /* Update pointers */
-    pthread_mutex_lock(&pointer_mutex_);
-    if (single_step){
-        beg_index_ += bytes_to_read;
-        if (beg_index_ == capacity){
-            /* Loop back */
-            beg_index_ = 0;
-        }
-    } else {
-        beg_index_ = size_2;
-    }
-    size_ -= bytes_to_read;
-    pthread_mutex_unlock(&pointer_mutex_);
-
-    return bytes_to_read;
+    return bytes_read;
 }
 
 size_t CircularBuffer::read(char *data, size_t bytes)
 {
     /*
-     *  read_nonblocking() - Blocking read from buffer
+     *  read() - Blocking read from buffer
      *
      *  Read from the pipe at most size_t bytes.  If there is no data,
      *  wait for a signal saying somebody wrote to the pipe.
@@ -194,14 +230,10 @@ size_t CircularBuffer::read(char *data, size_t bytes)
      *  returns: The number of bytes read from buffer on success, -1
      *  on failure.
      */
-    if (!size()){
+    while (!size() && !closed()){
         wait_for_data();
     }
-    size_t bytes_read = read_nonblocking(data, bytes);
-    if (bytes_read > 0) {
-        signal_space();
-    }
-    return bytes_read;
+    return read_nonblocking(data, bytes);
 }
 
 /******************************************************************************
@@ -214,12 +246,16 @@ void CircularBuffer::wait_for_space()
      *  wait_for_space() - Block until there is space to write to
      *
      *  If there is no space in the buffer, wait for a signal saying
-     *  that someone read from the buffer.
+     *  that someone read from the buffer.  The reader only signals
+     *  when it sees writer_waiting_, which is set before checking for
+     *  space one last time.
      */
     pthread_mutex_lock(&cond_mutex_);
-    while (!has_space()){
+    __atomic_store_n(&writer_waiting_, 1, __ATOMIC_SEQ_CST);
+    while (!has_space() && !closed()){
         pthread_cond_wait(&space_cond_, &cond_mutex_);
     }
+    __atomic_store_n(&writer_waiting_, 0, __ATOMIC_SEQ_CST);
     pthread_mutex_unlock(&cond_mutex_);
 }
 
@@ -229,12 +265,16 @@ void CircularBuffer::wait_for_data()
      *  wait_for_data() - Block until there is data to read
      *
      *  If there is no data in the buffer, wait for a signal saying
-     *  that someone write to the buffer.
+     *  that someone write to the buffer.  The writer only signals
+     *  when it sees reader_waiting_, which is set before checking for
+     *  data one last time.
      */
     pthread_mutex_lock(&cond_mutex_);
-    while (!size()){
+    __atomic_store_n(&reader_waiting_, 1, __ATOMIC_SEQ_CST);
+    while (!size() && !closed()){
         pthread_cond_wait(&data_cond_, &cond_mutex_);
     }
+    __atomic_store_n(&reader_waiting_, 0, __ATOMIC_SEQ_CST);
     pthread_mutex_unlock(&cond_mutex_);
 }
 
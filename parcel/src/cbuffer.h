@@ -13,7 +13,14 @@
 #include <cstring>
 #include <cstdio>
 #include <algorithm>
+#include <stdint.h>
 
+/*
+ * A single producer, single consumer ring.  The producer and the
+ * consumer each own one position and only read the other's, so
+ * neither takes a lock unless the ring is full or empty and it has to
+ * sleep until the other side catches up.
+ */
 class CircularBuffer
 {
 public:
@@ -21,13 +28,26 @@ public:
     ~CircularBuffer();
 
     /* True if there is space is available to write to */
-    bool has_space () const { return (capacity_ - size_ > 1); }
+    bool has_space () const { return size() < capacity_; }
     /* How many bytes are currently in the buffer */
-    size_t size () const { return size_;     }
+    size_t size () const {
+        return __atomic_load_n(&write_pos_, __ATOMIC_SEQ_CST)
+            - __atomic_load_n(&read_pos_, __ATOMIC_SEQ_CST);
+    }
     /* Total capacity */
     size_t capacity () const { return capacity_; }
-    /* Close the buffer */
-    void close () { closed_ = true;   }
+    /* True once the buffer is closed */
+    bool closed () const { return __atomic_load_n(&closed_, __ATOMIC_ACQUIRE); }
+    /* Close the buffer, waking anyone waiting on it */
+    void close ();
+    /* Return where to write up to *bytes bytes in place, NULL if closed */
+    char *write_region(size_t *bytes);
+    /* Publish bytes written to the region */
+    void commit_write(size_t bytes);
+    /* Return where to read up to *bytes bytes in place, NULL if done */
+    char *read_region(size_t *bytes);
+    /* Release bytes read from the region */
+    void commit_read(size_t bytes);
     /* Return number of bytes read. */
     size_t read_nonblocking(char *data, size_t bytes);
     /* Return number of bytes written. */
@@ -46,9 +66,13 @@ public:
     void signal_data();
 
 private:
-    size_t beg_index_, end_index_, size_, capacity_;
+    /* Bytes written and read since the buffer was created */
+    uint64_t write_pos_, read_pos_;
+    size_t capacity_;
+    /* Set by a side that is about to sleep on its condition */
+    int writer_waiting_, reader_waiting_;
     pthread_cond_t space_cond_, data_cond_;
-    pthread_mutex_t cond_mutex_, pointer_mutex_;
+    pthread_mutex_t cond_mutex_;
     bool closed_;
     char *data_;
 };
@@ -0,0 +1,216 @@
+/******************************************************************************
+ *
+ * FILE    : cc.cpp
+ * PROJECT : parcel
+ *
+ * DESCRIPTION : This file contains the congestion control algorithms
+ *               that the UDT proxies can use instead of UDT's own, and
+ *               the parsing of their names and parameters.
+ *
+ *               udt        : UDT's native rate based controller
+ *               tcp        : a window based controller that backs off
+ *                            like TCP Reno, to share a link fairly
+ *               blast:MBPS : a fixed rate of MBPS megabits per second
+ *                            that ignores loss, for dedicated circuits
+ *
+ *               The controllers are adapted from udt4/app/cc.h.
+ *
+ * LICENSE : Licensed under the Apache License, Version 2.0 (the
+ *           "License"); you may not use this file except in
+ *           compliance with the License.  You may obtain a copy of
+ *           the License at
+ *
+ *               http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *           Unless required by applicable law or agreed to in
+ *           writing, software distributed under the License is
+ *           distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+ *           CONDITIONS OF ANY KIND, either express or implied.  See
+ *           the License for the specific language governing
+ *           permissions and limitations under the License.)
+ *
+ ******************************************************************************/
+
+#include "parcel.h"
+#include <ccc.h>
+#include <common.h>
+
+enum congestion_control_t { CC_INVALID = -1, CC_UDT, CC_TCP, CC_BLAST };
+
+/* The largest window the windowed controllers open, in packets */
+#define MAX_CWND 83333.0
+
+
+class TCPCC: public CCC
+{
+    /*
+     * Additive increase and multiplicative decrease of a congestion
+     * window, with no pacing between packets.  Unlike CTCP in
+     * udt4/app/cc.h, it halves its window on the loss reports of UDT,
+     * once per window of packets, and not only on timeouts.
+     */
+public:
+    TCPCC()
+        : ssthresh_(MAX_CWND)
+        , slow_start_(true)
+        , last_decrease_seq_(0)
+    {
+    }
+
+    virtual void init()
+    {
+        m_dPktSndPeriod = 0.0;
+        m_dCWndSize = 2.0;
+        last_decrease_seq_ = m_iSndCurrSeqNo;
+        setACKInterval(2);
+        setRTO(1000000);
+    }
+
+    virtual void onACK(int32_t)
+    {
+        if (slow_start_){
+            m_dCWndSize += 1.0;
+            if (m_dCWndSize >= ssthresh_){
+                slow_start_ = false;
+            }
+        } else {
+            m_dCWndSize += 1.0 / m_dCWndSize;
+        }
+    }
+
+    virtual void onLoss(const int32_t *losslist, int)
+    {
+        /* Losses of packets sent before the last decrease are the
+         * same congestion event */
+        int32_t lost = losslist[0] & 0x7FFFFFFF;
+        if (CSeqNo::seqcmp(lost, last_decrease_seq_) <= 0){
+            return;
+        }
+        last_decrease_seq_ = m_iSndCurrSeqNo;
+        slow_start_ = false;
+        ssthresh_ = max(2.0, m_dCWndSize / 2);
+        m_dCWndSize = ssthresh_;
+    }
+
+    virtual void onTimeout()
+    {
+        ssthresh_ = max(2.0, m_dCWndSize / 2);
+        slow_start_ = true;
+        m_dCWndSize = 2.0;
+    }
+
+private:
+    double ssthresh_;
+    bool slow_start_;
+    int32_t last_decrease_seq_;
+};
+
+
+class BlastCC: public CCC
+{
+    /*
+     * Sends at a fixed rate, as CUDPBlast in udt4/app/cc.h, and
+     * leaves lost packets to retransmission.
+     */
+public:
+    BlastCC(double mbps) : mbps_(mbps) {}
+
+    virtual void init()
+    {
+        m_dCWndSize = MAX_CWND;
+        m_dPktSndPeriod = (m_iMSS * 8.0) / mbps_;
+    }
+
+private:
+    double mbps_;
+};
+
+
+class BlastCCFactory: public CCCVirtualFactory
+{
+    /* Creates BlastCC with the rate given on the command line */
+public:
+    BlastCCFactory(double mbps) : mbps_(mbps) {}
+    virtual CCC *create() { return new BlastCC(mbps_); }
+    virtual CCCVirtualFactory *clone() { return new BlastCCFactory(mbps_); }
+
+private:
+    double mbps_;
+};
+
+
+static congestion_control_t parse_congestion_control(const char *congestion_control,
+                                                     double *mbps)
+{
+    /*
+     *  parse_congestion_control() - Parse the name of a congestion
+     *  control algorithm and its parameter
+     *
+     *  NULL and the empty string are UDT's own.
+     */
+    if (!congestion_control || !*congestion_control
+        || !strcmp(congestion_control, "udt")){
+        return CC_UDT;
+    }
+    if (!strcmp(congestion_control, "tcp")){
+        return CC_TCP;
+    }
+    if (!strncmp(congestion_control, "blast:", 6)){
+        char *end;
+        *mbps = strtod(congestion_control + 6, &end);
+        if (*end || *mbps <= 0){
+            return CC_INVALID;
+        }
+        return CC_BLAST;
+    }
+    return CC_INVALID;
+}
+
+int valid_congestion_control(const char *congestion_control)
+{
+    /*
+     *  valid_congestion_control() - Check a congestion control
+     *  setting before starting a proxy with it
+     *
+     */
+    double mbps;
+    if (parse_congestion_control(congestion_control, &mbps) == CC_INVALID){
+        error("unknown congestion control [%s], expected udt, tcp or "
+              "blast:MBPS", congestion_control);
+        return 0;
+    }
+    return 1;
+}
+
+int set_congestion_control(UDTSOCKET udt_socket, const char *congestion_control)
+{
+    /*
+     *  set_congestion_control() - Set the congestion control of a UDT
+     *  socket before it connects or listens
+     *
+     *  Connections accepted by a listening socket inherit it.
+     */
+    double mbps = 0;
+    int ret = 0;
+    switch (parse_congestion_control(congestion_control, &mbps)){
+    case CC_UDT:
+        break;
+    case CC_TCP: {
+        CCCFactory<TCPCC> factory;
+        ret = UDT::setsockopt(udt_socket, 0, UDT_CC, &factory, sizeof(factory));
+        break;
+    }
+    case CC_BLAST: {
+        BlastCCFactory factory(mbps);
+        ret = UDT::setsockopt(udt_socket, 0, UDT_CC, &factory, sizeof(factory));
+        break;
+    }
+    default:
+        return -1;
+    }
+    if (UDT::ERROR == ret){
+        error("setsockopt UDT_CC: %s", UDT::getlasterror().getErrorMessage());
+        return -1;
+    }
+    return 0;
+}
@@ -32,9 +32,12 @@
 #include <netdb.h>
 #include <sys/socket.h>
 #include <iostream>
+#include <string>
 #include <assert.h>
 #include <signal.h>
 #include <time.h>
+#include <stdint.h>
+#include <pthread.h>
 
 /* Non standard libraries */
 #include <udt>
@@ -64,9 +67,51 @@
 /******************************************************************************/
 using namespace std;
 
+/******************************************************************************
+ * UDT statistics of a connection, or summed over a proxy's connections,
+ * see udt_stats()
+ ******************************************************************************/
+typedef struct udt_stats_t {
+    int socket;
+    int connections;
+    double rtt_ms;
+    double bandwidth_mbps;
+    double send_mbps;
+    double receive_mbps;
+    double send_period_us;
+    int64_t sent_packets;
+    int64_t received_packets;
+    int64_t retransmitted_packets;
+    int64_t send_loss_packets;
+    int64_t receive_loss_packets;
+    int64_t sent_naks;
+    int64_t received_naks;
+    int flow_window;
+    int congestion_window;
+    int flight_size;
+    int send_buffer_available;
+    int receive_buffer_available;
+} udt_stats_t;
+
+/******************************************************************************
+ * connection counters, one per kind of proxy, see proxy_connections()
+ ******************************************************************************/
+typedef struct proxy_stats_t {
+    int opened;
+    int active;
+    /* The packet counters of the UDT connections that have closed */
+    udt_stats_t closed;
+} proxy_stats_t;
+
+extern proxy_stats_t tcp2udt_stats;
+extern proxy_stats_t udt2tcp_stats;
+extern proxy_stats_t udt2file_stats;
+
 /******************************************************************************
  * thread arg structures
  ******************************************************************************/
+struct udt_pool_t;
+
 typedef struct server_args_t {
     UDTSOCKET udt_socket;
     int tcp_socket;
@@ -75,6 +120,11 @@ typedef struct server_args_t {
     int mss;
     int udt_buffer_size;
     int udp_buffer_size;
+    int stripes;
+    char *stripe_hosts;
+    int pool_size;
+    struct udt_pool_t *pool;
+    char *congestion_control;
 } server_args_t;
 
 typedef struct transcriber_args_t {
@@ -85,8 +135,24 @@ typedef struct transcriber_args_t {
     int mss;
     int udt_buffer_size;
     int udp_buffer_size;
+    proxy_stats_t *stats;
+    int closed;
+    int stripes;
+    char *stripe_hosts;
+    struct udt_pool_t *pool;
+    char *congestion_control;
 } udt2tcp_args_t;
 
+typedef struct udt_pool_t {
+    transcriber_args_t args;
+    int size;
+    int count;
+    UDTSOCKET *sockets;
+    time_t *since;
+    pthread_mutex_t lock;
+    pthread_cond_t taken;
+} udt_pool_t;
+
 typedef struct udt_pipe_args_t {
     UDTSOCKET udt_socket;
     CircularBuffer *pipe;
@@ -97,6 +163,34 @@ typedef struct tcp_pipe_args_t {
     CircularBuffer *pipe;
 } tcp_pipe_args_t;
 
+typedef struct stripe_session_t {
+    uint64_t id;
+    int count;
+    int joined;
+    UDTSOCKET *udt_sockets;
+    int tcp_socket;
+    pthread_mutex_t send_lock;
+    uint64_t send_seq;
+    int sent_eof;
+    pthread_mutex_t recv_lock;
+    pthread_cond_t turn;
+    uint64_t recv_seq;
+    int receiving;
+    int aborted;
+    proxy_stats_t *stats;
+    struct stripe_session_t *next;
+} stripe_session_t;
+
+typedef struct stripe_args_t {
+    stripe_session_t *session;
+    int index;
+} stripe_args_t;
+
+typedef struct file_server_args_t {
+    UDTSOCKET udt_socket;
+    char *directory;
+} file_server_args_t;
+
 /******************************************************************************
  * file: udt2tcp.cpp
  *
@@ -118,7 +212,14 @@ EXTERN int udt2tcp_start_configurable(char *local_host,
                                       char *remote_port,
                                       int mss,
                                       int udt_buffer_size,
-                                      int udp_buffer_size);
+                                      int udp_buffer_size,
+                                      int stripes,
+                                      char *congestion_control);
+UDTSOCKET listen_udt(char *local_port,
+                     int mss,
+                     int udt_buffer_size,
+                     int udp_buffer_size,
+                     const char *congestion_control);
 int connect_remote_tcp(transcriber_args_t *args);
 void *thread_udt2tcp(void *_args_);
 EXTERN void *udt2tcp_accept_clients(void *_args_);
@@ -144,12 +245,88 @@ EXTERN int tcp2udt_start_configurable(char *local_host,
                                       char *remote_port,
                                       int mss,
                                       int udt_buffer_size,
-                                      int udp_buffer_size);
-int connect_remote_udt(transcriber_args_t *args);
+                                      int udp_buffer_size,
+                                      int stripes,
+                                      char *stripe_hosts,
+                                      int pool_size,
+                                      char *congestion_control);
+int connect_remote_udt(transcriber_args_t *args, const char *bind_host = NULL);
 void *thread_tcp2udt(void *_args_);
 EXTERN void *tcp2udt_accept_clients(void *_args_);
 
 
+/******************************************************************************
+ * file: udt2file.cpp
+ *
+ * udt2file_start() - This is the main function for starting a UDT
+ *                    file server on the local.  Arguments specify the
+ *                    local hostname and port for the UDT server to
+ *                    bind to, and the directory of the files it
+ *                    serves.  Clients send the same HTTP range
+ *                    requests they would send to the data server.
+ *
+ ******************************************************************************/
+EXTERN int udt2file_start(char *local_host,
+                          char *local_port,
+                          char *directory);
+EXTERN int udt2file_start_configurable(char *local_host,
+                                       char *local_port,
+                                       char *directory,
+                                       int mss,
+                                       int udt_buffer_size,
+                                       int udp_buffer_size,
+                                       char *congestion_control);
+EXTERN void *udt2file_accept_clients(void *_args_);
+void *thread_udt2file(void *_args_);
+int serve_file_request(UDTSOCKET udt_socket,
+                       const char *directory,
+                       const string &request);
+int send_all(UDTSOCKET udt_socket, const char *buffer, int64_t size);
+
+
+/******************************************************************************
+ * file: stripes.cpp
+ *
+ * thread_tcp2stripes() - Proxies a TCP client over several UDT
+ *                        connections (stripes) to a udt2tcp proxy
+ *                        started with stripes, which reassembles the
+ *                        stream in order with thread_stripe2tcp().
+ *
+ ******************************************************************************/
+void *thread_tcp2stripes(void *_args_);
+void *thread_stripe2tcp(void *_args_);
+void *tcp2stripe(void *_args_);
+void *stripe2tcp(void *_args_);
+int send_stripe_header(UDTSOCKET udt_socket, uint64_t id, int index, int count);
+int run_stripes(stripe_session_t *session);
+
+
+/******************************************************************************
+ * file: pool.cpp
+ *
+ * udt_pool_start() - Keeps a pool of connected UDT sockets to the
+ *                    remote of a tcp2udt proxy, refilled in the
+ *                    background, for udt_pool_take() to hand to new
+ *                    TCP clients.
+ *
+ ******************************************************************************/
+udt_pool_t *udt_pool_start(server_args_t *args);
+void *udt_pool_refill(void *_pool_);
+UDTSOCKET udt_pool_take(udt_pool_t *pool);
+
+
+/******************************************************************************
+ * file: cc.cpp
+ *
+ * set_congestion_control() - Sets the congestion control algorithm of a
+ *                            UDT socket by name: udt, tcp or
+ *                            blast:MBPS.
+ *
+ ******************************************************************************/
+int valid_congestion_control(const char *congestion_control);
+int set_congestion_control(UDTSOCKET udt_socket, const char *congestion_control);
+
+
 /******************************************************************************
  * file: trascribers.cpp - These methods are written to be called as
  *                         threads (though they are called directly as
@@ -161,6 +338,36 @@ void *tcp2pipe(void *_args_);
 void *pipe2udt(void *_args_);
 void *pipe2tcp(void *_args_);
 
+/******************************************************************************
+ * file: trascribers.cpp
+ *
+ * proxy_connections() - Reports the number of connections a kind of
+ *                       proxy ("tcp2udt", "udt2tcp" or "udt2file")
+ *                       has accepted, and how many of them are still
+ *                       open.
+ *
+ ******************************************************************************/
+EXTERN int proxy_connections(char *proxy, int *opened, int *active);
+void proxy_opened(proxy_stats_t *stats);
+void proxy_closed(proxy_stats_t *stats);
+void transcriber_closed(transcriber_args_t *args);
+
+/******************************************************************************
+ * file: trascribers.cpp
+ *
+ * udt_stats() - Samples UDT::perfmon() of the open UDT connections of
+ *               a kind of proxy, registered with
+ *               udt_connection_opened() until udt_connection_closed()
+ *               is called before they are closed.  Fills in the
+ *               totals of the proxy and up to max connections, and
+ *               returns the number of open connections.
+ *
+ ******************************************************************************/
+EXTERN int udt_stats(char *proxy, udt_stats_t *total,
+                     udt_stats_t *connections, int max);
+void udt_connection_opened(proxy_stats_t *stats, UDTSOCKET udt_socket);
+void udt_connection_closed(UDTSOCKET udt_socket);
+
 /******************************************************************************
  * macros - Macros for logging
  ******************************************************************************/
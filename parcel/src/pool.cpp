@@ -0,0 +1,165 @@
+/******************************************************************************
+ *
+ * FILE    : pool.cpp
+ * PROJECT : parcel
+ *
+ * DESCRIPTION : This file contains functions for keeping a pool of
+ *               warm UDT connections to the remote udt2tcp proxy, so
+ *               that tcp2udt can hand an accepted TCP client a
+ *               connection without waiting on a UDT handshake across
+ *               the WAN.
+ *
+ * LICENSE : Licensed under the Apache License, Version 2.0 (the
+ *           "License"); you may not use this file except in
+ *           compliance with the License.  You may obtain a copy of
+ *           the License at
+ *
+ *               http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *           Unless required by applicable law or agreed to in
+ *           writing, software distributed under the License is
+ *           distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+ *           CONDITIONS OF ANY KIND, either express or implied.  See
+ *           the License for the specific language governing
+ *           permissions and limitations under the License.)
+ *
+ ******************************************************************************/
+
+#include "parcel.h"
+
+/*
+ * The remote udt2tcp proxy connects to its TCP server as soon as it
+ * accepts a UDT connection, so a warm connection also holds a TCP
+ * connection open on the far side.  Servers close idle connections
+ * eventually, so connections are replaced after POOL_MAX_IDLE seconds,
+ * and ones that the far side has closed are dropped as soon as UDT
+ * notices.
+ */
+#define POOL_MAX_IDLE 30
+/* Seconds between checks of the pooled connections */
+#define POOL_CHECK_INTERVAL 1
+/* The most seconds to wait before connecting again after a failure */
+#define POOL_MAX_BACKOFF 30
+
+
+udt_pool_t *udt_pool_start(server_args_t *args)
+{
+    /*
+     *  udt_pool_start() - Start keeping args->pool_size connections
+     *
+     *  Returns the pool, whose refill thread connects to the remote
+     *  udt2tcp proxy in the background.
+     */
+    udt_pool_t *pool = (udt_pool_t*) calloc(1, sizeof(udt_pool_t));
+    pool->args.remote_host     = args->remote_host;
+    pool->args.remote_port     = args->remote_port;
+    pool->args.mss             = args->mss;
+    pool->args.udt_buffer_size = args->udt_buffer_size;
+    pool->args.udp_buffer_size = args->udp_buffer_size;
+    pool->args.congestion_control = args->congestion_control;
+    pool->size    = args->pool_size;
+    pool->sockets = (UDTSOCKET*) malloc(pool->size * sizeof(UDTSOCKET));
+    pool->since   = (time_t*) malloc(pool->size * sizeof(time_t));
+    pthread_mutex_init(&pool->lock, NULL);
+    pthread_cond_init(&pool->taken, NULL);
+
+    log("Keeping %d warm UDT connections to [%s:%s]",
+        pool->size, args->remote_host, args->remote_port);
+    pthread_t refill_thread;
+    if (pthread_create(&refill_thread, NULL, udt_pool_refill, pool)){
+        error("unable to create pool thread");
+        return NULL;
+    }
+    pthread_detach(refill_thread);
+    return pool;
+}
+
+static void udt_pool_expire(udt_pool_t *pool)
+{
+    /*
+     *  udt_pool_expire() - Close pooled connections that are broken
+     *  or have been idle too long, the pool must be locked
+     *
+     */
+    time_t now = time(NULL);
+    int kept = 0;
+    for (int i = 0; i < pool->count; i++){
+        if (UDT::getsockstate(pool->sockets[i]) != CONNECTED
+            || now - pool->since[i] > POOL_MAX_IDLE){
+            debug("Closing pooled UDT connection %d", pool->sockets[i]);
+            UDT::close(pool->sockets[i]);
+            continue;
+        }
+        pool->sockets[kept] = pool->sockets[i];
+        pool->since[kept] = pool->since[i];
+        kept++;
+    }
+    pool->count = kept;
+}
+
+void *udt_pool_refill(void *_pool_)
+{
+    /*
+     *  udt_pool_refill() - Keep the pool full
+     *
+     *  Connects one connection at a time whenever the pool is short,
+     *  backing off exponentially while the remote cannot be reached.
+     */
+    udt_pool_t *pool = (udt_pool_t*) _pool_;
+    int failures = 0;
+
+    while (1){
+        /* Wait until the pool is short of a connection */
+        pthread_mutex_lock(&pool->lock);
+        udt_pool_expire(pool);
+        while (pool->count >= pool->size){
+            struct timespec deadline;
+            deadline.tv_sec = time(NULL) + POOL_CHECK_INTERVAL;
+            deadline.tv_nsec = 0;
+            pthread_cond_timedwait(&pool->taken, &pool->lock, &deadline);
+            udt_pool_expire(pool);
+        }
+        pthread_mutex_unlock(&pool->lock);
+
+        UDTSOCKET udt_socket = connect_remote_udt(&pool->args);
+        if (udt_socket <= 0){
+            failures++;
+            sleep(min(POOL_MAX_BACKOFF, 1 << min(failures - 1, 5)));
+            continue;
+        }
+        failures = 0;
+
+        pthread_mutex_lock(&pool->lock);
+        pool->sockets[pool->count] = udt_socket;
+        pool->since[pool->count] = time(NULL);
+        pool->count++;
+        pthread_mutex_unlock(&pool->lock);
+        debug("Pooled UDT connection %d", udt_socket);
+    }
+    return NULL;
+}
+
+UDTSOCKET udt_pool_take(udt_pool_t *pool)
+{
+    /*
+     *  udt_pool_take() - Take a warm connection out of the pool
+     *
+     *  Returns 0 if there is none, in which case the caller connects
+     *  one itself.
+     */
+    UDTSOCKET udt_socket = 0;
+    pthread_mutex_lock(&pool->lock);
+    while (pool->count && !udt_socket){
+        /* The most recently connected is the least likely to be stale */
+        UDTSOCKET pooled = pool->sockets[--pool->count];
+        if (UDT::getsockstate(pooled) == CONNECTED){
+            udt_socket = pooled;
+        } else {
+            UDT::close(pooled);
+        }
+    }
+    pthread_cond_signal(&pool->taken);
+    pthread_mutex_unlock(&pool->lock);
+    debug("Took %s UDT connection", udt_socket ? "a warm" : "no");
+    return udt_socket;
+}
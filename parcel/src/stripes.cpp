@@ -0,0 +1,520 @@
+/******************************************************************************
+ *
+ * FILE    : stripes.cpp
+ * PROJECT : parcel
+ *
+ * DESCRIPTION : This file contains functions for proxying one TCP
+ *               connection over several UDT connections (stripes),
+ *               reassembling the stream in order on the far side.
+ *
+ * LICENSE : Licensed under the Apache License, Version 2.0 (the
+ *           "License"); you may not use this file except in
+ *           compliance with the License.  You may obtain a copy of
+ *           the License at
+ *
+ *               http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *           Unless required by applicable law or agreed to in
+ *           writing, software distributed under the License is
+ *           distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+ *           CONDITIONS OF ANY KIND, either express or implied.  See
+ *           the License for the specific language governing
+ *           permissions and limitations under the License.)
+ *
+ ******************************************************************************/
+
+/*
+ * Every stripe starts with a STRIPE_HEADER_SIZE byte header, the
+ * magic, the id of the session it belongs to, its index and the
+ * number of stripes in the session.  After that each direction of a
+ * stripe carries frames of up to STRIPE_FRAME_SIZE bytes, each one
+ * preceded by its sequence number in the stream and its length.  The
+ * stripe senders take turns reading the next frame from the TCP
+ * socket, so faster stripes carry more of them, and the receivers take
+ * turns writing them to the TCP socket in sequence.  A frame of length
+ * 0 ends the direction of a stripe, once every stripe has ended it
+ * the TCP socket is shut down for writing.
+ */
+
+#include "parcel.h"
+#include <errno.h>
+#include <fcntl.h>
+#include <stdint.h>
+
+#define STRIPE_MAGIC 0x50435354  /* "PCST" */
+#define STRIPE_HEADER_SIZE 16
+#define FRAME_HEADER_SIZE 12
+#define STRIPE_FRAME_SIZE 1048576
+
+/* Seconds a session waits for the rest of its stripes */
+#define STRIPE_SESSION_TIMEOUT 30
+
+/* Sessions that are waiting for the rest of their stripes */
+static stripe_session_t *pending_sessions = NULL;
+static pthread_mutex_t pending_lock = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t pending_joined = PTHREAD_COND_INITIALIZER;
+
+
+static void pack(char *buffer, uint64_t value, int size)
+{
+    for (int i = size - 1; i >= 0; i--){
+        buffer[i] = (char) (value & 0xff);
+        value >>= 8;
+    }
+}
+
+static uint64_t unpack(const char *buffer, int size)
+{
+    uint64_t value = 0;
+    for (int i = 0; i < size; i++){
+        value = (value << 8) | (unsigned char) buffer[i];
+    }
+    return value;
+}
+
+static int recv_all(UDTSOCKET udt_socket, char *buffer, int size)
+{
+    /*
+     *  recv_all() - Receive exactly size bytes from UDT
+     *
+     */
+    int received = 0;
+    while (received < size){
+        int read_size = UDT::recv(udt_socket, buffer + received,
+                                  size - received, 0);
+        if (UDT::ERROR == read_size){
+            if (UDT::getlasterror().getErrorCode() != 2001){
+                debug("recv: %s", UDT::getlasterror().getErrorMessage());
+            }
+            return -1;
+        }
+        received += read_size;
+    }
+    return 0;
+}
+
+static int write_all(int tcp_socket, const char *buffer, int size)
+{
+    /*
+     *  write_all() - Send exactly size bytes over TCP
+     *
+     */
+    int sent = 0;
+    while (sent < size){
+        int sent_size = send(tcp_socket, buffer + sent, size - sent, 0);
+        if (sent_size < 0){
+            debug("unable to write to socket");
+            return -1;
+        }
+        sent += sent_size;
+    }
+    return 0;
+}
+
+static uint64_t new_session_id()
+{
+    /*
+     *  new_session_id() - A random id for a striped session
+     *
+     */
+    static uint64_t counter = 0;
+    uint64_t id = 0;
+    int fd = open("/dev/urandom", O_RDONLY);
+    if (fd < 0 || read(fd, &id, sizeof(id)) != sizeof(id)){
+        id = ((uint64_t) getpid() << 48) ^ ((uint64_t) time(NULL) << 16);
+    }
+    if (fd >= 0){
+        close(fd);
+    }
+    return id ^ __sync_add_and_fetch(&counter, 1);
+}
+
+static stripe_session_t *new_session(uint64_t id, int count)
+{
+    stripe_session_t *session = (stripe_session_t*) calloc(1, sizeof(stripe_session_t));
+    session->id = id;
+    session->count = count;
+    session->udt_sockets = (UDTSOCKET*) malloc(count * sizeof(UDTSOCKET));
+    for (int i = 0; i < count; i++){
+        session->udt_sockets[i] = UDT::INVALID_SOCK;
+    }
+    session->tcp_socket = -1;
+    session->receiving = count;
+    pthread_mutex_init(&session->send_lock, NULL);
+    pthread_mutex_init(&session->recv_lock, NULL);
+    pthread_cond_init(&session->turn, NULL);
+    return session;
+}
+
+static void free_session(stripe_session_t *session)
+{
+    for (int i = 0; i < session->count; i++){
+        if (session->udt_sockets[i] != UDT::INVALID_SOCK){
+            udt_connection_closed(session->udt_sockets[i]);
+            UDT::close(session->udt_sockets[i]);
+        }
+    }
+    if (session->tcp_socket >= 0){
+        close(session->tcp_socket);
+    }
+    pthread_mutex_destroy(&session->send_lock);
+    pthread_mutex_destroy(&session->recv_lock);
+    pthread_cond_destroy(&session->turn);
+    free(session->udt_sockets);
+    free(session);
+}
+
+static void abort_session(stripe_session_t *session)
+{
+    /*
+     *  abort_session() - Tear down a session after an error
+     *
+     *  Wakes every thread of the session, those blocked on a socket
+     *  by shutting the sockets down and those waiting for their turn
+     *  through the condition variable.
+     */
+    if (!__sync_bool_compare_and_swap(&session->aborted, 0, 1)){
+        return;
+    }
+    debug("Aborting striped session %llx", (unsigned long long) session->id);
+    shutdown(session->tcp_socket, SHUT_RDWR);
+    for (int i = 0; i < session->count; i++){
+        udt_connection_closed(session->udt_sockets[i]);
+        UDT::close(session->udt_sockets[i]);
+    }
+    pthread_mutex_lock(&session->recv_lock);
+    pthread_cond_broadcast(&session->turn);
+    pthread_mutex_unlock(&session->recv_lock);
+}
+
+int send_stripe_header(UDTSOCKET udt_socket, uint64_t id, int index, int count)
+{
+    /*
+     *  send_stripe_header() - Announce a stripe to the far side
+     *
+     */
+    char header[STRIPE_HEADER_SIZE];
+    pack(header, STRIPE_MAGIC, 4);
+    pack(header + 4, id, 8);
+    pack(header + 12, index, 2);
+    pack(header + 14, count, 2);
+    return send_all(udt_socket, header, STRIPE_HEADER_SIZE);
+}
+
+void *tcp2stripe(void *_args_)
+{
+    /*
+     *  tcp2stripe() - Send frames read from TCP over one stripe
+     *
+     */
+    stripe_args_t *args = (stripe_args_t*) _args_;
+    stripe_session_t *session = args->session;
+    UDTSOCKET udt_socket = session->udt_sockets[args->index];
+    char *buffer = (char*) malloc(FRAME_HEADER_SIZE + STRIPE_FRAME_SIZE);
+    int read_size;
+
+    while (1){
+        /* Take the next frame of the stream */
+        pthread_mutex_lock(&session->send_lock);
+        if (session->sent_eof || session->aborted){
+            read_size = 0;
+        } else if ((read_size = read(session->tcp_socket,
+                                     buffer + FRAME_HEADER_SIZE,
+                                     STRIPE_FRAME_SIZE)) <= 0){
+            session->sent_eof = 1;
+        }
+        uint64_t seq = session->send_seq++;
+        pthread_mutex_unlock(&session->send_lock);
+        if (read_size < 0){
+            debug("Unable to read from TCP socket.");
+            abort_session(session);
+            goto cleanup;
+        }
+
+        /* Send it, a frame of length 0 ends this stripe */
+        pack(buffer, seq, 8);
+        pack(buffer + 8, read_size, 4);
+        if (send_all(udt_socket, buffer, FRAME_HEADER_SIZE + read_size) < 0){
+            abort_session(session);
+            goto cleanup;
+        }
+        debug("Sent frame %llu of %d bytes on stripe %d",
+              (unsigned long long) seq, read_size, args->index);
+        if (!read_size){
+            goto cleanup;
+        }
+    }
+
+ cleanup:
+    debug("Exiting tcp2stripe thread.");
+    free(buffer);
+    return NULL;
+}
+
+void *stripe2tcp(void *_args_)
+{
+    /*
+     *  stripe2tcp() - Write the frames of one stripe to TCP in turn
+     *
+     */
+    stripe_args_t *args = (stripe_args_t*) _args_;
+    stripe_session_t *session = args->session;
+    UDTSOCKET udt_socket = session->udt_sockets[args->index];
+    char *buffer = (char*) malloc(STRIPE_FRAME_SIZE);
+    char header[FRAME_HEADER_SIZE];
+
+    while (1){
+        /* Receive the next frame of this stripe */
+        if (recv_all(udt_socket, header, FRAME_HEADER_SIZE) < 0){
+            abort_session(session);
+            goto cleanup;
+        }
+        uint64_t seq = unpack(header, 8);
+        int size = (int) unpack(header + 8, 4);
+        if (size > STRIPE_FRAME_SIZE){
+            error("frame of %d bytes on stripe %d", size, args->index);
+            abort_session(session);
+            goto cleanup;
+        }
+        if (!size){
+            break;
+        }
+        if (recv_all(udt_socket, buffer, size) < 0){
+            abort_session(session);
+            goto cleanup;
+        }
+
+        /* Wait for the frames before it, then write it */
+        pthread_mutex_lock(&session->recv_lock);
+        while (session->recv_seq != seq && !session->aborted){
+            pthread_cond_wait(&session->turn, &session->recv_lock);
+        }
+        if (session->aborted || write_all(session->tcp_socket, buffer, size) < 0){
+            pthread_mutex_unlock(&session->recv_lock);
+            abort_session(session);
+            goto cleanup;
+        }
+        session->recv_seq++;
+        pthread_cond_broadcast(&session->turn);
+        pthread_mutex_unlock(&session->recv_lock);
+    }
+
+    /* The last stripe to end ends the stream */
+    if (__sync_sub_and_fetch(&session->receiving, 1) == 0){
+        debug("Striped session %llx received", (unsigned long long) session->id);
+        shutdown(session->tcp_socket, SHUT_WR);
+    }
+
+ cleanup:
+    debug("Exiting stripe2tcp thread.");
+    free(buffer);
+    return NULL;
+}
+
+int run_stripes(stripe_session_t *session)
+{
+    /*
+     *  run_stripes() - Proxy a session whose sockets are all connected
+     *
+     *  Blocks until both directions of every stripe have ended, then
+     *  closes the sockets and frees the session.
+     */
+    int count = session->count;
+    pthread_t *threads = (pthread_t*) malloc(2 * count * sizeof(pthread_t));
+    stripe_args_t *args = (stripe_args_t*) malloc(count * sizeof(stripe_args_t));
+    int started = 0;
+
+    log("Proxying striped session %llx over %d UDT connections",
+        (unsigned long long) session->id, count);
+    for (int i = 0; i < count; i++){
+        udt_connection_opened(session->stats, session->udt_sockets[i]);
+    }
+    for (int i = 0; i < count; i++){
+        args[i].session = session;
+        args[i].index = i;
+        if (pthread_create(&threads[started], NULL, tcp2stripe, &args[i])){
+            error("unable to create tcp2stripe thread");
+            abort_session(session);
+            break;
+        }
+        started++;
+        if (pthread_create(&threads[started], NULL, stripe2tcp, &args[i])){
+            error("unable to create stripe2tcp thread");
+            abort_session(session);
+            break;
+        }
+        started++;
+    }
+
+    for (int i = 0; i < started; i++){
+        void *ret;
+        pthread_join(threads[i], &ret);
+    }
+    int aborted = session->aborted;
+    free(threads);
+    free(args);
+    free_session(session);
+    return aborted ? -1 : 0;
+}
+
+void *thread_tcp2stripes(void *_args_)
+{
+    /*
+     *  thread_tcp2stripes() - Proxy a TCP client over stripes
+     *
+     *  Connects args->stripes UDT connections to the remote, each
+     *  bound to the next of the comma separated args->stripe_hosts
+     *  if any are given.
+     */
+    transcriber_args_t *args = (transcriber_args_t*) _args_;
+    stripe_session_t *session = new_session(new_session_id(), args->stripes);
+    session->tcp_socket = args->tcp_socket;
+    session->stats = args->stats;
+
+    /* Split the local addresses to bind the stripes to */
+    char *hosts = strdup(args->stripe_hosts ? args->stripe_hosts : "");
+    char **bind_hosts = (char**) malloc((strlen(hosts) / 2 + 1) * sizeof(char*));
+    int host_count = 0;
+    char *saveptr;
+    for (char *host = strtok_r(hosts, ",", &saveptr); host;
+         host = strtok_r(NULL, ",", &saveptr)){
+        bind_hosts[host_count++] = host;
+    }
+
+    for (int i = 0; i < session->count; i++){
+        /* Stripes bound to given interfaces are not taken from the pool */
+        const char *bind_host = host_count ? bind_hosts[i % host_count] : NULL;
+        UDTSOCKET udt_socket = 0;
+        if (args->pool && !bind_host){
+            udt_socket = udt_pool_take(args->pool);
+        }
+        if (!udt_socket){
+            udt_socket = connect_remote_udt(args, bind_host);
+        }
+        if (udt_socket <= 0
+            || send_stripe_header(udt_socket, session->id, i, session->count) < 0){
+            error("unable to connect stripe %d", i);
+            if (udt_socket > 0){
+                UDT::close(udt_socket);
+            }
+            free_session(session);
+            goto cleanup;
+        }
+        session->udt_sockets[i] = udt_socket;
+    }
+    run_stripes(session);
+
+ cleanup:
+    free(bind_hosts);
+    free(hosts);
+    transcriber_closed(args);
+    free(args);
+    return NULL;
+}
+
+void *thread_stripe2tcp(void *_args_)
+{
+    /*
+     *  thread_stripe2tcp() - Add an accepted stripe to its session
+     *
+     *  The thread of the first stripe of a session waits for the rest,
+     *  then connects to the remote TCP server and proxies the session.
+     *  Sessions whose stripes have not all arrived within
+     *  STRIPE_SESSION_TIMEOUT seconds are dropped and their stripes
+     *  closed.
+     */
+    transcriber_args_t *args = (transcriber_args_t*) _args_;
+    char header[STRIPE_HEADER_SIZE];
+    stripe_session_t *session;
+
+    if (recv_all(args->udt_socket, header, STRIPE_HEADER_SIZE) < 0
+        || unpack(header, 4) != STRIPE_MAGIC){
+        error("UDT connection is not a stripe");
+        UDT::close(args->udt_socket);
+        free(args);
+        return NULL;
+    }
+    uint64_t id = unpack(header + 4, 8);
+    int index = (int) unpack(header + 12, 2);
+    int count = (int) unpack(header + 14, 2);
+    if (count < 1){
+        error("stripe %d of %d is not a valid session %llx",
+              index, count, (unsigned long long) id);
+        UDT::close(args->udt_socket);
+        free(args);
+        return NULL;
+    }
+
+    /* Find or start the session of the stripe */
+    pthread_mutex_lock(&pending_lock);
+    stripe_session_t **prev = &pending_sessions;
+    for (session = pending_sessions; session; session = session->next){
+        if (session->id == id){
+            break;
+        }
+        prev = &session->next;
+    }
+    int first = !session;
+    if (first){
+        session = new_session(id, count);
+        session->next = pending_sessions;
+        pending_sessions = session;
+        prev = &pending_sessions;
+    }
+    if (count != session->count || index >= count
+        || session->udt_sockets[index] != UDT::INVALID_SOCK){
+        pthread_mutex_unlock(&pending_lock);
+        error("stripe %d of %d does not fit session %llx",
+              index, count, (unsigned long long) id);
+        UDT::close(args->udt_socket);
+        free(args);
+        return NULL;
+    }
+    session->udt_sockets[index] = args->udt_socket;
+    debug("Stripe %d of %d joined session %llx",
+          index, count, (unsigned long long) id);
+    if (++session->joined == count){
+        *prev = session->next;
+        pthread_cond_broadcast(&pending_joined);
+    }
+    if (!first){
+        /* The session belongs to the thread of its first stripe */
+        pthread_mutex_unlock(&pending_lock);
+        free(args);
+        return NULL;
+    }
+
+    struct timespec deadline;
+    clock_gettime(CLOCK_REALTIME, &deadline);
+    deadline.tv_sec += STRIPE_SESSION_TIMEOUT;
+    while (session->joined < count){
+        if (pthread_cond_timedwait(&pending_joined, &pending_lock,
+                                   &deadline) == ETIMEDOUT){
+            break;
+        }
+    }
+    int complete = session->joined == count;
+    if (!complete){
+        /* No other thread can find the session once it is unlinked */
+        for (prev = &pending_sessions; *prev != session; prev = &(*prev)->next);
+        *prev = session->next;
+    }
+    pthread_mutex_unlock(&pending_lock);
+
+    if (!complete){
+        error("session %llx expired with %d of %d stripes",
+              (unsigned long long) id, session->joined, count);
+        free_session(session);
+    } else {
+        session->stats = args->stats;
+        proxy_opened(args->stats);
+        if ((session->tcp_socket = connect_remote_tcp(args)) < 0){
+            free_session(session);
+        } else {
+            run_stripes(session);
+        }
+        proxy_closed(args->stats);
+    }
+    free(args);
+    return NULL;
+}
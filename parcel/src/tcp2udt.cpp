@@ -48,7 +48,11 @@ EXTERN int tcp2udt_start(char *local_host, char *local_port,
                                       remote_port,
                                       mss,
                                       udt_buffer_size,
-                                      udp_buffer_size);
+                                      udp_buffer_size,
+                                      1,
+                                      NULL,
+                                      0,
+                                      NULL);
 
 }
 
@@ -59,7 +63,11 @@ EXTERN int tcp2udt_start_configurable(char *local_host,
                                       char *remote_port,
                                       int mss,
                                       int udt_buffer_size,
-                                      int udp_buffer_size)
+                                      int udp_buffer_size,
+                                      int stripes,
+                                      char *stripe_hosts,
+                                      int pool_size,
+                                      char *congestion_control)
 {
     /*
      *  tcp2udt_start() - starts a TCP-to-UDT proxy thread
@@ -67,12 +75,32 @@ EXTERN int tcp2udt_start_configurable(char *local_host,
      *  Starts a proxy server listening on local_host:local_port.
      *  Incomming connections get their own thread and a proxied
      *  connection to remote_host:remote_port.
+     *
+     *  mss             : maximum segment size
+     *  udt_buffer_size : UDT buffer size in bytes
+     *  udp_buffer_size : UDP buffer size in bytes
+     *  stripes         : UDT connections to stripe each TCP connection
+     *                    over, the remote udt2tcp proxy must also be
+     *                    started with stripes if this is more than 1
+     *  stripe_hosts    : comma separated local addresses to bind the
+     *                    stripes to in turn, or NULL for any
+     *  pool_size       : warm UDT connections to keep ready for new
+     *                    clients, 0 to connect for each client
+     *  congestion_control : udt, tcp or blast:MBPS, see cc.cpp, or
+     *                    NULL for udt
      */
     log("Proxy binding to local TCP socket [%s:%s] to remote UDT [%s:%s]",
         local_host, local_port, remote_host, remote_port);
     debug("MSS            : %d", mss);
     debug("UDT_BUFFER_SIZE: %d", udt_buffer_size);
     debug("UDP_BUFFER_SIZE: %d", udp_buffer_size);
+    debug("STRIPES        : %d", stripes);
+    debug("POOL_SIZE      : %d", pool_size);
+    debug("CONGESTION     : %s", congestion_control);
+
+    if (!valid_congestion_control(congestion_control)){
+        return -1;
+    }
 
     addrinfo hints;
     addrinfo* res;
@@ -131,7 +159,11 @@ EXTERN int tcp2udt_start_configurable(char *local_host,
     args->mss             = mss;
     args->udt_buffer_size = udt_buffer_size;
     args->udp_buffer_size = udp_buffer_size;
-
+    args->stripes         = stripes;
+    args->stripe_hosts    = stripe_hosts && *stripe_hosts ? strdup(stripe_hosts) : NULL;
+    args->pool_size       = pool_size;
+    args->congestion_control = congestion_control && *congestion_control ? strdup(congestion_control) : NULL;
+    args->pool            = pool_size > 0 ? udt_pool_start(args) : NULL;
 
     if (pthread_create(&tcp2udt_server_thread, NULL, tcp2udt_accept_clients, args)){
         perror("unable to create tcp2udt server thread");
@@ -177,6 +209,32 @@ EXTERN void *tcp2udt_accept_clients(void *_args_)
         transcriber_args->mss             = args->mss;
         transcriber_args->udt_buffer_size = args->udt_buffer_size;
         transcriber_args->udp_buffer_size = args->udp_buffer_size;
+        transcriber_args->stats           = &tcp2udt_stats;
+        transcriber_args->closed          = 0;
+        transcriber_args->stripes         = args->stripes;
+        transcriber_args->stripe_hosts    = args->stripe_hosts;
+        transcriber_args->pool            = args->pool;
+        transcriber_args->congestion_control = args->congestion_control;
+        proxy_opened(transcriber_args->stats);
+
+        /* Striped connections get a single thread of their own */
+        if (args->stripes > 1){
+            pthread_t stripes_thread;
+            if (pthread_create(&stripes_thread, NULL, thread_tcp2stripes, transcriber_args)){
+                perror("Unable to create stripes thread");
+                close(client_socket);
+                transcriber_closed(transcriber_args);
+                free(transcriber_args);
+            } else {
+                pthread_detach(stripes_thread);
+            }
+            continue;
+        }
+
+        /* Hand the client a warm connection if there is one */
+        if (args->pool){
+            transcriber_args->udt_socket = udt_pool_take(args->pool);
+        }
 
         /* Create tcp2udt thread */
         pthread_t tcp_thread;
@@ -202,11 +260,13 @@ EXTERN void *tcp2udt_accept_clients(void *_args_)
     return NULL;
 }
 
-int connect_remote_udt(transcriber_args_t *args)
+int connect_remote_udt(transcriber_args_t *args, const char *bind_host)
 {
     /*
      *  connect_remote_udt() - Creates client connection to UDT server
      *
+     *  The connection goes out of the local address bind_host if it
+     *  is not NULL.
      */
     debug("Connecting to remote UDT at [%s:%s]",
           args->remote_host, args->remote_port);
@@ -239,6 +299,27 @@ int connect_remote_udt(transcriber_args_t *args)
     UDT::setsockopt(udt_socket, 0, UDP_SNDBUF, &udp_buff, sizeof(int));
     UDT::setsockopt(udt_socket, 0, UDT_RCVBUF, &udt_buff, sizeof(int));
     UDT::setsockopt(udt_socket, 0, UDP_RCVBUF, &udp_buff, sizeof(int));
+    if (set_congestion_control(udt_socket, args->congestion_control)){
+        UDT::close(udt_socket);
+        return -1;
+    }
+
+    /* Bind to the local interface */
+    if (bind_host){
+        struct addrinfo *bind_addr;
+        if (0 != getaddrinfo(bind_host, NULL, &hints, &bind_addr)){
+            cerr << "incorrect local address. " << bind_host << endl;
+            UDT::close(udt_socket);
+            return -1;
+        }
+        int ret = UDT::bind(udt_socket, bind_addr->ai_addr, bind_addr->ai_addrlen);
+        freeaddrinfo(bind_addr);
+        if (UDT::ERROR == ret){
+            cerr << "bind: " << UDT::getlasterror().getErrorMessage() << endl;
+            UDT::close(udt_socket);
+            return -1;
+        }
+    }
 
     /* Get address information */
     if (0 != getaddrinfo(args->remote_host, args->remote_port, &hints, &peer)){
@@ -299,11 +380,14 @@ void *thread_tcp2udt(void *_args_)
     if (!args->udt_socket){
         if ((args->udt_socket = connect_remote_udt(args)) <= 0){
             close(args->udt_socket);
+            transcriber_closed(args);
             free(args);
             return NULL;
         }
     }
 
+    udt_connection_opened(args->stats, args->udt_socket);
+
     /*******************************************************************
      * Begin proxy procedure
      ******************************************************************/
@@ -313,6 +397,7 @@ void *thread_tcp2udt(void *_args_)
     int pipefd[2];
     if (pipe(pipefd) == -1) {
         perror("pipe");
+        transcriber_closed(args);
         free(args);
         return NULL;
     }
@@ -325,6 +410,7 @@ void *thread_tcp2udt(void *_args_)
     debug("Creating tcp2pipe thread");
     if (pthread_create(&tcp2pipe_thread, NULL, tcp2pipe, tcp2pipe_args)){
         perror("unable to create tcp2pipe thread");
+        transcriber_closed(args);
         free(args);
         return NULL;
     }
@@ -339,6 +425,7 @@ void *thread_tcp2udt(void *_args_)
     void *ret;
     pthread_join(tcp2pipe_thread, &ret);
     delete cbuffer;
+    transcriber_closed(args);
 
     return NULL;
 }
@@ -24,39 +24,56 @@
  ******************************************************************************/
 #include "parcel.h"
 
+proxy_stats_t tcp2udt_stats = {0, 0};
+proxy_stats_t udt2tcp_stats = {0, 0};
+proxy_stats_t udt2file_stats = {0, 0};
+
+/* The open UDT connections of every proxy, for udt_stats() */
+typedef struct udt_connection_t {
+    UDTSOCKET udt_socket;
+    proxy_stats_t *stats;
+    struct udt_connection_t *next;
+} udt_connection_t;
+
+static udt_connection_t *udt_connections = NULL;
+static pthread_mutex_t udt_connections_lock = PTHREAD_MUTEX_INITIALIZER;
+
 
 void *udt2pipe(void *_args_)
 {
     /*
      *  udt2pipe() - Read from a UDT socket into a pipe
      *
+     *  UDT receives straight into the pipe's buffer.
      */
     udt_pipe_args_t *args = (udt_pipe_args_t*) _args_;
-    char *buffer = (char*) malloc(BUFF_SIZE);
     int read_size;
 
     while (1){
-        /* Read from UDT */
-        read_size = UDT::recv(args->udt_socket, buffer, BUFF_SIZE, 0);
+        /* Wait for space in the pipe */
+        size_t size = BUFF_SIZE;
+        char *region = args->pipe->write_region(&size);
+        if (!region){
+            debug("Failed to write to pipe.");
+            goto cleanup;
+        }
+
+        /* Read from UDT into it */
+        read_size = UDT::recv(args->udt_socket, region, (int) size, 0);
         if (UDT::ERROR == read_size) {
             if (UDT::getlasterror().getErrorCode() != 2001){
                 debug("recv: %s", UDT::getlasterror().getErrorMessage());
             }
             goto cleanup;
         }
-        debug("Read %d bytes from UDT", read_size);
-
-        /* Write to pipe */
-        debug("Writing %d bytes to pipe", read_size);
-        if (args->pipe->write(buffer, read_size) <= 0){
-            debug("Failed to write to pipe.");
-            goto cleanup;
-        }
-        debug("Writing %d bytes to pipe from UDT", read_size);
+        args->pipe->commit_write(read_size);
+        debug("Wrote %d bytes to pipe from UDT", read_size);
     }
 
  cleanup:
     debug("Exiting udt2pipe thread.");
+    /* Count the connection before UDT garbage collects it */
+    udt_connection_closed(args->udt_socket);
     args->pipe->close();
     return NULL;
 }
@@ -66,25 +83,27 @@ void *tcp2pipe(void *_args_)
     /*
      *  tcp2pipe() - Read from a TCP socket into a pipe
      *
+     *  TCP receives straight into the pipe's buffer.
      */
     tcp_pipe_args_t *args = (tcp_pipe_args_t*) _args_;
-    char *buffer = (char*) malloc(BUFF_SIZE);
     int read_size;
 
     while (1){
-        /* Read from TCP */
-        if ((read_size = read(args->tcp_socket, buffer, BUFF_SIZE)) <= 0){
-            debug("Unable to read from TCP socket.");
+        /* Wait for space in the pipe */
+        size_t size = BUFF_SIZE;
+        char *region = args->pipe->write_region(&size);
+        if (!region){
+            debug("Failed to write to pipe");
             goto cleanup;
         }
-        debug("Read %d bytes from TCP socket %d", read_size, args->tcp_socket);
 
-        /* Write to pipe */
-        if (args->pipe->write(buffer, read_size) <= 0){
-            debug("Failed to write to pipe");
+        /* Read from TCP into it */
+        if ((read_size = read(args->tcp_socket, region, size)) <= 0){
+            debug("Unable to read from TCP socket.");
             goto cleanup;
         }
-        debug("Wrote %d bytes to pipe from TCP", read_size);
+        args->pipe->commit_write(read_size);
+        debug("Wrote %d bytes to pipe from TCP socket %d", read_size, args->tcp_socket);
     }
 
  cleanup:
@@ -98,38 +117,35 @@ void *pipe2udt(void *_args_)
     /*
      *  pipe2udt() - Read from a pipe into a UDT socket
      *
+     *  UDT sends straight from the pipe's buffer, and the space is
+     *  released as soon as it has been sent.
      */
     udt_pipe_args_t *args = (udt_pipe_args_t*) _args_;
-    char *buffer = (char*) malloc(BUFF_SIZE);
-    int read_size;
-    int temp_size;
-    int this_size;
+    int sent_size;
 
     while (1){
-        /* Read from pipe */
-        if ((read_size = args->pipe->read(buffer, BUFF_SIZE)) <= 0){
+        /* Wait for data in the pipe */
+        size_t size = BUFF_SIZE;
+        char *region = args->pipe->read_region(&size);
+        if (!region){
             debug("Unable to read from pipe.");
             goto cleanup;
         }
-        debug("Read %d bytes from pipe", read_size);
-
-        /* Write to UDT */
-        int sent_size = 0;
-        debug("Writing %d bytes to UDT socket %d", read_size, args->udt_socket);
-        while (sent_size < read_size) {
-            this_size = read_size - sent_size;
-            temp_size = UDT::send(args->udt_socket, buffer + sent_size, this_size, 0);
-            if (UDT::ERROR == temp_size){
-                debug("send: %s", UDT::getlasterror().getErrorMessage());
-                goto cleanup;
-            }
-            sent_size += temp_size;
+
+        /* Write it to UDT */
+        debug("Writing %d bytes to UDT socket %d", (int) size, args->udt_socket);
+        sent_size = UDT::send(args->udt_socket, region, (int) size, 0);
+        if (UDT::ERROR == sent_size){
+            debug("send: %s", UDT::getlasterror().getErrorMessage());
+            goto cleanup;
         }
-        debug("Wrote %d bytes to UDT", read_size);
+        args->pipe->commit_read(sent_size);
+        debug("Wrote %d bytes to UDT", sent_size);
     }
 
  cleanup:
     debug("Exiting pipe2udt thread.");
+    udt_connection_closed(args->udt_socket);
     UDT::close(args->udt_socket);
     args->pipe->close();
     return NULL;
@@ -138,36 +154,31 @@ void *pipe2udt(void *_args_)
 void *pipe2tcp(void *_args_)
 {
     /*
-     *  pipe2tcp() - Read from a pipe into a UDT socket
+     *  pipe2tcp() - Read from a pipe into a TCP socket
      *
+     *  TCP sends straight from the pipe's buffer, and the space is
+     *  released as soon as it has been sent.
      */
     tcp_pipe_args_t *args = (tcp_pipe_args_t*) _args_;
-    char *buffer = (char*) malloc(BUFF_SIZE);
-    int read_size;
-    int temp_size;
-    int this_size;
+    int sent_size;
 
     while (1){
-        /* Read from pipe */
-        if ((read_size = args->pipe->read(buffer, BUFF_SIZE)) <= 0){
+        /* Wait for data in the pipe */
+        size_t size = BUFF_SIZE;
+        char *region = args->pipe->read_region(&size);
+        if (!region){
             debug("Unable to read from pipe.");
             goto cleanup;
         }
-        debug("Read %d bytes from pipe", read_size);
-
-        /* Write to UDT */
-        int sent_size = 0;
-        debug("Writing %d bytes to TCP socket %d", read_size, args->tcp_socket);
-        while (sent_size < read_size) {
-            this_size = read_size - sent_size;
-            temp_size = send(args->tcp_socket, buffer + sent_size, this_size, 0);
-            if (temp_size < 0){
-                debug("unable to write to socket:");
-                goto cleanup;
-            }
-            sent_size += temp_size;
+
+        /* Write it to TCP */
+        debug("Writing %d bytes to TCP socket %d", (int) size, args->tcp_socket);
+        if ((sent_size = send(args->tcp_socket, region, size, 0)) < 0){
+            debug("unable to write to socket:");
+            goto cleanup;
         }
-        debug("Wrote %d bytes to TCP", read_size);
+        args->pipe->commit_read(sent_size);
+        debug("Wrote %d bytes to TCP", sent_size);
     }
 
  cleanup:
@@ -176,3 +187,193 @@ void *pipe2tcp(void *_args_)
     args->pipe->close();
     return NULL;
 }
+
+void proxy_opened(proxy_stats_t *stats)
+{
+    /*
+     *  proxy_opened() - Count a newly accepted connection
+     *
+     */
+    __sync_fetch_and_add(&stats->opened, 1);
+    __sync_fetch_and_add(&stats->active, 1);
+}
+
+void proxy_closed(proxy_stats_t *stats)
+{
+    /*
+     *  proxy_closed() - Count a connection that has been closed
+     *
+     */
+    __sync_fetch_and_sub(&stats->active, 1);
+}
+
+void transcriber_closed(transcriber_args_t *args)
+{
+    /*
+     *  transcriber_closed() - Called by both transcriber threads of a
+     *  connection when they exit, the first one counts the connection
+     *  as closed
+     *
+     */
+    if (args->stats && __sync_bool_compare_and_swap(&args->closed, 0, 1)){
+        proxy_closed(args->stats);
+    }
+}
+
+static proxy_stats_t *find_proxy(const char *proxy)
+{
+    if (strcmp(proxy, "tcp2udt") == 0){
+        return &tcp2udt_stats;
+    } else if (strcmp(proxy, "udt2tcp") == 0){
+        return &udt2tcp_stats;
+    } else if (strcmp(proxy, "udt2file") == 0){
+        return &udt2file_stats;
+    }
+    return NULL;
+}
+
+EXTERN int proxy_connections(char *proxy, int *opened, int *active)
+{
+    /*
+     *  proxy_connections() - Read the connection counters of a proxy
+     *
+     */
+    proxy_stats_t *stats = find_proxy(proxy);
+    if (!stats){
+        return -1;
+    }
+    *opened = __sync_fetch_and_add(&stats->opened, 0);
+    *active = __sync_fetch_and_add(&stats->active, 0);
+    return 0;
+}
+
+static void add_counters(udt_stats_t *stats, const UDT::TRACEINFO &perf)
+{
+    /*
+     *  add_counters() - Add the packet counters of a connection
+     *
+     */
+    stats->sent_packets          += perf.pktSentTotal;
+    stats->received_packets      += perf.pktRecvTotal;
+    stats->retransmitted_packets += perf.pktRetransTotal;
+    stats->send_loss_packets     += perf.pktSndLossTotal;
+    stats->receive_loss_packets  += perf.pktRcvLossTotal;
+    stats->sent_naks             += perf.pktSentNAKTotal;
+    stats->received_naks         += perf.pktRecvNAKTotal;
+}
+
+static void add_sample(udt_stats_t *stats, const UDT::TRACEINFO &perf)
+{
+    /*
+     *  add_sample() - Add the rates, windows and buffers of a
+     *  connection, the RTT and bandwidth are summed to be averaged
+     *
+     */
+    stats->rtt_ms                   += perf.msRTT;
+    stats->bandwidth_mbps           += perf.mbpsBandwidth;
+    stats->send_mbps                += perf.mbpsSendRate;
+    stats->receive_mbps             += perf.mbpsRecvRate;
+    stats->send_period_us           += perf.usPktSndPeriod;
+    stats->flow_window              += perf.pktFlowWindow;
+    stats->congestion_window        += perf.pktCongestionWindow;
+    stats->flight_size              += perf.pktFlightSize;
+    stats->send_buffer_available    += perf.byteAvailSndBuf;
+    stats->receive_buffer_available += perf.byteAvailRcvBuf;
+}
+
+void udt_connection_opened(proxy_stats_t *stats, UDTSOCKET udt_socket)
+{
+    /*
+     *  udt_connection_opened() - Register a UDT connection of a proxy
+     *
+     */
+    if (!stats){
+        return;
+    }
+    udt_connection_t *connection = (udt_connection_t*) malloc(sizeof(udt_connection_t));
+    connection->udt_socket = udt_socket;
+    connection->stats = stats;
+    pthread_mutex_lock(&udt_connections_lock);
+    connection->next = udt_connections;
+    udt_connections = connection;
+    pthread_mutex_unlock(&udt_connections_lock);
+}
+
+void udt_connection_closed(UDTSOCKET udt_socket)
+{
+    /*
+     *  udt_connection_closed() - Unregister a UDT connection before
+     *  it is closed, adding its counters to its proxy's
+     *
+     *  Connections that are not registered are ignored, so this may
+     *  be called more than once.
+     */
+    pthread_mutex_lock(&udt_connections_lock);
+    udt_connection_t **prev = &udt_connections;
+    for (udt_connection_t *connection = udt_connections; connection;
+         connection = connection->next){
+        if (connection->udt_socket == udt_socket){
+            UDT::TRACEINFO perf;
+            if (UDT::perfmon(udt_socket, &perf, false) != UDT::ERROR){
+                add_counters(&connection->stats->closed, perf);
+            }
+            *prev = connection->next;
+            free(connection);
+            break;
+        }
+        prev = &connection->next;
+    }
+    pthread_mutex_unlock(&udt_connections_lock);
+}
+
+EXTERN int udt_stats(char *proxy, udt_stats_t *total,
+                     udt_stats_t *connections, int max)
+{
+    /*
+     *  udt_stats() - Sample the UDT connections of a proxy
+     *
+     *  The rates of each connection are measured since the previous
+     *  sample.  The packet counters of the total include the
+     *  connections that have closed, its rates, windows and buffers
+     *  are summed over the open connections, and its RTT, bandwidth
+     *  and packet sending period are averaged over them.
+     */
+    proxy_stats_t *stats = find_proxy(proxy);
+    if (!stats){
+        return -1;
+    }
+
+    pthread_mutex_lock(&udt_connections_lock);
+    *total = stats->closed;
+    total->socket = -1;
+
+    int count = 0;
+    for (udt_connection_t *connection = udt_connections; connection;
+         connection = connection->next){
+        UDT::TRACEINFO perf;
+        if (connection->stats != stats
+            || UDT::perfmon(connection->udt_socket, &perf, true) == UDT::ERROR){
+            continue;
+        }
+        add_counters(total, perf);
+        add_sample(total, perf);
+        if (count < max){
+            udt_stats_t *sample = &connections[count];
+            memset(sample, 0, sizeof(udt_stats_t));
+            sample->socket = connection->udt_socket;
+            sample->connections = 1;
+            add_counters(sample, perf);
+            add_sample(sample, perf);
+        }
+        count++;
+    }
+    pthread_mutex_unlock(&udt_connections_lock);
+
+    total->connections = count;
+    if (count){
+        total->rtt_ms /= count;
+        total->bandwidth_mbps /= count;
+        total->send_period_us /= count;
+    }
+    return count;
+}
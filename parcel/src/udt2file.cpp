@@ -0,0 +1,372 @@
+/******************************************************************************
+ *
+ * FILE    : udt2file.cpp
+ * PROJECT : parcel
+ *
+ * DESCRIPTION : This file contains functions for creating a UDT
+ *               server that accepts incoming connections and answers
+ *               HTTP range requests with files from a local
+ *               directory, without an HTTP server behind it.
+ *
+ * LICENSE : Licensed under the Apache License, Version 2.0 (the
+ *           "License"); you may not use this file except in
+ *           compliance with the License.  You may obtain a copy of
+ *           the License at
+ *
+ *               http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *           Unless required by applicable law or agreed to in
+ *           writing, software distributed under the License is
+ *           distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+ *           CONDITIONS OF ANY KIND, either express or implied.  See
+ *           the License for the specific language governing
+ *           permissions and limitations under the License.)
+ *
+ ******************************************************************************/
+
+#include "parcel.h"
+#include <algorithm>
+#include <cctype>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+/* The largest request header accepted */
+#define REQUEST_SIZE 16384
+/* Files are mapped and sent a window of this many bytes at a time */
+#define MAP_WINDOW_SIZE 64*1024*1024
+
+
+EXTERN int udt2file_start(char *local_host, char *local_port,
+                          char *directory)
+{
+    /*
+     *  udt2file_start() - starts a UDT file server
+     *
+     *  Starts a file server listening on local_host:local_port.
+     *  Incoming connections get their own thread that serves files
+     *  from directory.
+     */
+
+    int mss = MSS;
+    int udt_buffer_size = BUFF_SIZE*2;
+    int udp_buffer_size = BUFF_SIZE;
+
+    return udt2file_start_configurable(local_host,
+                                       local_port,
+                                       directory,
+                                       mss,
+                                       udt_buffer_size,
+                                       udp_buffer_size,
+                                       NULL);
+}
+
+
+EXTERN int udt2file_start_configurable(char *local_host,
+                                       char *local_port,
+                                       char *directory,
+                                       int mss,
+                                       int udt_buffer_size,
+                                       int udp_buffer_size,
+                                       char *congestion_control)
+{
+    /*
+     *  udt2file_start_configurable() - starts a configurable UDT file
+     *  server
+     *
+     *  mss             : maximum segment size
+     *  udt_buffer_size : UDT buffer size in bytes
+     *  udp_buffer_size : UDP buffer size in bytes
+     *  congestion_control : udt, tcp or blast:MBPS, see cc.cpp, or
+     *                    NULL for udt
+     *
+     */
+    log("File server binding to local UDT socket [%s:%s] serving [%s]",
+        local_host, local_port, directory);
+    debug("MSS            : %d", mss);
+    debug("UDT_BUFFER_SIZE: %d", udt_buffer_size);
+    debug("UDP_BUFFER_SIZE: %d", udp_buffer_size);
+    debug("CONGESTION     : %s", congestion_control);
+
+    struct stat info;
+    if (stat(directory, &info) != 0 || !S_ISDIR(info.st_mode)){
+        error("not a directory: [%s]", directory);
+        return -1;
+    }
+
+    UDTSOCKET udt_socket = listen_udt(local_port, mss,
+                                      udt_buffer_size, udp_buffer_size,
+                                      congestion_control);
+    if (udt_socket == UDT::INVALID_SOCK){
+        return -1;
+    }
+    log("File server bound to local UDT socket [%s:%s] serving [%s]",
+        local_host, local_port, directory);
+
+    log("Creating udt2file server thread");
+    pthread_t udt2file_server_thread;
+    file_server_args_t *args = (file_server_args_t*) malloc(sizeof(file_server_args_t));
+    args->udt_socket = udt_socket;
+    args->directory  = strdup(directory);
+    if (pthread_create(&udt2file_server_thread, NULL, udt2file_accept_clients, args)){
+        error("unable to create udt2file server thread");
+        free(args->directory);
+        free(args);
+        return -1;
+    }
+
+    return 0;
+}
+
+EXTERN void *udt2file_accept_clients(void *_args_)
+{
+    /*
+     *  udt2file_accept_clients() - Accepts incoming UDT clients
+     *
+     */
+    file_server_args_t *args = (file_server_args_t*) _args_;
+
+    while (1){
+        UDTSOCKET client_socket;
+        sockaddr_storage clientaddr;
+        int addrlen = sizeof(clientaddr);
+
+        /* Wait for the next connection */
+        debug("Accepting incoming UDT connections");
+        if ((client_socket = UDT::accept(args->udt_socket, (sockaddr*)&clientaddr, &addrlen))
+            == UDT::INVALID_SOCK){
+            error("accept: %s", UDT::getlasterror().getErrorMessage());
+            return 0;
+        }
+        log("New UDT connection");
+        proxy_opened(&udt2file_stats);
+        udt_connection_opened(&udt2file_stats, client_socket);
+
+        /* The client thread shares the directory with the server */
+        file_server_args_t *client_args = (file_server_args_t*) malloc(sizeof(file_server_args_t));
+        client_args->udt_socket = client_socket;
+        client_args->directory  = args->directory;
+
+        pthread_t client_thread;
+        if (pthread_create(&client_thread, NULL, thread_udt2file, client_args)){
+            error("Unable to create udt2file thread");
+            udt_connection_closed(client_socket);
+            UDT::close(client_socket);
+            proxy_closed(&udt2file_stats);
+            free(client_args);
+        } else {
+            pthread_detach(client_thread);
+        }
+    }
+}
+
+int send_all(UDTSOCKET udt_socket, const char *buffer, int64_t size)
+{
+    /*
+     *  send_all() - Send size bytes of buffer over UDT
+     *
+     */
+    int64_t sent_size = 0;
+    int temp_size;
+
+    while (sent_size < size){
+        temp_size = UDT::send(udt_socket, buffer + sent_size,
+                              (int) min(size - sent_size, (int64_t) BUFF_SIZE), 0);
+        if (UDT::ERROR == temp_size){
+            debug("send: %s", UDT::getlasterror().getErrorMessage());
+            return -1;
+        }
+        sent_size += temp_size;
+    }
+    return 0;
+}
+
+static int send_range(UDTSOCKET udt_socket, int fd, int64_t begin, int64_t end)
+{
+    /*
+     *  send_range() - Send bytes [begin, end) of file fd over UDT
+     *
+     *  The file is mapped a window at a time and sent straight from
+     *  the page cache, it is never copied into a buffer of our own.
+     */
+    int64_t page_size = sysconf(_SC_PAGESIZE);
+
+    while (begin < end){
+        int64_t offset = begin - begin % page_size;
+        int64_t length = min(end - offset, (int64_t) MAP_WINDOW_SIZE);
+        char *map = (char*) mmap(NULL, length, PROT_READ, MAP_SHARED, fd, offset);
+        if (map == MAP_FAILED){
+            perror("mmap");
+            return -1;
+        }
+        madvise(map, length, MADV_SEQUENTIAL);
+        int ret = send_all(udt_socket, map + (begin - offset),
+                           length - (begin - offset));
+        munmap(map, length);
+        if (ret < 0){
+            return -1;
+        }
+        begin = offset + length;
+    }
+    return 0;
+}
+
+static int send_status(UDTSOCKET udt_socket, int status, const char *reason)
+{
+    /*
+     *  send_status() - Send an empty response
+     *
+     */
+    char response[128];
+    int size = snprintf(response, sizeof(response),
+                        "HTTP/1.1 %d %s\r\nContent-Length: 0\r\n\r\n",
+                        status, reason);
+    return send_all(udt_socket, response, size);
+}
+
+int serve_file_request(UDTSOCKET udt_socket,
+                       const char *directory,
+                       const string &request)
+{
+    /*
+     *  serve_file_request() - Answer one HTTP request
+     *
+     *  Sends the whole file named by the request path, or the range
+     *  of it asked for by a "Range: bytes=begin-end" header or the
+     *  suffix of it asked for by "Range: bytes=-length", with the
+     *  Content-Length and Content-Disposition headers that parcel
+     *  clients expect.  Returns -1 if the connection should be closed.
+     */
+
+    /* Parse the request line, e.g. GET /file_id HTTP/1.1 */
+    size_t method_end = request.find(' ');
+    size_t target_end = request.find(' ', method_end + 1);
+    if (method_end == string::npos || target_end == string::npos){
+        send_status(udt_socket, 400, "Bad Request");
+        return -1;
+    }
+    string method = request.substr(0, method_end);
+    string target = request.substr(method_end + 1, target_end - method_end - 1);
+    if (method != "GET" && method != "HEAD"){
+        return send_status(udt_socket, 405, "Method Not Allowed");
+    }
+
+    /* Only files directly in the directory are served */
+    target = target.substr(0, target.find('?'));
+    string name = target.substr(target.rfind('/') + 1);
+    if (name.empty() || name == "." || name == ".."){
+        return send_status(udt_socket, 404, "Not Found");
+    }
+    string path = string(directory) + "/" + name;
+    debug("%s %s", method.c_str(), path.c_str());
+
+    int fd = open(path.c_str(), O_RDONLY);
+    struct stat info;
+    if (fd < 0 || fstat(fd, &info) != 0 || !S_ISREG(info.st_mode)){
+        if (fd >= 0){
+            close(fd);
+        }
+        return send_status(udt_socket, 404, "Not Found");
+    }
+    int64_t size = info.st_size;
+    int64_t begin = 0;
+    int64_t end = size;
+
+    /* Find the range header, header names are case insensitive */
+    string headers = request;
+    transform(headers.begin(), headers.end(), headers.begin(), ::tolower);
+    size_t range = headers.find("\r\nrange:");
+    char content_range[128] = "";
+    int status = 200;
+    if (range != string::npos){
+        long long first = 0, last = -1;
+        size_t spec = headers.find("bytes=", range);
+        const char *bytes = spec == string::npos ? NULL : headers.c_str() + spec + 6;
+        int satisfiable;
+        if (bytes && *bytes == '-'){
+            /* A suffix range, "bytes=-N" is the last N bytes */
+            satisfiable = sscanf(bytes, "-%lld", &last) == 1 && last > 0 && size > 0;
+            begin = max((int64_t) 0, size - (int64_t) last);
+        } else {
+            int count = bytes ? sscanf(bytes, "%lld-%lld", &first, &last) : 0;
+            satisfiable = count >= 1 && first >= 0 && first < size
+                && (count == 1 || last >= first);
+            begin = first;
+            end = count == 2 ? min((int64_t) last + 1, size) : size;
+        }
+        if (!satisfiable){
+            close(fd);
+            return send_status(udt_socket, 416, "Range Not Satisfiable");
+        }
+        status = 206;
+        snprintf(content_range, sizeof(content_range),
+                 "Content-Range: bytes %lld-%lld/%lld\r\n",
+                 (long long) begin, (long long) end - 1, (long long) size);
+    }
+
+    /* Send the headers and then the file */
+    char response[REQUEST_SIZE];
+    int response_size = snprintf(
+        response, sizeof(response),
+        "HTTP/1.1 %d %s\r\n"
+        "Content-Length: %lld\r\n"
+        "Content-Disposition: attachment; filename=%s\r\n"
+        "Accept-Ranges: bytes\r\n"
+        "%s"
+        "\r\n",
+        status, status == 206 ? "Partial Content" : "OK",
+        (long long) (end - begin), name.c_str(), content_range);
+    int ret = send_all(udt_socket, response, min(response_size, REQUEST_SIZE - 1));
+    if (ret == 0 && method == "GET" && end > begin){
+        ret = send_range(udt_socket, fd, begin, end);
+    }
+    close(fd);
+    return ret;
+}
+
+void *thread_udt2file(void *_args_)
+{
+    /*
+     *  thread_udt2file() - Answer the requests of one client
+     *
+     *  Requests are read until the client closes the connection, so
+     *  that clients can keep connections alive between ranges.
+     */
+    file_server_args_t *args = (file_server_args_t*) _args_;
+    char buffer[4096];
+    string pending;
+    int read_size;
+
+    while (1){
+        /* Read until the end of the request headers */
+        size_t header_end;
+        while ((header_end = pending.find("\r\n\r\n")) == string::npos){
+            if (pending.size() > REQUEST_SIZE){
+                send_status(args->udt_socket, 431, "Request Header Fields Too Large");
+                goto cleanup;
+            }
+            read_size = UDT::recv(args->udt_socket, buffer, sizeof(buffer), 0);
+            if (UDT::ERROR == read_size){
+                if (UDT::getlasterror().getErrorCode() != 2001){
+                    debug("recv: %s", UDT::getlasterror().getErrorMessage());
+                }
+                goto cleanup;
+            }
+            pending.append(buffer, read_size);
+        }
+        string request = pending.substr(0, header_end + 2);
+        pending.erase(0, header_end + 4);
+
+        if (serve_file_request(args->udt_socket, args->directory, request) < 0){
+            goto cleanup;
+        }
+    }
+
+ cleanup:
+    debug("Exiting udt2file thread.");
+    udt_connection_closed(args->udt_socket);
+    UDT::close(args->udt_socket);
+    proxy_closed(&udt2file_stats);
+    free(args);
+    return NULL;
+}
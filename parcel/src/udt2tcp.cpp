@@ -48,7 +48,9 @@ EXTERN int udt2tcp_start(char *local_host, char *local_port,
                                       remote_port,
                                       mss,
                                       udt_buffer_size,
-                                      udp_buffer_size);
+                                      udp_buffer_size,
+                                      1,
+                                      NULL);
 
 }
 
@@ -59,7 +61,9 @@ EXTERN int udt2tcp_start_configurable(char *local_host,
                                       char *remote_port,
                                       int mss,
                                       int udt_buffer_size,
-                                      int udp_buffer_size)
+                                      int udp_buffer_size,
+                                      int stripes,
+                                      char *congestion_control)
 {
     /*
      *  udt2tcp_start_configurable() - starts a configurable UDT proxy
@@ -72,6 +76,11 @@ EXTERN int udt2tcp_start_configurable(char *local_host,
      *  mss             : maximum segment size
      *  udt_buffer_size : UDT buffer size in bytes
      *  udp_buffer_size : UDP buffer size in bytes
+     *  stripes         : more than 1 if the clients are tcp2udt
+     *                    proxies that stripe their connections, the
+     *                    number of stripes is given by each client
+     *  congestion_control : udt, tcp or blast:MBPS, see cc.cpp, or
+     *                    NULL for udt
      *
      */
     log("Proxy binding to local UDT socket [%s:%s] to remote TCP [%s:%s]",
@@ -79,12 +88,56 @@ EXTERN int udt2tcp_start_configurable(char *local_host,
     debug("MSS            : %d", mss);
     debug("UDT_BUFFER_SIZE: %d", udt_buffer_size);
     debug("UDP_BUFFER_SIZE: %d", udp_buffer_size);
+    debug("STRIPES        : %d", stripes);
+    debug("CONGESTION     : %s", congestion_control);
 
+    UDTSOCKET udt_socket = listen_udt(local_port, mss,
+                                      udt_buffer_size, udp_buffer_size,
+                                      congestion_control);
+    if (udt_socket == UDT::INVALID_SOCK){
+        return -1;
+    }
+    log("Proxy bound to local UDT socket [%s:%s] to remote TCP [%s:%s]",
+        local_host, local_port, remote_host, remote_port);
+
+    log("Creating pipe2tcp server thread");
+    pthread_t udt2tcp_server_thread;
+    server_args_t *args = (server_args_t*) malloc(sizeof(server_args_t));
+    args->remote_host = strdup(remote_host);
+    args->remote_port = strdup(remote_port);
+    args->udt_socket  = udt_socket;
+    args->stripes     = stripes;
+    if (pthread_create(&udt2tcp_server_thread, NULL, udt2tcp_accept_clients, args)){
+        error("unable to create udt2tcp server thread");
+        free(args);
+        return -1;
+    }
+
+    return 0;
+}
+
+UDTSOCKET listen_udt(char *local_port,
+                     int mss,
+                     int udt_buffer_size,
+                     int udp_buffer_size,
+                     const char *congestion_control)
+{
+    /*
+     *  listen_udt() - Creates a UDT server socket
+     *
+     *  Binds a UDT socket to local_port with the given options and
+     *  listens on it.  The connections it accepts use the given
+     *  congestion control.  Returns UDT::INVALID_SOCK on failure.
+     */
     addrinfo hints;
     addrinfo* res;
     int reuseaddr = 1;
     UDTSOCKET udt_socket;
 
+    if (!valid_congestion_control(congestion_control)){
+        return UDT::INVALID_SOCK;
+    }
+
     /*******************************************************************
      * Establish server socket
      ******************************************************************/
@@ -96,7 +149,7 @@ EXTERN int udt2tcp_start_configurable(char *local_host,
     hints.ai_socktype = SOCK_STREAM;
     if (getaddrinfo(NULL, local_port, &hints, &res) != 0){
         error("illegal port number or port is busy: [%s]", local_port);
-        return -1;
+        return UDT::INVALID_SOCK;
     }
 
     /* Create the server socket */
@@ -107,14 +160,16 @@ EXTERN int udt2tcp_start_configurable(char *local_host,
     UDT::setsockopt(udt_socket, 0, UDT_RCVBUF, &udt_buffer_size, sizeof(int));
     UDT::setsockopt(udt_socket, 0, UDP_RCVBUF, &udp_buffer_size, sizeof(int));
     UDT::setsockopt(udt_socket, 0, UDT_REUSEADDR, &reuseaddr, sizeof(int));
+    if (set_congestion_control(udt_socket, congestion_control)){
+        UDT::close(udt_socket);
+        return UDT::INVALID_SOCK;
+    }
 
     /* Bind the server socket */
     if (UDT::bind(udt_socket, res->ai_addr, res->ai_addrlen) == UDT::ERROR){
         error("bind: %s", UDT::getlasterror().getErrorMessage());
-        return -1;
+        return UDT::INVALID_SOCK;
     }
-    log("Proxy bound to local UDT socket [%s:%s] to remote TCP [%s:%s]",
-        local_host, local_port, remote_host, remote_port);
 
     /* We no longer need this address information */
     freeaddrinfo(res);
@@ -123,22 +178,10 @@ EXTERN int udt2tcp_start_configurable(char *local_host,
     log("Calling UDT socket listen");
     if (UDT::listen(udt_socket, 10) == UDT::ERROR){
         error(": listen: %s", UDT::getlasterror().getErrorMessage());
-        return -1;
+        return UDT::INVALID_SOCK;
     }
 
-    log("Creating pipe2tcp server thread");
-    pthread_t udt2tcp_server_thread;
-    server_args_t *args = (server_args_t*) malloc(sizeof(server_args_t));
-    args->remote_host = strdup(remote_host);
-    args->remote_port = strdup(remote_port);
-    args->udt_socket  = udt_socket;
-    if (pthread_create(&udt2tcp_server_thread, NULL, udt2tcp_accept_clients, args)){
-        error("unable to create udt2tcp server thread");
-        free(args);
-        return -1;
-    }
-
-    return 0;
+    return udt_socket;
 }
 
 EXTERN void *udt2tcp_accept_clients(void *_args_)
@@ -170,6 +213,23 @@ EXTERN void *udt2tcp_accept_clients(void *_args_)
         transcriber_args->udt_socket  = client_socket;
         transcriber_args->remote_host = args->remote_host;
         transcriber_args->remote_port = args->remote_port;
+        transcriber_args->stats       = &udt2tcp_stats;
+        transcriber_args->closed      = 0;
+        transcriber_args->pool        = NULL;
+
+        /* Stripes are counted as a connection once the session is whole */
+        if (args->stripes > 1){
+            pthread_t stripe_thread;
+            if (pthread_create(&stripe_thread, NULL, thread_stripe2tcp, transcriber_args)){
+                error("Unable to create stripe thread");
+                UDT::close(client_socket);
+                free(transcriber_args);
+            } else {
+                pthread_detach(stripe_thread);
+            }
+            continue;
+        }
+        proxy_opened(transcriber_args->stats);
 
         /* Create tcp2udt thread */
         pthread_t tcp_thread;
@@ -273,6 +333,7 @@ void *thread_udt2tcp(void *_args_)
      */
     if (!args->tcp_socket){
         if ((args->tcp_socket = connect_remote_tcp(args)) < 0){
+            transcriber_closed(args);
             free(args);
             return NULL;
         }
@@ -282,6 +343,7 @@ void *thread_udt2tcp(void *_args_)
     int pipefd[2];
     if (pipe(pipefd) == -1) {
         perror("pipe");
+        transcriber_closed(args);
         free(args);
         return NULL;
     }
@@ -299,6 +361,7 @@ void *thread_udt2tcp(void *_args_)
     debug("Creating udt2pipe thread");
     if (pthread_create(&udt2pipe_thread, NULL, udt2pipe, udt2pipe_args)){
         error("unable to create udt2pipe thread");
+        transcriber_closed(args);
         free(args);
         return NULL;
     }
@@ -315,6 +378,7 @@ void *thread_udt2tcp(void *_args_)
     pthread_join(udt2pipe_thread, &ret);
 
     delete cbuffer;
+    transcriber_closed(args);
 
     return NULL;
 }
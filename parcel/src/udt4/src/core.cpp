@@ -1578,9 +1578,12 @@ int64_t CUDT::recvfile(fstream& ofs, int64_t& offset, int64_t size, int block)
 
 void CUDT::sample(CPerfMon* perf, bool clear)
 {
+   // a connection broken by its peer or by a timeout, which also marks it
+   // closing, can still be sampled for its final counters, but not one
+   // that close() is tearing down
    if (!m_bConnected)
       throw CUDTException(2, 2, 0);
-   if (m_bBroken || m_bClosing)
+   if (m_bClosing && !m_bBroken)
       throw CUDTException(2, 1, 0);
 
    uint64_t currtime = CTimer::getTime();
@@ -0,0 +1,193 @@
+from .log import get_logger
+
+import cProfile
+import glob
+import json
+import os
+import pstats
+import threading
+import time
+
+# Logging
+log = get_logger('tracing')
+
+# The trace of this process, None unless tracing is enabled
+_trace = None
+
+
+class Trace(object):
+
+    def __init__(self, path):
+        """Records spans as complete events of the Trace Event Format,
+        which chrome://tracing and Perfetto open.  Every process that
+        inherits the trace writes its own events to ``<path>.<pid>``,
+        which :func:`finish_trace` merges into ``path``.
+
+        """
+
+        self.path = path
+        self.pid = os.getpid()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name, category, start, end, args):
+        event = dict(
+            name=name, cat=category, ph='X', ts=start * 1e6,
+            dur=(end - start) * 1e6, pid=os.getpid(),
+            tid=threading.current_thread().ident, args=args)
+        with self.lock:
+            if event['pid'] != self.pid:
+                # Forked into a worker, the parent writes its own events
+                self.pid, self.events = event['pid'], []
+            self.events.append(event)
+
+    def flush(self):
+        with self.lock:
+            if not self.events:
+                return
+            with open('{}.{}'.format(self.path, os.getpid()), 'a') as f:
+                for event in self.events:
+                    f.write(json.dumps(event) + '\n')
+            self.events = []
+
+
+class Span(object):
+
+    __slots__ = ('name', 'category', 'args', 'start')
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if _trace is not None:
+            _trace.add(self.name, self.category, self.start, time.time(),
+                       self.args)
+
+
+class NoSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+def _parts(path):
+    """The files each process wrote its part of ``path`` to.
+
+    """
+
+    return glob.glob(path + '.[0-9]*')
+
+
+def enabled():
+    return _trace is not None
+
+
+def span(name, category='parcel', **args):
+    """Time the body of a ``with`` statement as a span of the trace.
+    When tracing is disabled a shared object that does nothing is
+    returned.
+
+    """
+
+    if _trace is None:
+        return NO_SPAN
+    return Span(name, category, args)
+
+
+def record(name, started, finished, category='parcel', **args):
+    """Record a span that has already finished.
+
+    """
+
+    if _trace is not None:
+        _trace.add(name, category, started, finished, args)
+
+
+def start_trace(path):
+    """Trace this process and the workers it starts from now on.
+
+    """
+
+    global _trace
+    map(os.remove, _parts(path))
+    _trace = Trace(path)
+
+
+def flush_trace():
+    """Write this process's events, called by workers as they exit.
+
+    """
+
+    if _trace is not None:
+        _trace.flush()
+
+
+def finish_trace():
+    """Stop tracing and merge the events of every process into one JSON
+    trace at the path given to :func:`start_trace`.
+
+    """
+
+    global _trace
+    if _trace is None:
+        return
+    _trace.flush()
+    path, _trace = _trace.path, None
+    events = []
+    for part in _parts(path):
+        with open(part) as f:
+            events.extend(json.loads(line) for line in f)
+        os.remove(part)
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+    log.info('Trace of {} spans written to {}'.format(len(events), path))
+
+
+def start_profiles(path):
+    """Remove what is left of an earlier profile at ``path``.
+
+    """
+
+    map(os.remove, _parts(path))
+
+
+def profiled(path, target, *args):
+    """Run ``target(*args)`` with cProfile, and write the statistics to
+    ``<path>.<pid>.<thread>`` for :func:`merge_profiles`.
+
+    """
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(target, *args)
+    finally:
+        profile.dump_stats('{}.{}.{}'.format(
+            path, os.getpid(), threading.current_thread().ident))
+
+
+def merge_profiles(path):
+    """Merge the statistics of every profiled worker into ``path``, which
+    can be read with :mod:`pstats`.
+
+    """
+
+    parts = _parts(path)
+    if not parts:
+        return
+    stats = pstats.Stats(*parts)
+    stats.dump_stats(path)
+    for part in parts:
+        os.remove(part)
+    log.info('Profile of {} workers written to {}'.format(len(parts), path))
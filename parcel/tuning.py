@@ -0,0 +1,72 @@
+from .log import get_logger
+
+# Logging
+log = get_logger('tuning')
+
+# Seconds of throughput each connection count is judged on
+TUNE_INTERVAL = 5
+
+# The relative gain in throughput an added connection must bring
+MIN_GAIN = 0.05
+
+# Intervals to keep a connection count before probing for more
+HOLD_INTERVALS = 6
+
+
+class ConnectionTuner(object):
+
+    def __init__(self, n_procs, min_procs=1, max_procs=32):
+        """Chooses the number of connections to download with by hill
+        climbing on total throughput.  Connections are added while
+        each addition still pays for itself, an addition that does not
+        is undone, and connections are shed whenever segments fail.
+        After settling, more connections are probed for every
+        ``HOLD_INTERVALS`` intervals.
+
+        :param int n_procs: The number of connections to start with
+        :param int min_procs: The fewest connections to use
+        :param int max_procs: The most connections to use
+
+        """
+
+        self.min_procs = max(1, min_procs)
+        self.max_procs = max(self.min_procs, max_procs)
+        self.n_procs = self.clamp(n_procs)
+        # The last probe for more connections and the throughput before it
+        self.step = 0
+        self.previous = None
+        self.held = HOLD_INTERVALS
+
+    def clamp(self, n_procs):
+        return min(self.max_procs, max(self.min_procs, n_procs))
+
+    def update(self, throughput, errors=0):
+        """Choose the number of connections for the next interval.
+
+        :param float throughput:
+            Bytes per second downloaded over the last interval with
+            ``self.n_procs`` connections
+        :param int errors: The number of segments that failed
+        :returns: The number of connections to use
+
+        """
+
+        probe = False
+        if errors:
+            change = -max(1, self.n_procs / 4)
+        elif self.step and throughput < self.previous * (1 + MIN_GAIN):
+            change = -self.step
+        elif self.step or self.held >= HOLD_INTERVALS:
+            change, probe = max(1, self.n_procs / 4), True
+        else:
+            change = 0
+
+        n_procs = self.clamp(self.n_procs + change)
+        if n_procs == self.n_procs:
+            self.step, self.held = 0, self.held + 1
+        else:
+            self.step = n_procs - self.n_procs if probe else 0
+            self.held = 0
+        self.previous = throughput
+        self.n_procs = n_procs
+        return n_procs
@@ -1,5 +1,5 @@
 from .client import Client
-from .cparcel import lib
+from .cparcel import lib, log_udt_stats_every, BUFFER_SIZE, MSS
 from .log import get_logger
 
 import urlparse
@@ -11,15 +11,38 @@ log = get_logger('client')
 class UDTClient(Client):
 
     def __init__(self, proxy_host, proxy_port, remote_uri,
-                 external_proxy=False, *args, **kwargs):
-        if not remote_uri.startswith('http'):
-            remote_uri = 'https://{}'.format(remote_uri)
-        if not external_proxy:
-            # Create a local UDT proxy that translates TCP to UDT
-            self.start_proxy_server(proxy_host, proxy_port, remote_uri)
-        local_uri = self.construct_local_uri(
-            proxy_host, proxy_port, remote_uri)
-        super(UDTClient, self).__init__(local_uri, *args, **kwargs)
+                 external_proxy=False, stripes=1, stripe_hosts=None,
+                 pool_size=None, udt_stats_interval=None,
+                 congestion_control=None, *args, **kwargs):
+        # Each connection to a proxy is striped over this many UDT
+        # connections, bound to the stripe_hosts in turn
+        self.stripes = stripes
+        self.stripe_hosts = stripe_hosts
+        # Each proxy keeps this many UDT connections warm, by default
+        # one for every connection the download makes
+        if pool_size is None:
+            pool_size = kwargs.get('n_procs', 1) * stripes
+        self.pool_size = pool_size
+        # The UDT congestion control algorithm of the local proxy, it
+        # governs what the proxy sends, the server's governs downloads
+        self.congestion_control = congestion_control
+        # Each mirror is reached through its own proxy, on the ports
+        # following proxy_port
+        local_uris = []
+        remote_uris = [remote_uri] + list(kwargs.get('mirrors', []))
+        for i, remote_uri in enumerate(remote_uris):
+            port = int(proxy_port) + i
+            if not remote_uri.startswith('http'):
+                remote_uri = 'https://{}'.format(remote_uri)
+            if not external_proxy:
+                # Create a local UDT proxy that translates TCP to UDT
+                self.start_proxy_server(proxy_host, port, remote_uri)
+            local_uris.append(self.construct_local_uri(
+                proxy_host, port, remote_uri))
+        kwargs['mirrors'] = local_uris[1:]
+        if udt_stats_interval and not external_proxy:
+            log_udt_stats_every(udt_stats_interval)
+        super(UDTClient, self).__init__(local_uris[0], *args, **kwargs)
 
     def construct_local_uri(self, proxy_host, proxy_port, remote_uri):
         """Given proxy settings and remote_uri, construct the uri where the
@@ -41,6 +64,12 @@ class UDTClient(Client):
         port = p.port or 9000
         log.info('Binding proxy server {}:{} -> {}:{}'.format(
             str(proxy_host), str(proxy_port), str(p.hostname), str(port)))
-        proxy = lib.tcp2udt_start(
-            str(proxy_host), str(proxy_port), str(p.hostname), str(port))
+        if self.stripes > 1:
+            log.info('Striping connections over {} UDT connections'.format(
+                self.stripes))
+        proxy = lib.tcp2udt_start_configurable(
+            str(proxy_host), str(proxy_port), str(p.hostname), str(port),
+            MSS, BUFFER_SIZE*2, BUFFER_SIZE,
+            self.stripes, self.stripe_hosts, self.pool_size,
+            self.congestion_control)
         assert proxy == 0, 'Proxy failed to start'
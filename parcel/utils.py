@@ -1,12 +1,19 @@
+from .const import RETRY_BACKOFF, MAX_RETRY_BACKOFF
 from .log import get_logger
+from .portability import OS_WINDOWS, OS_LINUX
 
 from contextlib import contextmanager
 from progressbar import ProgressBar, Percentage, Bar, ETA, FileTransferSpeed
+import ctypes
+import ctypes.util
 import hashlib
 import mmap
 import os
+import random
 import requests
 import stat
+import string
+import tempfile
 
 # Logging
 log = get_logger('utils')
@@ -78,19 +85,118 @@ def read_offset(path, offset, size):
         raise Exception('Unable to read offset: {}'.format(str(e)))
 
 
-def set_file_length(path, length):
+def _load_fallocate():
+    """Load ``fallocate(2)`` from libc.  Unlike ``posix_fallocate`` it
+    fails on filesystems that can not allocate blocks instead of
+    writing zeros to every one of them.
+
+    """
+
+    if not OS_LINUX:
+        return None
     try:
-        if os.path.isfile(path) and os.path.getsize(path) == length:
-            return
-        f = open(path, 'wb')
-        f.seek(length-1)
-        f.write('\0')
-        f.truncate()
-        f.close()
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = libc.fallocate64
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int,
+                          ctypes.c_int64, ctypes.c_int64)
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _load_fallocate()
+
+
+def preallocate(path, length):
+    """Allocate the blocks of the first ``length`` bytes of ``path``
+    without changing its contents, so that chunks written out of order
+    land in contiguous extents instead of fragmenting a sparse file.
+
+    :returns: True if the blocks were allocated
+
+    """
+
+    if _fallocate is None or not length:
+        return False
+    fd = os.open(path, os.O_RDWR)
+    try:
+        if _fallocate(fd, 0, 0, length) != 0:
+            log.debug('Unable to preallocate {}: {}'.format(
+                path, os.strerror(ctypes.get_errno())))
+            return False
+    finally:
+        os.close(fd)
+    return True
+
+
+def set_file_length(path, length, allocate=True):
+    """Give ``path`` a length of ``length`` bytes, creating it if
+    necessary.
+
+    :param bool allocate:
+        Also preallocate the file's blocks where the filesystem
+        supports it, see :func:`preallocate`
+
+    """
+
+    try:
+        if not (os.path.isfile(path) and os.path.getsize(path) == length):
+            f = open(path, 'wb')
+            f.seek(length-1)
+            f.write('\0')
+            f.truncate()
+            f.close()
+        if allocate:
+            preallocate(path, length)
     except Exception as e:
         raise Exception('Unable to set file length: {}'.format(str(e)))
 
 
+def replace_file(src, dst):
+    """Rename ``src`` to ``dst``, replacing ``dst`` if it exists.  This
+    could fail if the two are on different devices.
+
+    """
+
+    if OS_WINDOWS and os.path.exists(dst):
+        # If we're on windows, there's not much we can do here
+        # except stash the old file, rename the new one,
+        # and back up if there is a problem.
+        old_path = os.path.join(tempfile.gettempdir(), ''.join(
+            random.choice(string.ascii_lowercase + string.digits)
+            for _ in range(10)))
+        try:
+            # stash the old file
+            os.rename(dst, old_path)
+            # move the new file into place
+            os.rename(src, dst)
+            # if no exception, then delete the old stash
+            os.remove(old_path)
+        except Exception as msg:
+            log.error('Unable to replace file: {}'.format(msg))
+            try:
+                os.rename(old_path, dst)
+            except:
+                pass
+            raise
+    else:
+        # If we're not on windows, then we'll just try to
+        # atomically rename the file
+        os.rename(src, dst)
+
+
+def retry_delay(failures):
+    """Seconds to wait before retrying after the given number of
+    consecutive failures: exponential backoff with full jitter, so
+    that connections failing together do not all retry at once.
+
+    """
+
+    return random.uniform(
+        0, min(MAX_RETRY_BACKOFF, RETRY_BACKOFF * 2 ** (failures - 1)))
+
+
 def get_file_type(path):
     try:
         mode = os.stat(path).st_mode
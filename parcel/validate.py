@@ -0,0 +1,91 @@
+from .const import MB
+from .digests import get_digest
+from .portability import OS_WINDOWS
+
+from progressbar import ProgressBar, Percentage, Bar, ETA
+import mmap
+import multiprocessing
+
+if OS_WINDOWS:
+    from multiprocessing.pool import ThreadPool as Pool
+else:
+    from multiprocessing import Pool
+
+# Bytes of segments checked by each task of the validation pool
+BATCH_SIZE = 256 * MB
+
+
+def check_segments(task):
+    """Check a batch of segments of a file against their recorded
+    digests.  Segments are hashed straight out of a read-only memory
+    map of the file without copying them.
+
+    :param tuple task: ``(path, digest name, [(begin, end, digest)])``
+    :returns: ``(bytes checked, [(begin, end)] of corrupt segments)``
+
+    """
+
+    path, name, segments = task
+    digest = get_digest(name)
+    corrupt, checked = [], 0
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for begin, end, expected in segments:
+                view = buffer(data, begin, end - begin)
+                if digest(view) != expected:
+                    corrupt.append((begin, end))
+                checked += end - begin
+        finally:
+            data.close()
+    return checked, corrupt
+
+
+def batches(segments, batch_size=BATCH_SIZE):
+    """Group segments into consecutive batches of about ``batch_size``
+    bytes.
+
+    """
+
+    batch, size = [], 0
+    for segment in segments:
+        batch.append(segment)
+        size += segment[1] - segment[0]
+        if size >= batch_size:
+            yield batch
+            batch, size = [], 0
+    if batch:
+        yield batch
+
+
+def find_corrupt_segments(path, name, segments, label, processes=None):
+    """Check the digests of ``segments`` of the file at ``path`` with a
+    pool of processes (threads on Windows).
+
+    :param str path: The path of the file
+    :param str name: The name of the digest, see :data:`parcel.digests.DIGESTS`
+    :param list segments: ``(begin, end, digest)`` tuples
+    :param str label: The name of the file shown in the progress bar
+    :param int processes: Defaults to the number of CPUs
+    :returns: A list of ``(begin, end)`` of the corrupt segments
+
+    """
+
+    tasks = [(path, name, batch) for batch in batches(segments)]
+    processes = min(processes or multiprocessing.cpu_count(), len(tasks))
+    pbar = ProgressBar(widgets=[
+        'Checksumming {}: '.format(label), Percentage(), ' ',
+        Bar(marker='#', left='[', right=']'), ' ', ETA()],
+        maxval=sum(end - begin for begin, end, _ in segments)).start()
+    pool = Pool(max(1, processes))
+    corrupt, checked = [], 0
+    try:
+        for size, bad in pool.imap_unordered(check_segments, tasks):
+            corrupt.extend(bad)
+            checked += size
+            pbar.update(checked)
+    finally:
+        pool.close()
+        pool.join()
+    pbar.finish()
+    return corrupt
@@ -0,0 +1,279 @@
+from .const import MMAP_WINDOW_SIZE
+from .log import get_logger
+from . import utils
+
+from collections import OrderedDict
+import mmap
+import os
+import threading
+import time
+
+# Logging
+log = get_logger('writers')
+
+# Writers are kept open by each download worker across segments
+_local = threading.local()
+
+# The maximum number of files a worker keeps open at once
+MAX_OPEN_WRITERS = 16
+
+# O_DIRECT writes must start and end on a multiple of this many bytes,
+# from a buffer aligned to it
+DIRECT_ALIGNMENT = 4096
+
+
+class Writer(object):
+    """Base class for writing downloaded chunks into a file at a given
+    offset.  Subclasses implement :func:`_write`.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.writes = 0
+        self.write_time = 0.0
+
+    def write(self, data, offset):
+        start = time.time()
+        self._write(data, offset)
+        self.write_time += time.time() - start
+        self.writes += 1
+
+    def _write(self, data, offset):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class ReopenWriter(Writer):
+    """Opens, seeks, writes and closes the file for every chunk.  This
+    is the original write path.
+
+    """
+
+    def _write(self, data, offset):
+        utils.write_offset(self.path, data, offset)
+
+
+class PwriteWriter(Writer):
+    """Keeps one descriptor open for the file and writes at an offset
+    with ``os.pwrite`` where it is available, or ``lseek`` and
+    ``write`` otherwise.
+
+    """
+
+    def __init__(self, path):
+        super(PwriteWriter, self).__init__(path)
+        self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+
+    def _write(self, data, offset):
+        view = memoryview(data)
+        while view:
+            if hasattr(os, 'pwrite'):
+                written = os.pwrite(self.fd, view, offset)
+            else:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                written = os.write(self.fd, view)
+            view = view[written:]
+            offset += written
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectWriter(PwriteWriter):
+    """Writes the aligned blocks of each chunk with ``O_DIRECT`` from a
+    page aligned buffer, so that large downloads bypass the page cache
+    instead of flooding it.  The unaligned edges of a chunk, such as
+    the end of the file, are written through the page cache.  Where
+    ``O_DIRECT`` is not supported everything is.
+
+    """
+
+    def __init__(self, path):
+        super(DirectWriter, self).__init__(path)
+        self.buffer = None
+        self.direct_fd = None
+        try:
+            self.direct_fd = os.open(path, os.O_RDWR | os.O_DIRECT)
+        except (AttributeError, OSError) as e:
+            log.warn('Unable to open {} with O_DIRECT, writing through the '
+                     'page cache: {}'.format(path, str(e)))
+
+    def _write(self, data, offset):
+        # The aligned blocks are [begin, end) of the chunk
+        begin = min(len(data), -offset % DIRECT_ALIGNMENT)
+        end = len(data) - (len(data) - begin) % DIRECT_ALIGNMENT
+        if self.direct_fd is None or end == begin:
+            return super(DirectWriter, self)._write(data, offset)
+        view = memoryview(data)
+        if begin:
+            super(DirectWriter, self)._write(view[:begin], offset)
+        self._write_direct(data, begin, end, offset + begin)
+        if end < len(data):
+            super(DirectWriter, self)._write(view[end:], offset + end)
+
+    def _write_direct(self, data, begin, end, offset):
+        length = end - begin
+        if self.buffer is None or len(self.buffer) < length:
+            if self.buffer is not None:
+                self.buffer.close()
+            # Anonymous maps are page aligned
+            self.buffer = mmap.mmap(-1, length)
+        self.buffer.seek(0)
+        self.buffer.write(buffer(data, begin, length))
+        written = 0
+        while written < length:
+            block = buffer(self.buffer, written, length - written)
+            if hasattr(os, 'pwrite'):
+                n = os.pwrite(self.direct_fd, block, offset + written)
+            else:
+                os.lseek(self.direct_fd, offset + written, os.SEEK_SET)
+                n = os.write(self.direct_fd, block)
+            written += n
+
+    def close(self):
+        super(DirectWriter, self).close()
+        if self.direct_fd is not None:
+            os.close(self.direct_fd)
+        if self.buffer is not None:
+            self.buffer.close()
+
+
+class MmapWriter(Writer):
+    """Copies chunks into a writable memory map of the file.  Only a
+    window of ``MMAP_WINDOW_SIZE`` bytes is mapped at a time and it is
+    moved when a write falls outside of it.  The file must already
+    have its full length.
+
+    """
+
+    def __init__(self, path, window_size=MMAP_WINDOW_SIZE):
+        super(MmapWriter, self).__init__(path)
+        self.file = open(path, 'r+b')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.window_size = window_size
+        self.window = None
+        self.window_start = 0
+
+    def _map(self, offset):
+        if self.window is not None:
+            self.window.close()
+        self.window_start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        length = min(self.window_size, self.size - self.window_start)
+        self.window = mmap.mmap(
+            self.file.fileno(), length,
+            access=mmap.ACCESS_WRITE, offset=self.window_start)
+
+    def _write(self, data, offset):
+        written = 0
+        while written < len(data):
+            if (self.window is None or offset < self.window_start or
+                    offset >= self.window_start + len(self.window)):
+                self._map(offset)
+            begin = offset - self.window_start
+            length = min(len(self.window) - begin, len(data) - written)
+            # Only slice (copy) the chunk if it straddles two windows
+            if length == len(data):
+                self.window[begin:begin+length] = data
+            else:
+                self.window[begin:begin+length] = data[
+                    written:written+length]
+            written += length
+            offset += length
+
+    def close(self):
+        if self.window is not None:
+            self.window.close()
+        self.file.close()
+
+
+WRITERS = {
+    'reopen': ReopenWriter,
+    'pwrite': PwriteWriter,
+    'mmap': MmapWriter,
+    'direct': DirectWriter,
+}
+
+
+def _writers():
+    """Return this process and thread's open writers, starting fresh
+    after a fork so descriptors are never shared with a parent.
+
+    """
+
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.writers = OrderedDict()
+        _local.stats = {'writes': 0, 'write_time': 0.0}
+    return _local.writers
+
+
+def get_writer(name, path, pipeline=None):
+    """Return an open writer of type ``name`` for ``path``, reusing the
+    one this worker already has open for the file.
+
+    :param str name: One of the keys of :data:`WRITERS`
+    :param str path: The path of the file to write to
+    :param pipeline:
+        The :class:`parcel.pipeline.WritePipeline` the worker queues its
+        chunks on.  A writer evicted to keep ``MAX_OPEN_WRITERS`` open
+        is then closed by the pipeline after the chunks already queued
+        for it, rather than under them
+    :returns: A :class:`Writer`
+
+    """
+
+    writers = _writers()
+    key = (name, path)
+    if key in writers:
+        writers[key] = writers.pop(key)
+    else:
+        if name not in WRITERS:
+            raise ValueError('Unknown writer {}, expected one of: {}'.format(
+                name, ', '.join(sorted(WRITERS))))
+        writers[key] = WRITERS[name](path)
+        while len(writers) > MAX_OPEN_WRITERS:
+            writer = writers.popitem(last=False)[1]
+            if pipeline is None:
+                _close(writer, _local.stats)
+            else:
+                pipeline.writes().submit(_close, writer, _local.stats)
+    return writers[key]
+
+
+def _close(writer, stats):
+    stats['writes'] += writer.writes
+    stats['write_time'] += writer.write_time
+    try:
+        writer.close()
+    except Exception as e:
+        log.error('Unable to close {}: {}'.format(writer.path, str(e)))
+    return 0
+
+
+def close_writers():
+    """Close every writer this worker has open.
+
+    """
+
+    writers = _writers()
+    while writers:
+        _close(writers.popitem()[1], _local.stats)
+
+
+def writer_stats():
+    """Count the chunks written and the seconds spent writing them by
+    this worker's writers, open or closed.
+
+    :returns: A dict with ``writes`` and ``write_time``
+
+    """
+
+    writers = _writers()
+    stats = dict(_local.stats)
+    for writer in writers.values():
+        stats['writes'] += writer.writes
+        stats['write_time'] += writer.write_time
+    return stats
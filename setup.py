@@ -77,6 +77,7 @@ setup(
         'bin/parcel-server',
         'bin/parcel-tcp2udt',
         'bin/parcel-udt2tcp',
+        'bin/parcel-benchmark',
     ],
     **extra_args
 )
@@ -0,0 +1,57 @@
+import unittest
+from parcel.checksum import PrefixChecksum
+from tempfile import NamedTemporaryFile
+import hashlib
+import os
+import threading
+
+
+class TestPrefixChecksum(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(3 * 1024 * 1024 + 17)
+        self.file = NamedTemporaryFile()
+        self.file.write(self.data)
+        self.file.flush()
+
+    def tearDown(self):
+        self.file.close()
+
+    def test_verify(self):
+        checksum = PrefixChecksum(self.file.name)
+        checksum.update(1024)
+        checksum.update(len(self.data))
+        reported = []
+        done = threading.Event()
+
+        def report(digest, error):
+            reported.append((digest, error, threading.current_thread()))
+            done.set()
+
+        checksum.verify(report)
+        done.wait(10)
+        self.assertEqual(len(reported), 1)
+        digest, error, thread = reported[0]
+        self.assertIsNone(error)
+        self.assertIsNot(thread, threading.current_thread())
+        self.assertEqual(digest, hashlib.md5(self.data).hexdigest())
+
+    def test_verify_error(self):
+        checksum = PrefixChecksum(self.file.name)
+        # Past the end of the file
+        checksum.update(len(self.data) + 1)
+        reported = []
+        done = threading.Event()
+        checksum.verify(lambda digest, error: (
+            reported.append((digest, error)), done.set()))
+        done.wait(10)
+        digest, error = reported[0]
+        self.assertIsNone(digest)
+        self.assertIsInstance(error, IOError)
+
+    def test_abandon(self):
+        checksum = PrefixChecksum(self.file.name)
+        checksum.update(len(self.data))
+        checksum.abandon()
+        checksum.thread.join(10)
+        self.assertFalse(checksum.thread.is_alive())
@@ -0,0 +1,112 @@
+import unittest
+from parcel.completion import CompletionRing, SegmentClaim
+from parcel.ranges import Range
+import threading
+import time
+
+
+class TestCompletionRing(unittest.TestCase):
+
+    def test_wrap_around(self):
+        ring = CompletionRing(capacity=4)
+        for i in range(3):
+            ring.put(0, i, i + 1)
+        self.assertEqual([r[1] for r in ring.read()], [0, 1, 2])
+        # These are written over the start of the buffer
+        for i in range(3, 7):
+            ring.put(1, i, i + 1, digest='d' * 16, mirror=2)
+        self.assertEqual(ring.read(), [
+            (1, i, i + 1, 'd' * 16, 2) for i in range(3, 7)])
+        self.assertEqual(ring.read(), [])
+
+    def test_back_pressure(self):
+        ring = CompletionRing(capacity=4)
+        for i in range(4):
+            ring.put(0, i, i + 1)
+        writer = threading.Thread(target=ring.put, args=(0, 4, 5))
+        writer.daemon = True
+        writer.start()
+        time.sleep(0.05)
+        # The ring is full, so the record must not overwrite the oldest
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(ring.counters[0], 4)
+        self.assertEqual([r[1] for r in ring.read()], [0, 1, 2, 3])
+        writer.join(1)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual([r[1] for r in ring.read()], [4])
+
+
+class TestSegmentClaim(unittest.TestCase):
+
+    def assertCovers(self, ranges, begin, end):
+        """Assert that ``ranges`` tile ``[begin, end)`` with no overlap and
+        no gap.
+
+        """
+
+        at = begin
+        for r in sorted(ranges):
+            self.assertEqual(r.begin, at)
+            at = r.end
+        self.assertEqual(at, end)
+
+    def take_all(self, claim, begin, chunk):
+        taken = []
+        while True:
+            length = claim.take(begin, chunk)
+            if not length:
+                return taken
+            taken.append(Range(begin, begin + length))
+            begin += length
+
+    def test_split_live_claim(self):
+        claim = SegmentClaim()
+        claim.start(3, Range(0, 100))
+        self.assertEqual(claim.take(0, 10), 10)
+        self.assertEqual(claim.split(10), (3, 55, 100))
+        self.assertEqual(claim.end, 55)
+        taken = [Range(0, 10)] + self.take_all(claim, 10, 20)
+        # The last chunk before the split point is cut short
+        self.assertEqual(taken[-1], Range(50, 55))
+        self.assertCovers(taken + [Range(55, 100)], 0, 100)
+
+    def test_split_aligned(self):
+        claim = SegmentClaim()
+        claim.start(0, Range(0, 100))
+        claim.take(0, 7)
+        slot, begin, end = claim.split(10, align=16)
+        self.assertEqual((begin, end), (48, 100))
+        self.assertCovers(self.take_all(claim, 7, 16) +
+                          [Range(0, 7), Range(begin, end)], 0, 100)
+
+    def test_split_too_small(self):
+        claim = SegmentClaim()
+        claim.start(0, Range(0, 100))
+        claim.take(0, 90)
+        self.assertIsNone(claim.split(10))
+        self.assertEqual(claim.end, 100)
+        claim.release()
+        self.assertEqual(claim.remaining, 0)
+        self.assertIsNone(claim.split(1))
+
+    def test_split_while_taking(self):
+        size = 1 << 20
+        claim = SegmentClaim()
+        claim.start(0, Range(0, size))
+        taken = []
+
+        def work():
+            taken.extend(self.take_all(claim, 0, 100))
+
+        worker = threading.Thread(target=work)
+        worker.start()
+        splits = []
+        while worker.is_alive():
+            split = claim.split(1000)
+            if split:
+                splits.append(Range(*split[1:]))
+        worker.join()
+        # Each split shortens the segment split before it
+        ends = [size] + [r.begin for r in splits]
+        self.assertEqual([r.end for r in splits], ends[:-1])
+        self.assertCovers(taken + splits, 0, size)
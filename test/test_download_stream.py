@@ -0,0 +1,40 @@
+import unittest
+from parcel.download_stream import DownloadStream
+from tempfile import mkdtemp
+import json
+import os
+import shutil
+
+
+class TestDownloadStream(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stream(self):
+        return DownloadStream('file', 'http://localhost:0/', self.directory)
+
+    def test_information_saved_once(self):
+        stream = self.stream()
+        stream.name, stream.size = 'file.bam', 1024L
+        stream.get_information()
+        with open(stream.metadata_path) as f:
+            self.assertEqual(json.load(f), {'name': 'file.bam', 'size': 1024})
+        # A prefetched stream is initialized without writing it again
+        os.remove(stream.metadata_path)
+        stream.init()
+        self.assertFalse(os.path.exists(stream.metadata_path))
+        self.assertTrue(stream.initialized)
+
+    def test_information_loaded(self):
+        saved = self.stream()
+        saved.name, saved.size = 'file.bam', 1024L
+        saved.save_information()
+        stream = self.stream()
+        self.assertEqual(stream.get_information(), ('file.bam', 1024))
+        os.remove(stream.metadata_path)
+        stream.get_information()
+        self.assertFalse(os.path.exists(stream.metadata_path))
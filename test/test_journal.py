@@ -0,0 +1,104 @@
+import unittest
+from parcel import journal
+from parcel.journal import StateJournal, HEADER, MAGIC
+from intervaltree import Interval, IntervalTree
+from tempfile import mkdtemp
+import hashlib
+import os
+import pickle
+import shutil
+
+
+def digest(i):
+    return hashlib.md5(str(i)).digest()
+
+
+class TestStateJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.path = os.path.join(self.dir, 'file.parcel')
+        self.compact_records = journal.COMPACT_RECORDS
+
+    def tearDown(self):
+        journal.COMPACT_RECORDS = self.compact_records
+        shutil.rmtree(self.dir)
+
+    def reload(self):
+        state = StateJournal(self.path)
+        return sorted(state.load()), state
+
+    def test_roundtrip(self):
+        state = StateJournal(self.path)
+        open(self.path, 'w').close()
+        state.rewrite([(0, 10, digest(0))])
+        state.append(10, 20, digest(1))
+        state.append(20, 30)
+        state.close()
+        records, loaded = self.reload()
+        self.assertEqual(records, [(0, 10, digest(0)), (10, 20, digest(1)),
+                                   (20, 30, None)])
+        self.assertEqual(loaded.recorded_digest, 'md5')
+
+    def test_migrate_pickle(self):
+        tree = IntervalTree([
+            Interval(0, 10, {'md5sum': digest(0).encode('hex')}),
+            Interval(10, 20),
+        ])
+        with open(self.path, 'wb') as f:
+            pickle.dump(tree, f)
+        records, state = self.reload()
+        self.assertEqual(records, [(0, 10, digest(0)), (10, 20, None)])
+        self.assertEqual(state.recorded_digest, 'md5')
+
+        # Rewriting migrates the file to the journal format
+        state.rewrite(records)
+        state.close()
+        with open(self.path, 'rb') as f:
+            self.assertTrue(f.read(HEADER.size).startswith(MAGIC))
+        self.assertEqual(self.reload()[0], records)
+
+    def test_torn_record(self):
+        state = StateJournal(self.path)
+        open(self.path, 'w').close()
+        state.rewrite([(0, 10, digest(0))])
+        state.append(10, 20, digest(1))
+        state.close()
+        # A crash part way through appending a record
+        with open(self.path, 'ab') as f:
+            f.write(state._record(20, 30, digest(2))[:state.record_size / 2])
+        records, state = self.reload()
+        self.assertEqual(records, [(0, 10, digest(0)), (10, 20, digest(1))])
+
+        # Resuming writes a clean journal that can be appended to
+        state.rewrite(records)
+        state.append(20, 30, digest(2))
+        state.close()
+        self.assertEqual(self.reload()[0], [
+            (0, 10, digest(0)), (10, 20, digest(1)), (20, 30, digest(2))])
+
+    def test_compaction(self):
+        journal.COMPACT_RECORDS = 8
+        state = StateJournal(self.path)
+        open(self.path, 'w').close()
+        state.rewrite([])
+        # Every range is recorded three times, as by retries
+        for i in range(3):
+            for j in range(4):
+                state.append(j * 10, j * 10 + 10, digest(j))
+            state.flush()
+        self.assertIsNotNone(state.compaction)
+        # Ranges completed while the compaction runs
+        for j in range(4, 6):
+            state.append(j * 10, j * 10 + 10, digest(j))
+        state.flush()
+        state.close()
+        self.assertIsNone(state.compaction)
+
+        records, _ = self.reload()
+        self.assertEqual(records, [(j * 10, j * 10 + 10, digest(j))
+                                   for j in range(6)])
+        self.assertEqual(os.path.getsize(self.path),
+                         HEADER.size + 6 * state.record_size)
+        # Nothing is left behind by the swap
+        self.assertEqual(os.listdir(self.dir), ['file.parcel'])
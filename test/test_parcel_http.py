@@ -1,11 +1,19 @@
 import unittest
 from parcel import mock_server
+from parcel import range_server
+from parcel.range_server import RangeServer
+from parcel.writers import MAX_OPEN_WRITERS
 from tempfile import NamedTemporaryFile, mkdtemp, gettempdir
 import random
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 from subprocess import check_call
+import errno
+import hashlib
+import json
 import shutil
+import socket
 import os
+import pstats
 import time
 
 
@@ -13,6 +21,29 @@ server_host = 'localhost'
 server_port = 8888
 
 
+def serve_truncated(server, requests):
+    """Serve ``server`` with the response to the first segment request
+    for each file cut off half way, putting the ``(file, begin)`` of
+    every request on the ``requests`` queue.
+
+    """
+
+    copy_range = range_server.copy_range
+    served = {}
+
+    def truncate(sock, f, begin, end):
+        requests.put((os.path.basename(f.name), begin))
+        # The first request is for the file's information
+        served[f.name] = served.get(f.name, 0) + 1
+        if served[f.name] != 2:
+            return copy_range(sock, f, begin, end)
+        copy_range(sock, f, begin, begin + (end - begin) / 2)
+        raise socket.error(errno.EPIPE, 'Truncated')
+
+    range_server.copy_range = truncate
+    server.serve_forever()
+
+
 class TestParcelHTTP(unittest.TestCase):
 
     def setUp(self):
@@ -65,3 +96,269 @@ class TestParcelHTTP(unittest.TestCase):
             self.validate_file(
                 os.path.join(gettempdir(), file_id),
                 os.path.join(gettempdir(), self.dest_dir, file_id, file_id))
+
+    def test_files_in_flight(self):
+        check_call(
+            ['parcel', '-v',
+             '-n4',
+             '--files-in-flight', '3',
+             '-d', self.dest_dir,
+             '-s', 'http://{}:{}'.format(server_host, server_port)]
+            + self.file_ids)
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(gettempdir(), self.dest_dir, file_id, file_id))
+
+    def test_async_files_in_flight(self):
+        # More files at once than a worker keeps writers open for
+        files = [NamedTemporaryFile() for i in range(MAX_OPEN_WRITERS + 4)]
+        for f in files:
+            f.write(str(range(random.randint(1000, 3000))))
+            f.flush()
+        metrics = os.path.join(self.dest_dir, 'metrics.json')
+        file_ids = [f.name.split('/')[-1] for f in files]
+        check_call(
+            ['parcel', '-v',
+             '-n', str(len(files)),
+             '--engine', 'async',
+             '--files-in-flight', str(len(files)),
+             '--writer', 'mmap',
+             '--http-chunk-size', '100',
+             '--metrics-file', metrics,
+             '-d', self.dest_dir,
+             '-s', 'http://{}:{}'.format(server_host, server_port)]
+            + file_ids)
+        for file_id in file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(self.dest_dir, file_id, file_id))
+        with open(metrics) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['retries'], 0)
+        for f in files:
+            f.close()
+
+    def test_autotune(self):
+        check_call(
+            ['parcel', '-v',
+             '-n2',
+             '--autotune', '--max-processes', '6',
+             '-d', self.dest_dir,
+             '-s', 'http://{}:{}'.format(server_host, server_port)]
+            + self.file_ids)
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(gettempdir(), self.dest_dir, file_id, file_id))
+
+    def test_manifest_md5(self):
+        manifest = os.path.join(self.dest_dir, 'manifest.txt')
+        with open(manifest, 'w') as m:
+            m.write('id\tfilename\tmd5\tsize\tstate\n')
+            for f, file_id in zip(self.files, self.file_ids):
+                with open(f.name, 'rb') as src:
+                    data = src.read()
+                m.write('{}\t{}\t{}\t{}\tlive\n'.format(
+                    file_id, file_id, hashlib.md5(data).hexdigest(),
+                    len(data)))
+        check_call(
+            ['parcel', '-v',
+             '-n4',
+             '-m', manifest,
+             '-d', self.dest_dir,
+             '-s', 'http://{}:{}'.format(server_host, server_port)])
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(gettempdir(), self.dest_dir, file_id, file_id))
+
+    def test_segment_digest(self):
+        for file_id in self.file_ids:
+            check_call(
+                ['parcel', '-v',
+                 '-n2',
+                 '--segment-digest', 'crc32',
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, server_port),
+                 file_id])
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(gettempdir(), self.dest_dir, file_id, file_id))
+
+    def test_engines(self):
+        for engine in ['threads', 'async']:
+            dest_dir = mkdtemp()
+            check_call(
+                ['parcel', '-v',
+                 '-n3',
+                 '--engine', engine,
+                 '-d', dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, server_port)]
+                + self.file_ids)
+            for file_id in self.file_ids:
+                self.validate_file(
+                    os.path.join(gettempdir(), file_id),
+                    os.path.join(dest_dir, file_id, file_id))
+            shutil.rmtree(dest_dir)
+
+    def test_writers(self):
+        for writer in ['reopen', 'mmap', 'direct']:
+            dest_dir = mkdtemp()
+            check_call(
+                ['parcel', '-v',
+                 '-n2',
+                 '--writer', writer,
+                 '--http-chunk-size', '100',
+                 '-d', dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, server_port)]
+                + self.file_ids)
+            for file_id in self.file_ids:
+                self.validate_file(
+                    os.path.join(gettempdir(), file_id),
+                    os.path.join(dest_dir, file_id, file_id))
+            shutil.rmtree(dest_dir)
+
+    def test_range_server(self):
+        server = RangeServer(gettempdir(), server_host, 0)
+        process = Process(target=server.serve_forever)
+        process.start()
+        server.server_close()
+        try:
+            check_call(
+                ['parcel', '-v',
+                 '-n2',
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, server.port)]
+                + self.file_ids)
+        finally:
+            process.terminate()
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(self.dest_dir, file_id, file_id))
+
+    def test_cached_metadata(self):
+        args = ['parcel', '-v',
+                '-n2',
+                '-d', self.dest_dir,
+                '-s', 'http://{}:{}'.format(server_host, server_port)]
+        check_call(args + self.file_ids)
+        for file_id in self.file_ids:
+            self.assertTrue(os.path.isfile(os.path.join(
+                self.dest_dir, file_id, 'logs', 'metadata.json')))
+        check_call(args + self.file_ids)
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(gettempdir(), self.dest_dir, file_id, file_id))
+
+    def test_metrics_file(self):
+        metrics = os.path.join(self.dest_dir, 'metrics.json')
+        check_call(
+            ['parcel', '-v',
+             '-n2',
+             '--metrics-file', metrics,
+             '-d', self.dest_dir,
+             '-s', 'http://{}:{}'.format(server_host, server_port)]
+            + self.file_ids)
+        with open(metrics) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['downloaded'], len(self.file_ids))
+        self.assertEqual(snapshot['errors'], 0)
+        self.assertEqual(len(snapshot['workers']), 2)
+        self.assertTrue(all(w['write_queue'] == 0
+                            for w in snapshot['workers']))
+        self.assertEqual(
+            sum(w['bytes'] for w in snapshot['workers']),
+            sum(os.path.getsize(f.name) for f in self.files))
+
+    def test_trace_and_profile(self):
+        trace = os.path.join(self.dest_dir, 'trace.json')
+        profile = os.path.join(self.dest_dir, 'workers.prof')
+        check_call(
+            ['parcel', '-v',
+             '-n2',
+             '--trace', trace,
+             '--profile', profile,
+             '-d', self.dest_dir,
+             '-s', 'http://{}:{}'.format(server_host, server_port)]
+            + self.file_ids)
+        with open(trace) as f:
+            events = json.load(f)['traceEvents']
+        segments = [e for e in events if e['name'] == 'segment']
+        self.assertEqual(len(segments), len(self.file_ids))
+        self.assertTrue(all(e['ph'] == 'X' and e['dur'] >= 0 for e in events))
+        self.assertTrue(pstats.Stats(profile).total_calls > 0)
+
+    def test_resume_segments(self):
+        server = RangeServer(gettempdir(), server_host, 0)
+        requests = Queue()
+        for engine in ['processes', 'async']:
+            dest_dir = mkdtemp()
+            metrics = os.path.join(dest_dir, 'metrics.json')
+            process = Process(target=serve_truncated,
+                              args=(server, requests))
+            process.start()
+            try:
+                check_call(
+                    ['parcel', '-v',
+                     '-n2',
+                     '--engine', engine,
+                     '--http-chunk-size', '64',
+                     '--metrics-file', metrics,
+                     '-d', dest_dir,
+                     '-s', 'http://{}:{}'.format(server_host, server.port)]
+                    + self.file_ids)
+            finally:
+                process.terminate()
+            with open(metrics) as f:
+                self.assertEqual(json.load(f)['retries'], len(self.file_ids))
+            begins = {}
+            while not requests.empty():
+                file_id, begin = requests.get()
+                begins.setdefault(file_id, []).append(begin)
+            for file_id in self.file_ids:
+                # The retry continues where the first response was cut off
+                self.assertEqual(len(begins[file_id]), 3)
+                self.assertTrue(begins[file_id][2] > 0)
+                self.validate_file(
+                    os.path.join(gettempdir(), file_id),
+                    os.path.join(dest_dir, file_id, file_id))
+            shutil.rmtree(dest_dir)
+        server.server_close()
+
+    def test_mirrors(self):
+        # The second mirror is the range server, the third is down
+        server = RangeServer(gettempdir(), server_host, 0)
+        process = Process(target=server.serve_forever)
+        process.start()
+        server.server_close()
+        down = socket.socket()
+        down.bind((server_host, 0))
+        metrics = os.path.join(self.dest_dir, 'metrics.json')
+        try:
+            check_call(
+                ['parcel', '-v',
+                 '-n3',
+                 '--http-chunk-size', '64',
+                 '--metrics-file', metrics,
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, server_port),
+                 '--mirror', 'http://{}:{}'.format(server_host, server.port),
+                 '--mirror', 'http://{}:{}'.format(
+                     server_host, down.getsockname()[1])]
+                + self.file_ids)
+        finally:
+            process.terminate()
+            down.close()
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(self.dest_dir, file_id, file_id))
+        with open(metrics) as f:
+            mirrors = json.load(f)['mirrors']
+        self.assertEqual(len(mirrors), 3)
+        self.assertEqual(sum(m['bytes'] for m in mirrors),
+                         sum(os.path.getsize(f.name) for f in self.files))
+        self.assertEqual(mirrors[2]['bytes'], 0)
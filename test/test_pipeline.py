@@ -0,0 +1,56 @@
+import unittest
+from multiprocessing.sharedctypes import RawArray
+from ctypes import c_uint64
+from parcel.pipeline import WritePipeline
+import time
+
+
+class TestWritePipeline(unittest.TestCase):
+
+    def test_close_writes_in_order(self):
+        stats = RawArray(c_uint64, 2)
+        pipeline = WritePipeline(depth=2, stats=stats)
+        written = []
+
+        def write(i):
+            time.sleep(0.002)
+            written.append(i)
+            return 1
+
+        writes = pipeline.writes()
+        for i in range(20):
+            writes.submit(write, i)
+        # Everything queued is written before the thread stops
+        pipeline.close()
+        self.assertFalse(pipeline.thread.is_alive())
+        self.assertEqual(written, range(20))
+        self.assertEqual(writes.written, 20)
+        self.assertEqual(writes.pending, 0)
+        self.assertEqual(stats[0], 0)
+        # Twenty slow writes through a queue of two must have blocked
+        self.assertGreater(stats[1], 0)
+
+    def test_error_drops_rest(self):
+        pipeline = WritePipeline(depth=4)
+        written = []
+
+        def write(i):
+            if i == 2:
+                raise IOError('No space left on device')
+            written.append(i)
+            return 1
+
+        writes = pipeline.writes()
+        for i in range(5):
+            writes.submit(write, i)
+        writes.wait()
+        self.assertEqual(written, [0, 1])
+        self.assertEqual(writes.written, 2)
+        self.assertIsInstance(writes.error, IOError)
+        self.assertRaises(IOError, writes.submit, write, 5)
+        # Other requests are unaffected
+        other = pipeline.writes()
+        other.submit(write, 6)
+        pipeline.close()
+        self.assertEqual(written, [0, 1, 6])
+        self.assertIsNone(other.error)
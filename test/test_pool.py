@@ -0,0 +1,114 @@
+import unittest
+from collections import namedtuple
+from parcel import const
+from parcel.completion import SegmentRetry
+from parcel.download_stream import DownloadStream
+from parcel.pool import DownloadPool, Worker
+from parcel.ranges import Range
+from parcel.tuning import ConnectionTuner, TUNE_INTERVAL
+from tempfile import mkdtemp
+import shutil
+import time
+
+
+class TestDownloadPool(unittest.TestCase):
+
+    def test_retries_shed_connections(self):
+        pool = DownloadPool(4, tuner=ConnectionTuner(4, max_procs=8),
+                            engine='threads')
+        try:
+            for i in range(3):
+                pool.q_events.put((0, SegmentRetry(100, 'Truncated', 0)))
+            # Judge the interval now
+            pool.measure_start -= TUNE_INTERVAL
+            pool.tune_start -= TUNE_INTERVAL
+            pool.poll()
+            self.assertEqual(pool.retries, 3)
+            self.assertEqual(pool.wasted, 300)
+            self.assertEqual(pool.n_procs, 3)
+            self.assertEqual(pool.tune_errors, 0)
+        finally:
+            pool.stop()
+
+    def add_worker(self, pool, rate):
+        worker = Worker(pool.engine, pool.q_work, pool.q_events)
+        worker.rate = rate
+        pool.workers.append(worker)
+        return worker
+
+    def test_segment_size(self):
+        pool = DownloadPool(2, engine='threads')
+        self.assertEqual(pool.segment_size(), const.MIN_SEGMENT_SIZE)
+        # Unmeasured workers do not count
+        self.add_worker(pool, None)
+        self.add_worker(pool, 3.5 * const.MB)
+        self.add_worker(pool, 6.5 * const.MB)
+        self.assertEqual(pool.segment_size(), 50 * const.MB)
+        self.add_worker(pool, 1024 * const.MB)
+        self.assertEqual(pool.segment_size(), const.MAX_SEGMENT_SIZE)
+        pool.workers = [w for w in pool.workers if not w.rate]
+        self.add_worker(pool, 1)
+        self.assertEqual(pool.segment_size(), const.MIN_SEGMENT_SIZE)
+
+    def test_split_segment(self):
+        pool = DownloadPool(2, engine='threads')
+        stream = namedtuple('Stream', ['ID'])('file')
+        pool.active[1] = namedtuple('Producer', ['download'])(stream)
+        fast = self.add_worker(pool, 100 * const.MB)
+        slow = self.add_worker(pool, const.MB)
+        fast.claims[0].start(1, Range(0, 256 * const.MB))
+        slow.claims[0].start(1, Range(256 * const.MB, 320 * const.MB))
+        slow.claims[0].take(256 * const.MB, 4 * const.MB)
+        # A segment of a file that is no longer active is never split
+        other = self.add_worker(pool, 1)
+        other.claims[0].start(2, Range(0, 256 * const.MB))
+        slot, download, segment, mirror = pool.split_segment()
+        self.assertEqual((slot, download, mirror), (1, stream, 0))
+        # The slow connection will finish last although it has less left
+        self.assertEqual(segment, Range(290 * const.MB, 320 * const.MB))
+        self.assertEqual(slow.claims[0].end, segment.begin)
+        self.assertEqual(fast.claims[0].end, 256 * const.MB)
+        self.assertEqual(other.claims[0].end, 256 * const.MB)
+        # Splitting never gives away what has been claimed
+        self.assertEqual(
+            slow.claims[0].take(260 * const.MB, 40 * const.MB), 30 * const.MB)
+        fast.claims[0].take(0, 256 * const.MB - const.MIN_SEGMENT_SIZE)
+        self.assertIsNone(pool.split_segment())
+
+    def test_dead_worker_rescheduled(self):
+        directory = mkdtemp()
+        pool = DownloadPool(1, engine='processes')
+        try:
+            stream = DownloadStream('file', 'http://localhost:0/', directory)
+            stream.name, stream.size = 'file', 64 * const.MB
+            pool.activate(stream)
+            producer = pool.active[0]
+            segment = producer.next_segment(32 * const.MB)
+            self.assertEqual(list(producer.work_pool),
+                             [(32 * const.MB, 64 * const.MB)])
+            pool.start()
+            worker = pool.workers[0]
+            # The worker has claimed 2 MB of the segment and written 1 MB
+            claim = worker.claims[0]
+            claim.start(0, segment)
+            claim.take(0, 2 * const.MB)
+            worker.ring.put(0, 0, const.MB)
+            worker.process.terminate()
+            worker.process.join()
+            pool.poll()
+            self.assertEqual(list(producer.completed), [(0, const.MB)])
+            self.assertEqual(list(producer.work_pool),
+                             [(const.MB, 64 * const.MB)])
+            self.assertEqual(len(pool.workers), 1)
+            self.assertIsNot(pool.workers[0], worker)
+            self.assertTrue(pool.workers[0].process.is_alive())
+            # A retired worker is not replaced
+            pool.resize(0)
+            pool.workers[0].process.join(10)
+            pool.poll()
+            self.assertEqual(pool.workers, [])
+            self.assertEqual(pool.retiring, 0)
+            self.assertEqual(pool.spawned, 2)
+        finally:
+            pool.stop()
+            shutil.rmtree(directory)
@@ -0,0 +1,83 @@
+import unittest
+from parcel.ranges import RangeSet
+
+
+class TestRangeSet(unittest.TestCase):
+
+    def assertRanges(self, ranges, expected):
+        self.assertEqual(list(ranges), expected)
+        self.assertEqual(ranges.total, sum(e - b for b, e in expected))
+
+    def test_empty(self):
+        ranges = RangeSet()
+        self.assertRanges(ranges, [])
+        self.assertEqual(len(ranges), 0)
+        self.assertIsNone(ranges.first())
+        self.assertEqual(ranges.next_gap(0), 0)
+        ranges.remove(0, 10)
+        self.assertRanges(ranges, [])
+
+    def test_empty_ranges(self):
+        ranges = RangeSet([(0, 10)])
+        ranges.add(5, 5)
+        ranges.add(20, 20)
+        ranges.add(30, 25)
+        self.assertRanges(ranges, [(0, 10)])
+        ranges.remove(5, 5)
+        ranges.remove(8, 2)
+        self.assertRanges(ranges, [(0, 10)])
+
+    def test_add_disjoint(self):
+        ranges = RangeSet([(20, 30), (0, 10), (40, 50)])
+        self.assertRanges(ranges, [(0, 10), (20, 30), (40, 50)])
+        self.assertEqual(ranges.first(), (0, 10))
+
+    def test_add_adjacent(self):
+        ranges = RangeSet([(0, 10), (20, 30)])
+        ranges.add(10, 20)
+        self.assertRanges(ranges, [(0, 30)])
+        ranges.add(30, 40)
+        self.assertRanges(ranges, [(0, 40)])
+
+    def test_add_overlapping(self):
+        ranges = RangeSet([(0, 10), (20, 30), (40, 50)])
+        ranges.add(5, 25)
+        self.assertRanges(ranges, [(0, 30), (40, 50)])
+        ranges.add(35, 60)
+        self.assertRanges(ranges, [(0, 30), (35, 60)])
+        # Inside an existing range
+        ranges.add(1, 2)
+        self.assertRanges(ranges, [(0, 30), (35, 60)])
+        # Over every range
+        ranges.add(0, 100)
+        self.assertRanges(ranges, [(0, 100)])
+
+    def test_remove_middle(self):
+        ranges = RangeSet([(0, 100)])
+        ranges.remove(40, 60)
+        self.assertRanges(ranges, [(0, 40), (60, 100)])
+        ranges.remove(0, 10)
+        ranges.remove(90, 100)
+        self.assertRanges(ranges, [(10, 40), (60, 90)])
+
+    def test_remove_across_ranges(self):
+        ranges = RangeSet([(0, 10), (20, 30), (40, 50)])
+        ranges.remove(5, 45)
+        self.assertRanges(ranges, [(0, 5), (45, 50)])
+        # Gaps only
+        ranges.remove(10, 40)
+        self.assertRanges(ranges, [(0, 5), (45, 50)])
+        ranges.remove(0, 50)
+        self.assertRanges(ranges, [])
+
+    def test_next_gap(self):
+        ranges = RangeSet([(0, 10), (20, 30)])
+        self.assertEqual(ranges.next_gap(0), 10)
+        self.assertEqual(ranges.next_gap(9), 10)
+        # The end of a range is not in it
+        self.assertEqual(ranges.next_gap(10), 10)
+        self.assertEqual(ranges.next_gap(15), 15)
+        self.assertEqual(ranges.next_gap(20), 30)
+        self.assertEqual(ranges.next_gap(30), 30)
+        self.assertEqual(ranges.next_gap(100), 100)
+        self.assertEqual(RangeSet([(5, 10)]).next_gap(0), 0)
@@ -1,10 +1,14 @@
 import unittest
 from parcel import mock_server
+from parcel.cparcel import _lib
 from tempfile import NamedTemporaryFile, mkdtemp, gettempdir
 import random
+import requests
 from multiprocessing import Process
-from subprocess import check_call
+from subprocess import Popen, check_call
 import shutil
+import json
+import socket
 import os
 import time
 
@@ -13,6 +17,14 @@ server_host = 'localhost'
 server_port = 8888
 
 
+def free_port(kind):
+    s = socket.socket(socket.AF_INET, kind)
+    s.bind((server_host, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
 class TestParcelUDT(unittest.TestCase):
 
     def setUp(self):
@@ -69,3 +81,165 @@ class TestParcelUDT(unittest.TestCase):
                 os.path.join(gettempdir(), file_id),
                 os.path.join(gettempdir(), self.dest_dir, '{}_{}'.format(
                     file_id, file_id)))
+
+    @unittest.skipIf(_lib is None, "parcel udt library not built")
+    def test_serve_directory(self):
+        udt_port = free_port(socket.SOCK_DGRAM)
+        proxy_port = free_port(socket.SOCK_STREAM)
+        range_port = free_port(socket.SOCK_STREAM)
+        server = Popen(
+            ['parcel-server',
+             '-d', gettempdir(),
+             '-i', server_host,
+             '-p', str(udt_port)])
+        proxy = Popen(
+            ['parcel-tcp2udt',
+             '-i', server_host,
+             '-p', str(range_port),
+             'http://{}:{}'.format(server_host, udt_port)])
+        time.sleep(1)
+        self.files[0].seek(0)
+        data = self.files[0].read()
+        url = 'http://{}:{}/{}'.format(
+            server_host, range_port, self.file_ids[0])
+        try:
+            check_call(
+                ['parcel', '--udt', '-v',
+                 '-n2',
+                 '-P', str(proxy_port),
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, udt_port)]
+                + self.file_ids)
+            # Ranges, suffix ranges and unsatisfiable ranges
+            for spec, begin, end in [('10-19', 10, 20),
+                                     ('-100', len(data) - 100, len(data)),
+                                     ('-{}'.format(len(data) * 2),
+                                      0, len(data)),
+                                     ('100-', 100, len(data))]:
+                r = requests.get(url, headers={'Range': 'bytes=' + spec})
+                self.assertEqual(r.status_code, 206, spec)
+                self.assertEqual(r.content, data[begin:end], spec)
+                self.assertEqual(
+                    r.headers['Content-Range'], 'bytes {}-{}/{}'.format(
+                        begin, end - 1, len(data)))
+            for spec in ['-0', '{}-'.format(len(data)), '20-10']:
+                r = requests.get(url, headers={'Range': 'bytes=' + spec})
+                self.assertEqual(r.status_code, 416, spec)
+        finally:
+            proxy.terminate()
+            server.terminate()
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(self.dest_dir, file_id, file_id))
+
+    @unittest.skipIf(_lib is None, "parcel udt library not built")
+    def test_stripes(self):
+        udt_port = free_port(socket.SOCK_DGRAM)
+        proxy_port = free_port(socket.SOCK_STREAM)
+        server = Popen(
+            ['parcel-server',
+             '-i', server_host,
+             '-p', str(udt_port),
+             '--stripes', '3',
+             'http://{}:{}'.format(server_host, server_port)])
+        time.sleep(1)
+        try:
+            check_call(
+                ['parcel', '--udt', '-v',
+                 '-n2',
+                 '--stripes', '3',
+                 '-P', str(proxy_port),
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, udt_port)]
+                + self.file_ids)
+        finally:
+            server.terminate()
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(self.dest_dir, file_id, file_id))
+
+    @unittest.skipIf(_lib is None, "parcel udt library not built")
+    def test_pool(self):
+        # Fewer warm connections than workers, so that some requests
+        # get a pooled connection and some connect their own
+        udt_port = free_port(socket.SOCK_DGRAM)
+        proxy_port = free_port(socket.SOCK_STREAM)
+        server = Popen(
+            ['parcel-server',
+             '-i', server_host,
+             '-p', str(udt_port),
+             'http://{}:{}'.format(server_host, server_port)])
+        time.sleep(1)
+        try:
+            check_call(
+                ['parcel', '--udt', '-v',
+                 '-n4',
+                 '--udt-pool', '2',
+                 '-P', str(proxy_port),
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, udt_port)]
+                + self.file_ids)
+        finally:
+            server.terminate()
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(self.dest_dir, file_id, file_id))
+
+    @unittest.skipIf(_lib is None, "parcel udt library not built")
+    def test_congestion_control(self):
+        # The server sends at a fixed rate, the client's proxy sends
+        # its requests with the TCP-like controller
+        udt_port = free_port(socket.SOCK_DGRAM)
+        proxy_port = free_port(socket.SOCK_STREAM)
+        server = Popen(
+            ['parcel-server',
+             '-i', server_host,
+             '-p', str(udt_port),
+             '--congestion-control', 'blast:1000',
+             'http://{}:{}'.format(server_host, server_port)])
+        time.sleep(1)
+        try:
+            check_call(
+                ['parcel', '--udt', '-v',
+                 '--congestion-control', 'tcp',
+                 '-P', str(proxy_port),
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, udt_port)]
+                + self.file_ids)
+        finally:
+            server.terminate()
+        for file_id in self.file_ids:
+            self.validate_file(
+                os.path.join(gettempdir(), file_id),
+                os.path.join(self.dest_dir, file_id, file_id))
+
+    @unittest.skipIf(_lib is None, "parcel udt library not built")
+    def test_udt_stats(self):
+        udt_port = free_port(socket.SOCK_DGRAM)
+        proxy_port = free_port(socket.SOCK_STREAM)
+        metrics = os.path.join(self.dest_dir, 'metrics.json')
+        server = Popen(
+            ['parcel-server',
+             '-i', server_host,
+             '-p', str(udt_port),
+             'http://{}:{}'.format(server_host, server_port)])
+        time.sleep(1)
+        try:
+            check_call(
+                ['parcel', '--udt', '-v',
+                 '--udt-stats-interval', '0.5',
+                 '--metrics-file', metrics,
+                 '-P', str(proxy_port),
+                 '-d', self.dest_dir,
+                 '-s', 'http://{}:{}'.format(server_host, udt_port)]
+                + self.file_ids)
+        finally:
+            server.terminate()
+        with open(metrics) as f:
+            snapshot = json.load(f)
+        total = snapshot['udt']['tcp2udt']['total']
+        self.assertGreater(total['sent_packets'], 0)
+        self.assertGreater(total['received_packets'], 0)
@@ -0,0 +1,49 @@
+import unittest
+from parcel import writers
+from parcel.pipeline import WritePipeline
+from tempfile import mkdtemp
+import os
+import shutil
+import threading
+
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        writers.close_writers()
+        shutil.rmtree(self.directory)
+
+    def write(self, writer, data, offset):
+        writer.write(data, offset)
+        return len(data)
+
+    def test_evicted_writer_closed_after_queued_chunks(self):
+        written = writers.writer_stats()['writes']
+        pipeline = WritePipeline(depth=64)
+        blocked = threading.Event()
+        writes = pipeline.writes()
+        # Hold the pipeline so that every chunk below is still queued
+        # when the writers are evicted
+        writes.submit(lambda: blocked.wait(10) and 0)
+        paths = [os.path.join(self.directory, str(i))
+                 for i in range(writers.MAX_OPEN_WRITERS + 4)]
+        for path in paths:
+            with open(path, 'w') as f:
+                f.write('\0' * 4)
+            writer = writers.get_writer('mmap', path, pipeline)
+            writes.submit(self.write, writer, os.path.basename(path)[:4], 0)
+        self.assertEqual(len(writers._writers()), writers.MAX_OPEN_WRITERS)
+        blocked.set()
+        writes.wait()
+        pipeline.close()
+        self.assertIsNone(writes.error)
+        writers.close_writers()
+        for path in paths:
+            with open(path) as f:
+                self.assertEqual(f.read().rstrip('\0'),
+                                 os.path.basename(path))
+        self.assertEqual(writers.writer_stats()['writes'] - written,
+                         len(paths))